@@ -8,10 +8,25 @@ NUM_GPUS = 4
 WORKERS = []
 PORTS = [8001 + i for i in range(NUM_GPUS)]
 worker_path = str(pathlib.Path(__file__).resolve().parent / "worker.py")
+# GPU of a text encoder service shared by all workers, which then load only the transformer and the VAE; None keeps
+# the text encoders in every worker
+TEXT_ENCODER_GPU = None
+TEXT_ENCODER_SOCKET = "/tmp/hidream_text_encoder.sock"
+text_encoder_server_path = str(pathlib.Path(__file__).resolve().parent / "text_encoder_server.py")
 
 from concurrent.futures import ThreadPoolExecutor
 import subprocess, os
 
+def launch_text_encoder_server():
+    return subprocess.Popen(
+        ["python", text_encoder_server_path],
+        env={
+            **os.environ,
+            "TEXT_ENCODER_SOCKET": TEXT_ENCODER_SOCKET,
+            "CUDA_VISIBLE_DEVICES": str(TEXT_ENCODER_GPU)
+        }
+    )
+
 def launch_worker(i, port):
     return {
         "gpu": i,
@@ -22,11 +37,15 @@ def launch_worker(i, port):
             env={
                 **os.environ,
                 "PORT": str(port),
-                "CUDA_VISIBLE_DEVICES": str(i)
+                "CUDA_VISIBLE_DEVICES": str(i),
+                # the workers wait for the service to come up when they first encode a prompt
+                **({"TEXT_ENCODER_SOCKET": TEXT_ENCODER_SOCKET} if TEXT_ENCODER_GPU is not None else {})
             }
         )
     }
 
+TEXT_ENCODER_SERVER = launch_text_encoder_server() if TEXT_ENCODER_GPU is not None else None
+
 # Concurrently launch workers
 with ThreadPoolExecutor() as executor:
     futures = [
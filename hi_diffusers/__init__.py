@@ -1,2 +1,7 @@
-from .models.transformers.transformer_hidream_image import HiDreamImageTransformer2DModel
+from .models.transformers.transformer_hidream_image import (
+    HiDreamImageTransformer2DModel,
+    HiDreamTextConditioning,
+    HiDreamScheduleConditioning,
+    HiDreamStepConditioning,
+)
 from .pipelines.hidream_image.pipeline_hidream_image import HiDreamImagePipeline
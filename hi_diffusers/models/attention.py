@@ -1,9 +1,57 @@
 import torch
 from torch import nn
-from typing import Optional
+from typing import List, Optional
 from diffusers.models.attention_processor import Attention
 from diffusers.utils.torch_utils import maybe_allow_in_graph
 
+@torch.no_grad()
+def fuse_linears(linears: List[nn.Linear]) -> nn.Linear:
+    weight = torch.cat([linear.weight.data for linear in linears], dim=0)
+    has_bias = linears[0].bias is not None
+    fused = torch.nn.utils.skip_init(
+        nn.Linear, weight.shape[1], weight.shape[0], bias=has_bias, device=weight.device, dtype=weight.dtype
+    )
+    fused.weight.data = weight
+    if has_bias:
+        fused.bias.data = torch.cat([linear.bias.data for linear in linears], dim=0)
+    return fused
+
+@torch.no_grad()
+def unfuse_linear(fused: nn.Linear, out_features: List[int]) -> List[nn.Linear]:
+    linears = []
+    weights = fused.weight.data.split(out_features, dim=0)
+    biases = fused.bias.data.split(out_features, dim=0) if fused.bias is not None else [None] * len(out_features)
+    for weight, bias in zip(weights, biases):
+        linear = torch.nn.utils.skip_init(
+            nn.Linear, weight.shape[1], weight.shape[0], bias=bias is not None, device=weight.device, dtype=weight.dtype
+        )
+        linear.weight.data = weight.clone()
+        if bias is not None:
+            linear.bias.data = bias.clone()
+        linears.append(linear)
+    return linears
+
+def max_chunk_rows(max_chunk_bytes: Optional[int], row_bytes: int, num_rows: int) -> Optional[int]:
+    """Rows per chunk that keep `row_bytes` per row under `max_chunk_bytes`, None if all rows fit at once."""
+    if max_chunk_bytes is None:
+        return None
+    max_rows = max(1, max_chunk_bytes // row_bytes)
+    return max_rows if num_rows > max_rows else None
+
+def apply_in_chunks(fn, x: torch.Tensor, max_rows: int) -> torch.Tensor:
+    """
+    Applies the token-wise `fn` to slices of at most `max_rows` tokens of `x` (..., dim), passed as (1, rows, dim),
+    and writes the results into one output, so only one slice of intermediate activations is alive at a time.
+    """
+    x_flat = x.reshape(-1, x.shape[-1])
+    out = None
+    for start in range(0, x_flat.shape[0], max_rows):
+        chunk = fn(x_flat[start:start + max_rows][None])[0]
+        if out is None:
+            out = chunk.new_empty(x_flat.shape[0], chunk.shape[-1])
+        out[start:start + chunk.shape[0]] = chunk
+    return out.view(*x.shape[:-1], out.shape[-1])
+
 @maybe_allow_in_graph
 class HiDreamAttention(Attention):
     def __init__(
@@ -50,6 +98,12 @@ class HiDreamAttention(Attention):
             self.q_rms_norm_t = nn.RMSNorm(self.inner_dim, eps)
             self.k_rms_norm_t = nn.RMSNorm(self.inner_dim, eps)
 
+        self.fused_projections = False
+
+        # None defers to the process-wide defaults, see `attention_processor.set_attention_backend`
+        self.attention_backend = None
+        self.mask_padded_keys = None
+
         self.set_processor(processor)
         self.apply(self._init_weights)
 
@@ -59,12 +113,50 @@ class HiDreamAttention(Attention):
             if m.bias is not None:
                 nn.init.constant_(m.bias, 0)
 
+    @torch.no_grad()
+    def fuse_projections(self):
+        """Replaces to_q/to_k/to_v (and their text-stream counterparts) by a single to_qkv projection."""
+        if self.fused_projections:
+            return
+        self.to_qkv = fuse_linears([self.to_q, self.to_k, self.to_v])
+        del self.to_q, self.to_k, self.to_v
+        if not self.single:
+            self.to_qkv_t = fuse_linears([self.to_q_t, self.to_k_t, self.to_v_t])
+            del self.to_q_t, self.to_k_t, self.to_v_t
+        self.fused_projections = True
+
+    @torch.no_grad()
+    def unfuse_projections(self):
+        if not self.fused_projections:
+            return
+        self.to_q, self.to_k, self.to_v = unfuse_linear(self.to_qkv, [self.inner_dim] * 3)
+        del self.to_qkv
+        if not self.single:
+            self.to_q_t, self.to_k_t, self.to_v_t = unfuse_linear(self.to_qkv_t, [self.inner_dim] * 3)
+            del self.to_qkv_t
+        self.fused_projections = False
+
+    def image_keys(self, norm_image_tokens: torch.Tensor) -> torch.Tensor:
+        """Normalized attention keys of the image stream, without positional encoding."""
+        if self.fused_projections:
+            key = self.to_qkv(norm_image_tokens).chunk(3, dim=-1)[1]
+        else:
+            key = self.to_k(norm_image_tokens)
+        return self.k_rms_norm(key)
+
+    def set_attention_backend(self, backend: Optional[str] = None, mask_padded_keys: Optional[bool] = None):
+        self.attention_backend = backend
+        self.mask_padded_keys = mask_padded_keys
+
     def forward(
         self,
         norm_image_tokens: torch.FloatTensor,
         image_tokens_masks: torch.FloatTensor = None,
         norm_text_tokens: torch.FloatTensor = None,
         rope: torch.FloatTensor = None,
+        packed_seq = None,
+        seq_shard = None,
+        text_tokens_masks: torch.Tensor = None,
     ) -> torch.Tensor:
         return self.processor(
             self,
@@ -72,6 +164,9 @@ class HiDreamAttention(Attention):
             image_tokens_masks = image_tokens_masks,
             text_tokens = norm_text_tokens,
             rope = rope,
+            packed_seq = packed_seq,
+            seq_shard = seq_shard,
+            text_tokens_masks = text_tokens_masks,
         )
 
 class FeedForwardSwiGLU(nn.Module):
@@ -94,6 +189,10 @@ class FeedForwardSwiGLU(nn.Module):
         self.w1 = nn.Linear(dim, hidden_dim, bias=False)
         self.w2 = nn.Linear(hidden_dim, dim, bias=False)
         self.w3 = nn.Linear(dim, hidden_dim, bias=False)
+        self.hidden_dim = hidden_dim
+        self.fused_projections = False
+        # byte budget of the intermediate activations, see `HiDreamImageTransformer2DModel.set_ffn_memory_budget`
+        self.max_chunk_bytes = None
         self.apply(self._init_weights)
     
     def _init_weights(self, m):
@@ -102,5 +201,32 @@ class FeedForwardSwiGLU(nn.Module):
             if m.bias is not None:
                 nn.init.constant_(m.bias, 0)
 
+    @torch.no_grad()
+    def fuse_projections(self):
+        """Replaces w1/w3, which read the same input, by a single w13 projection."""
+        if self.fused_projections:
+            return
+        self.w13 = fuse_linears([self.w1, self.w3])
+        del self.w1, self.w3
+        self.fused_projections = True
+
+    @torch.no_grad()
+    def unfuse_projections(self):
+        if not self.fused_projections:
+            return
+        self.w1, self.w3 = unfuse_linear(self.w13, [self.hidden_dim] * 2)
+        del self.w13
+        self.fused_projections = False
+
     def forward(self, x):
+        # the w1 and w3 activations and their product are `3 * hidden_dim` values per token
+        max_rows = max_chunk_rows(self.max_chunk_bytes, 3 * self.hidden_dim * x.element_size(), x.numel() // x.shape[-1])
+        if max_rows is not None:
+            return apply_in_chunks(self._forward, x, max_rows)
+        return self._forward(x)
+
+    def _forward(self, x):
+        if self.fused_projections:
+            x1, x3 = self.w13(x).chunk(2, dim=-1)
+            return self.w2(torch.nn.functional.silu(x1) * x3)
         return self.w2(torch.nn.functional.silu(self.w1(x)) * self.w3(x))
\ No newline at end of file
@@ -1,14 +1,60 @@
-from typing import Optional
+import itertools
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Optional
 import torch
+import torch.nn.functional as F
 from .attention import HiDreamAttention
+from .sequence_parallel import SequenceShard, sequence_parallel_attention
 
 try:
-    from flash_attn_interface import flash_attn_func
+    from flash_attn_interface import flash_attn_func as flash_attn3_func
+    from flash_attn_interface import flash_attn_varlen_func as flash_attn3_varlen_func
     USE_FLASH_ATTN3 = True
-except:
-    from flash_attn import flash_attn_func
+except ImportError:
     USE_FLASH_ATTN3 = False
 
+try:
+    from flash_attn import flash_attn_func, flash_attn_varlen_func
+    USE_FLASH_ATTN2 = True
+except ImportError:
+    USE_FLASH_ATTN2 = False
+
+@dataclass
+class PackedSeqInfo:
+    """
+    Layout of a packed batch: the tokens of all samples are concatenated into a single sequence without padding.
+    `sample_ids` gives the owning sample of every token, `perm`/`inv_perm` group the tokens sample by sample for
+    variable-length attention, described by `cu_seqlens` and `max_seqlen`.
+    """
+    sample_ids: torch.Tensor
+    perm: torch.Tensor
+    inv_perm: torch.Tensor
+    cu_seqlens: torch.Tensor
+    max_seqlen: int
+    seq_lens: List[int]
+
+    @classmethod
+    def from_segments(cls, segments: List[List[int]], device: torch.device) -> "PackedSeqInfo":
+        # `segments` are consecutive parts of the packed sequence, each holding the token count of every sample
+        batch_size = len(segments[0])
+        sample_ids = torch.cat([
+            torch.repeat_interleave(torch.arange(batch_size), torch.tensor(seq_lens, dtype=torch.int64))
+            for seq_lens in segments
+        ])
+        perm = torch.argsort(sample_ids, stable=True)
+        inv_perm = torch.argsort(perm)
+        seq_lens = [sum(segment[i] for segment in segments) for i in range(batch_size)]
+        cu_seqlens = torch.tensor([0] + list(itertools.accumulate(seq_lens)), dtype=torch.int32)
+        return cls(
+            sample_ids = sample_ids.to(device),
+            perm = perm.to(device),
+            inv_perm = inv_perm.to(device),
+            cu_seqlens = cu_seqlens.to(device),
+            max_seqlen = max(seq_lens),
+            seq_lens = seq_lens,
+        )
+
 # Copied from https://github.com/black-forest-labs/flux/blob/main/src/flux/math.py
 def apply_rope(xq: torch.Tensor, xk: torch.Tensor, freqs_cis: torch.Tensor) -> tuple[torch.Tensor, torch.Tensor]:
     xq_ = xq.float().reshape(*xq.shape[:-1], -1, 1, 2)
@@ -17,15 +63,215 @@ def apply_rope(xq: torch.Tensor, xk: torch.Tensor, freqs_cis: torch.Tensor) -> t
     xk_out = freqs_cis[..., 0] * xk_[..., 0] + freqs_cis[..., 1] * xk_[..., 1]
     return xq_out.reshape(*xq.shape).type_as(xq), xk_out.reshape(*xk.shape).type_as(xk)
 
-def attention(query: torch.Tensor, key: torch.Tensor, value: torch.Tensor):
-    if USE_FLASH_ATTN3:
-        hidden_states = flash_attn_func(query, key, value, causal=False, deterministic=False)[0]
-    else:
-        hidden_states = flash_attn_func(query, key, value, dropout_p=0., causal=False)
+def _additive_key_mask(key_padding_mask: torch.Tensor, dtype: torch.dtype) -> torch.Tensor:
+    # (B, S) keep-mask -> (B, 1, 1, S) additive bias broadcast over heads and queries
+    bias = torch.zeros(key_padding_mask.shape, dtype=dtype, device=key_padding_mask.device)
+    bias = bias.masked_fill(~key_padding_mask.bool(), float("-inf"))
+    return bias[:, None, None, :]
+
+def _flash_attn_with_key_mask(varlen_func, query, key, value, key_padding_mask, **kwargs):
+    # flash-attn has no mask argument: padded keys are dropped and the batch runs as a varlen problem
+    batch_size, seq_len, heads, head_dim = query.shape
+    keep = key_padding_mask.bool()
+    cu_seqlens_q = torch.arange(0, (batch_size + 1) * seq_len, seq_len, dtype=torch.int32, device=query.device)
+    cu_seqlens_k = F.pad(keep.sum(dim=1, dtype=torch.int32).cumsum(0, dtype=torch.int32), (1, 0))
+    hidden_states = varlen_func(
+        query.reshape(-1, heads, head_dim), key[keep], value[keep],
+        cu_seqlens_q, cu_seqlens_k, seq_len, key.shape[1], causal=False, **kwargs
+    )
+    return hidden_states
+
+def flash_attn3_backend(query, key, value, key_padding_mask=None):
+    if key_padding_mask is not None:
+        hidden_states = _flash_attn_with_key_mask(
+            flash_attn3_varlen_func, query, key, value, key_padding_mask, deterministic=False
+        )[0]
+        return hidden_states.view(query.shape)
+    return flash_attn3_func(query, key, value, causal=False, deterministic=False)[0]
+
+def flash_attn3_varlen_backend(query, key, value, packed_seq):
+    cu_seqlens, max_seqlen = packed_seq.cu_seqlens, packed_seq.max_seqlen
+    return flash_attn3_varlen_func(
+        query, key, value, cu_seqlens, cu_seqlens, max_seqlen, max_seqlen, causal=False, deterministic=False
+    )[0]
+
+def flash_attn2_backend(query, key, value, key_padding_mask=None):
+    if key_padding_mask is not None:
+        hidden_states = _flash_attn_with_key_mask(
+            flash_attn_varlen_func, query, key, value, key_padding_mask, dropout_p=0.
+        )
+        return hidden_states.view(query.shape)
+    return flash_attn_func(query, key, value, dropout_p=0., causal=False)
+
+def flash_attn2_varlen_backend(query, key, value, packed_seq):
+    cu_seqlens, max_seqlen = packed_seq.cu_seqlens, packed_seq.max_seqlen
+    return flash_attn_varlen_func(
+        query, key, value, cu_seqlens, cu_seqlens, max_seqlen, max_seqlen, dropout_p=0., causal=False
+    )
+
+def sdpa_backend(query, key, value, key_padding_mask=None):
+    attn_mask = _additive_key_mask(key_padding_mask, query.dtype) if key_padding_mask is not None else None
+    hidden_states = F.scaled_dot_product_attention(
+        query.transpose(1, 2), key.transpose(1, 2), value.transpose(1, 2), attn_mask=attn_mask
+    )
+    return hidden_states.transpose(1, 2)
+
+def chunked_backend(query, key, value, key_padding_mask=None, chunk_size=1024):
+    # reference implementation: only a (chunk_size x S) block of attention scores is materialized at a time
+    scale = query.shape[-1] ** -0.5
+    query, key, value = (x.transpose(1, 2).float() for x in (query, key, value))
+    bias = _additive_key_mask(key_padding_mask, query.dtype) if key_padding_mask is not None else None
+    hidden_states = torch.empty_like(query)
+    for start in range(0, query.shape[2], chunk_size):
+        scores = torch.matmul(query[:, :, start:start + chunk_size], key.transpose(-1, -2)) * scale
+        if bias is not None:
+            scores = scores + bias
+        hidden_states[:, :, start:start + chunk_size] = torch.matmul(scores.softmax(dim=-1), value)
+    return hidden_states.transpose(1, 2)
+
+def _varlen_by_sample(dense_backend):
+    # varlen fallback for dense backends: one attention call per packed sample
+    def varlen_backend(query, key, value, packed_seq):
+        hidden_states = [
+            dense_backend(q[None], k[None], v[None])[0]
+            for q, k, v in zip(*(x.split(packed_seq.seq_lens) for x in (query, key, value)))
+        ]
+        return torch.cat(hidden_states, dim=0)
+    return varlen_backend
+
+@dataclass
+class AttentionBackend:
+    """
+    An attention implementation. `func` takes (B, S, H, D) query/key/value and an optional (B, S) key padding mask
+    (nonzero = attend), `varlen_func` takes packed (N, H, D) tensors grouped by sample and a `PackedSeqInfo`.
+    """
+    name: str
+    func: Callable
+    varlen_func: Callable
+    is_available: Callable[[torch.Tensor], bool]
+
+ATTENTION_BACKENDS: Dict[str, AttentionBackend] = {}
+# order in which the "auto" backend picks an available implementation
+AUTO_ATTENTION_BACKENDS = ["flash_attn3", "flash_attn2", "sdpa"]
+_ATTENTION_CONFIG = {"backend": "auto", "mask_padded_keys": False}
+
+def register_attention_backend(
+    name: str,
+    func: Callable,
+    varlen_func: Optional[Callable] = None,
+    is_available: Optional[Callable[[torch.Tensor], bool]] = None,
+):
+    ATTENTION_BACKENDS[name] = AttentionBackend(
+        name = name,
+        func = func,
+        varlen_func = varlen_func or _varlen_by_sample(func),
+        is_available = is_available or (lambda query: True),
+    )
+
+register_attention_backend(
+    "flash_attn3", flash_attn3_backend, flash_attn3_varlen_backend,
+    is_available = lambda query: USE_FLASH_ATTN3 and query.is_cuda,
+)
+register_attention_backend(
+    "flash_attn2", flash_attn2_backend, flash_attn2_varlen_backend,
+    is_available = lambda query: USE_FLASH_ATTN2 and query.is_cuda,
+)
+register_attention_backend("sdpa", sdpa_backend)
+register_attention_backend("chunked", chunked_backend)
+
+def set_attention_backend(backend: Optional[str] = None, mask_padded_keys: Optional[bool] = None):
+    """
+    Sets the process-wide attention defaults used by every `HiDreamAttention` without its own override. `backend` is
+    a registered backend name or "auto"; `mask_padded_keys` excludes padded image tokens from attention with a
+    key-padding mask instead of zeroing their keys (which is what the released checkpoints were run with).
+    """
+    if backend is not None:
+        if backend != "auto" and backend not in ATTENTION_BACKENDS:
+            raise ValueError(f"Unknown attention backend {backend}, available: {list(ATTENTION_BACKENDS)} or 'auto'")
+        _ATTENTION_CONFIG["backend"] = backend
+    if mask_padded_keys is not None:
+        _ATTENTION_CONFIG["mask_padded_keys"] = mask_padded_keys
+
+def get_attention_backend(query: torch.Tensor, backend: Optional[str] = None) -> AttentionBackend:
+    backend = backend or _ATTENTION_CONFIG["backend"]
+    if backend != "auto":
+        return ATTENTION_BACKENDS[backend]
+    for name in AUTO_ATTENTION_BACKENDS:
+        if ATTENTION_BACKENDS[name].is_available(query):
+            return ATTENTION_BACKENDS[name]
+    return ATTENTION_BACKENDS["chunked"]
+
+def attention(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    key_padding_mask: Optional[torch.Tensor] = None,
+    backend: Optional[str] = None,
+):
+    hidden_states = get_attention_backend(query, backend).func(query, key, value, key_padding_mask)
+    hidden_states = hidden_states.flatten(-2)
+    hidden_states = hidden_states.to(query.dtype)
+    return hidden_states
+
+def attention_varlen(
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    packed_seq: PackedSeqInfo,
+    backend: Optional[str] = None,
+):
+    attn_backend = get_attention_backend(query, backend)
+    query, key, value = (x.index_select(0, packed_seq.perm) for x in (query, key, value))
+    hidden_states = attn_backend.varlen_func(query, key, value, packed_seq)
+    hidden_states = hidden_states.index_select(0, packed_seq.inv_perm)
     hidden_states = hidden_states.flatten(-2)
     hidden_states = hidden_states.to(query.dtype)
     return hidden_states
 
+@torch.no_grad()
+def benchmark_attention_backends(
+    batch_size: int,
+    seq_len: int,
+    heads: int,
+    head_dim: int,
+    device: torch.device,
+    dtype: torch.dtype = torch.bfloat16,
+    warmup: int = 2,
+    iters: int = 10,
+    backends: Optional[List[str]] = None,
+) -> Dict[str, float]:
+    """Returns the mean latency in milliseconds of every usable backend for the given attention shape."""
+    query, key, value = (
+        torch.randn(batch_size, seq_len, heads, head_dim, device=device, dtype=dtype) for _ in range(3)
+    )
+    timings = {}
+    for name in backends or list(ATTENTION_BACKENDS):
+        attn_backend = ATTENTION_BACKENDS[name]
+        if not attn_backend.is_available(query):
+            continue
+        try:
+            for _ in range(warmup):
+                attn_backend.func(query, key, value)
+            if query.is_cuda:
+                torch.cuda.synchronize(device)
+            start = time.perf_counter()
+            for _ in range(iters):
+                attn_backend.func(query, key, value)
+            if query.is_cuda:
+                torch.cuda.synchronize(device)
+        except RuntimeError:
+            # e.g. dtype or head_dim not supported by the kernel
+            continue
+        timings[name] = (time.perf_counter() - start) * 1000 / iters
+    return timings
+
+def select_fastest_attention_backend(*args, **kwargs) -> str:
+    """Benchmarks the backends on a shape (see `benchmark_attention_backends`) and makes the fastest the default."""
+    timings = benchmark_attention_backends(*args, **kwargs)
+    backend = min(timings, key=timings.get)
+    set_attention_backend(backend)
+    return backend
+
 class HiDreamAttnProcessor_flashattn:
     """Attention processor used typically in processing the SD3-like self-attention projections."""
 
@@ -36,15 +282,21 @@ class HiDreamAttnProcessor_flashattn:
         image_tokens_masks: Optional[torch.FloatTensor] = None,
         text_tokens: Optional[torch.FloatTensor] = None,
         rope: torch.FloatTensor = None,
+        packed_seq: Optional[PackedSeqInfo] = None,
+        seq_shard: Optional[SequenceShard] = None,
+        text_tokens_masks: Optional[torch.Tensor] = None,
         *args,
         **kwargs,
     ) -> torch.FloatTensor:
         dtype = image_tokens.dtype
         batch_size = image_tokens.shape[0]
 
-        query_i = attn.q_rms_norm(attn.to_q(image_tokens)).to(dtype=dtype)
-        key_i = attn.k_rms_norm(attn.to_k(image_tokens)).to(dtype=dtype)
-        value_i = attn.to_v(image_tokens)
+        if attn.fused_projections:
+            query_i, key_i, value_i = attn.to_qkv(image_tokens).chunk(3, dim=-1)
+        else:
+            query_i, key_i, value_i = attn.to_q(image_tokens), attn.to_k(image_tokens), attn.to_v(image_tokens)
+        query_i = attn.q_rms_norm(query_i).to(dtype=dtype)
+        key_i = attn.k_rms_norm(key_i).to(dtype=dtype)
 
         inner_dim = key_i.shape[-1]
         head_dim = inner_dim // attn.heads
@@ -52,13 +304,23 @@ class HiDreamAttnProcessor_flashattn:
         query_i = query_i.view(batch_size, -1, attn.heads, head_dim)
         key_i = key_i.view(batch_size, -1, attn.heads, head_dim)
         value_i = value_i.view(batch_size, -1, attn.heads, head_dim)
+        mask_padded_keys = attn.mask_padded_keys
+        if mask_padded_keys is None:
+            mask_padded_keys = _ATTENTION_CONFIG["mask_padded_keys"]
+        key_padding_mask = None
         if image_tokens_masks is not None:
-            key_i = key_i * image_tokens_masks.view(batch_size, -1, 1, 1)
+            if mask_padded_keys:
+                key_padding_mask = image_tokens_masks
+            else:
+                key_i = key_i * image_tokens_masks.view(batch_size, -1, 1, 1)
 
         if not attn.single:
-            query_t = attn.q_rms_norm_t(attn.to_q_t(text_tokens)).to(dtype=dtype)
-            key_t = attn.k_rms_norm_t(attn.to_k_t(text_tokens)).to(dtype=dtype)
-            value_t = attn.to_v_t(text_tokens)
+            if attn.fused_projections:
+                query_t, key_t, value_t = attn.to_qkv_t(text_tokens).chunk(3, dim=-1)
+            else:
+                query_t, key_t, value_t = attn.to_q_t(text_tokens), attn.to_k_t(text_tokens), attn.to_v_t(text_tokens)
+            query_t = attn.q_rms_norm_t(query_t).to(dtype=dtype)
+            key_t = attn.k_rms_norm_t(key_t).to(dtype=dtype)
 
             query_t = query_t.view(batch_size, -1, attn.heads, head_dim)
             key_t = key_t.view(batch_size, -1, attn.heads, head_dim)
@@ -69,10 +331,24 @@ class HiDreamAttnProcessor_flashattn:
             query = torch.cat([query_i, query_t], dim=1)
             key = torch.cat([key_i, key_t], dim=1)
             value = torch.cat([value_i, value_t], dim=1)
+            if key_padding_mask is not None or text_tokens_masks is not None:
+                if key_padding_mask is None:
+                    key_padding_mask = text_tokens_masks.new_ones(batch_size, num_image_tokens)
+                if text_tokens_masks is None:
+                    text_tokens_masks = key_padding_mask.new_ones(batch_size, num_text_tokens)
+                key_padding_mask = torch.cat([key_padding_mask, text_tokens_masks.to(key_padding_mask.dtype)], dim=1)
         else:
             query = query_i
             key = key_i
             value = value_i
+            if text_tokens_masks is not None:
+                # the text tokens are the tail of the single-stream sequence
+                num_image_tokens = query.shape[1] - text_tokens_masks.shape[1]
+                if key_padding_mask is None:
+                    key_padding_mask = text_tokens_masks.new_ones(batch_size, num_image_tokens)
+                key_padding_mask = torch.cat(
+                    [key_padding_mask[:, :num_image_tokens], text_tokens_masks.to(key_padding_mask.dtype)], dim=1
+                )
         
         if query.shape[-1] == rope.shape[-3] * 2:
             query, key = apply_rope(query, key, rope)
@@ -83,7 +359,17 @@ class HiDreamAttnProcessor_flashattn:
             query = torch.cat([query_1, query_2], dim=-1)
             key = torch.cat([key_1, key_2], dim=-1)
 
-        hidden_states = attention(query, key, value)
+        if packed_seq is not None:
+            hidden_states = attention_varlen(query[0], key[0], value[0], packed_seq, backend=attn.attention_backend)[None]
+        elif seq_shard is not None:
+            # image tokens are sharded across ranks, see `sequence_parallel.SequenceParallel`
+            attn_backend = get_attention_backend(query, attn.attention_backend)
+            hidden_states = sequence_parallel_attention(
+                attn_backend.func, query, key, value, seq_shard, key_padding_mask
+            )
+            hidden_states = hidden_states.flatten(-2).to(query.dtype)
+        else:
+            hidden_states = attention(query, key, value, key_padding_mask, backend=attn.attention_backend)
 
         if not attn.single:
             hidden_states_i, hidden_states_t = torch.split(hidden_states, [num_image_tokens, num_text_tokens], dim=1)
@@ -0,0 +1,88 @@
+from typing import List, Optional, Tuple
+import torch
+
+# Starting points per model variant. Larger thresholds skip more steps at a larger quality cost, so tune them
+# against reference images of the deployment before enabling them in production.
+BLOCK_CACHE_PRESETS = {
+    "full": {"threshold": 0.2, "warmup_steps": 3},
+    "dev": {"threshold": 0.15, "warmup_steps": 2},
+    "fast": {"threshold": 0.1, "warmup_steps": 2},
+}
+
+class BlockResidualCache:
+    """
+    Step-to-step residual cache for a contiguous range of transformer blocks (TeaCache-style).
+
+    Every step measures the relative L1 change of the modulated input of the first cached block against the previous
+    step. While the change accumulated since the last full computation stays below `threshold`, the blocks in
+    `block_range` are skipped and the residual they produced last time is added to their input instead.
+    """
+
+    def __init__(
+        self,
+        threshold: float = 0.1,
+        block_range: Optional[Tuple[int, int]] = None,
+        warmup_steps: int = 1,
+        max_consecutive_skips: Optional[int] = None,
+        coefficients: Optional[List[float]] = None,
+    ):
+        self.threshold = threshold
+        self.block_range = block_range
+        self.warmup_steps = warmup_steps
+        self.max_consecutive_skips = max_consecutive_skips
+        # optional polynomial (highest order first) mapping the input change to the expected output change
+        self.coefficients = coefficients
+        self.reset()
+
+    def reset(self, num_steps: Optional[int] = None):
+        """Clears the cached state; call once per request. With `num_steps` the last step is always computed."""
+        self.num_steps = num_steps
+        self.step = 0
+        self.skipped_steps = 0
+        self.accumulated_change = 0.0
+        self.consecutive_skips = 0
+        self.previous_input = None
+        self.residual = None
+
+    def get_block_range(self, num_blocks: int) -> Tuple[int, int]:
+        start, end = self.block_range if self.block_range is not None else (0, num_blocks)
+        if not 0 <= start < end <= num_blocks:
+            raise ValueError(f"Invalid cached block range {self.block_range} for {num_blocks} blocks")
+        return start, end
+
+    @torch.no_grad()
+    def should_skip(self, modulated_input: torch.Tensor) -> bool:
+        step = self.step
+        self.step += 1
+        previous_input, self.previous_input = self.previous_input, modulated_input
+
+        skip = False
+        if (
+            previous_input is not None
+            and previous_input.shape == modulated_input.shape
+            and self.residual is not None
+            and step >= self.warmup_steps
+            and (self.num_steps is None or step < self.num_steps - 1)
+            and (self.max_consecutive_skips is None or self.consecutive_skips < self.max_consecutive_skips)
+        ):
+            change = (
+                (modulated_input - previous_input).abs().mean() / previous_input.abs().mean().clamp_min(1e-8)
+            ).item()
+            if self.coefficients is not None:
+                change = sum(c * change ** i for i, c in enumerate(reversed(self.coefficients)))
+            self.accumulated_change += abs(change)
+            skip = self.accumulated_change < self.threshold
+
+        if skip:
+            self.skipped_steps += 1
+            self.consecutive_skips += 1
+        else:
+            self.accumulated_change = 0.0
+            self.consecutive_skips = 0
+        return skip
+
+    def apply(self, hidden_states: torch.Tensor) -> torch.Tensor:
+        return hidden_states + self.residual
+
+    def update(self, block_input: torch.Tensor, block_output: torch.Tensor):
+        self.residual = block_output - block_input
@@ -1,6 +1,7 @@
+from collections import OrderedDict
 import torch
 from torch import nn
-from typing import List
+from typing import List, Optional, Sequence, Tuple
 from diffusers.models.embeddings import Timesteps, TimestepEmbedding
 
 # Copied from https://github.com/black-forest-labs/flux/blob/main/src/flux/math.py
@@ -19,13 +20,31 @@ def rope(pos: torch.Tensor, dim: int, theta: int) -> torch.Tensor:
     out = stacked_out.view(batch_size, -1, dim // 2, 2, 2)
     return out.float()
 
+def img_position_ids(pH: int, pW: int, device=None) -> torch.Tensor:
+    img_ids = torch.zeros(pH, pW, 3, device=device)
+    img_ids[..., 1] = img_ids[..., 1] + torch.arange(pH, device=device)[:, None]
+    img_ids[..., 2] = img_ids[..., 2] + torch.arange(pW, device=device)[None, :]
+    return img_ids.reshape(pH * pW, 3)
+
+def expand_modulation(modulation: torch.Tensor, sample_ids: Optional[torch.Tensor] = None) -> torch.Tensor:
+    # (B, C) -> (B, 1, C) for padded batches, or one row per token -> (1, N, C) for packed batches
+    if sample_ids is None:
+        return modulation[:, None]
+    return modulation[sample_ids][None]
+
 # Copied from https://github.com/black-forest-labs/flux/blob/main/src/flux/modules/layers.py
 class EmbedND(nn.Module):
-    def __init__(self, theta: int, axes_dim: List[int]):
+    def __init__(self, theta: int, axes_dim: List[int], cache_size: int = 16):
         super().__init__()
         self.theta = theta
         self.axes_dim = axes_dim
 
+        # rope tables only depend on the token geometry, keep the most recent ones on device
+        self.cache_size = cache_size
+        self._rope_cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def forward(self, ids: torch.Tensor) -> torch.Tensor:
         n_axes = ids.shape[-1]
         emb = torch.cat(
@@ -33,6 +52,79 @@ class EmbedND(nn.Module):
             dim=-3,
         )
         return emb.unsqueeze(2)
+
+    def get_rope(
+        self,
+        img_sizes: Sequence[Tuple[int, int]],
+        image_seq_len: int,
+        text_seq_len: int,
+        device: torch.device,
+        dtype: torch.dtype = torch.float32,
+    ) -> torch.Tensor:
+        """
+        Returns the rope table for image tokens laid out on `img_sizes` grids (padded to `image_seq_len`) followed by
+        `text_seq_len` text tokens. Tables are cached per geometry; batches of equally sized images share a single
+        table with a batch dimension of 1.
+        """
+        img_sizes = [tuple(int(v) for v in img_size) for img_size in img_sizes]
+        if len(set(img_sizes)) == 1:
+            img_sizes = img_sizes[:1]
+        key = (tuple(img_sizes), image_seq_len, text_seq_len, torch.device(device), dtype)
+
+        def build():
+            ids = torch.zeros(len(img_sizes), image_seq_len + text_seq_len, 3, device=device)
+            for i, (pH, pW) in enumerate(img_sizes):
+                ids[i, :pH * pW] = img_position_ids(pH, pW, device=device)
+            return self(ids).to(dtype)
+        return self._lookup(key, build)
+
+    def get_packed_rope(
+        self,
+        img_sizes: Sequence[Tuple[int, int]],
+        text_seq_len: int,
+        device: torch.device,
+        dtype: torch.dtype = torch.float32,
+    ) -> torch.Tensor:
+        """
+        Returns the rope table of a packed batch: the unpadded image tokens of every sample back to back, followed by
+        `text_seq_len` text tokens in total.
+        """
+        img_sizes = tuple(tuple(int(v) for v in img_size) for img_size in img_sizes)
+        key = ("packed", img_sizes, text_seq_len, torch.device(device), dtype)
+
+        def build():
+            embs = [self.get_rope([img_size], img_size[0] * img_size[1], 0, device, dtype) for img_size in img_sizes]
+            embs.append(self.get_rope([(0, 0)], 0, text_seq_len, device, dtype))
+            return torch.cat(embs, dim=1)
+        return self._lookup(key, build)
+
+    def _lookup(self, key, build):
+        emb = self._rope_cache.get(key)
+        if emb is not None:
+            self._rope_cache.move_to_end(key)
+            self.cache_hits += 1
+            return emb
+
+        self.cache_misses += 1
+        emb = build()
+        if self.cache_size > 0:
+            self._rope_cache[key] = emb
+            if len(self._rope_cache) > self.cache_size:
+                self._rope_cache.popitem(last=False)
+        return emb
+
+    def cache_info(self):
+        return {
+            "hits": self.cache_hits,
+            "misses": self.cache_misses,
+            "size": len(self._rope_cache),
+            "max_size": self.cache_size,
+        }
+
+    def clear_cache(self):
+        self._rope_cache.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
     
 class PatchEmbed(nn.Module):
     def __init__(
@@ -107,8 +199,10 @@ class OutEmbed(nn.Module):
             if m.bias is not None:
                 nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, adaln_input):
-        shift, scale = self.adaLN_modulation(adaln_input).chunk(2, dim=1)
-        x = self.norm_final(x) * (1 + scale.unsqueeze(1)) + shift.unsqueeze(1)
+    def forward(self, x, adaln_input, sample_ids=None, modulation=None):
+        if modulation is None:
+            modulation = self.adaLN_modulation(adaln_input)
+        shift, scale = expand_modulation(modulation, sample_ids).chunk(2, dim=-1)
+        x = self.norm_final(x) * (1 + scale) + shift
         x = self.linear(x)
         return x
\ No newline at end of file
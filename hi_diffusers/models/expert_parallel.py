@@ -0,0 +1,167 @@
+import math
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+import torch
+import torch.distributed as dist
+from torch import nn
+
+@dataclass
+class ExpertDispatch:
+    """
+    Tokens of one MoE layer exchanged with the expert-owning ranks. `tokens` are the rows received by this rank,
+    grouped by local expert with `tokens_per_local_expert` rows each; `order` are the routing assignments (token
+    index * top-k + slot) this rank sent, in send order.
+    """
+    tokens: torch.Tensor
+    tokens_per_local_expert: List[int]
+    order: torch.Tensor
+    grouping: torch.Tensor
+    send_splits: List[int]
+    recv_splits: List[int]
+
+class ExpertParallel:
+    """
+    Expert parallelism of the MoE layers over the ranks of a process group: rank r owns the routed experts
+    [r * E / P, (r + 1) * E / P) of every layer, the others are moved to `offload_device`. After the gate of a layer
+    routes the local tokens, every token is sent to the ranks owning its top-k experts with an all-to-all, run
+    there, and sent back to be combined with the gate weights. The shared experts run locally.
+
+    Every rank can run different tokens (data parallelism), but all ranks have to run the same number of forwards,
+    since every MoE layer is a collective. With a `capacity_factor`, an expert accepts at most
+    ceil(capacity_factor * assignments / E) assignments from every rank per layer; the rest are dropped, i.e. that
+    token only gets its other experts and the shared experts. `stats()` reports the tokens every rank processed and
+    the dropped assignments.
+    """
+
+    def __init__(
+        self,
+        moe_layers: List[nn.Module],
+        group: Optional[dist.ProcessGroup] = None,
+        capacity_factor: Optional[float] = None,
+        offload_device: torch.device = "cpu",
+    ):
+        if not dist.is_initialized():
+            raise RuntimeError("Expert parallelism needs an initialized default process group")
+        if capacity_factor is not None and capacity_factor <= 0:
+            raise ValueError(f"`capacity_factor` has to be positive but is {capacity_factor}")
+        self.layers = list(moe_layers)
+        self.group = group
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+        self.capacity_factor = capacity_factor
+        self.num_experts = len(self.layers[0].experts)
+        if self.num_experts % self.world_size != 0:
+            raise ValueError(f"{self.num_experts} experts cannot be split across {self.world_size} ranks")
+        self.num_local_experts = self.num_experts // self.world_size
+        self.local_experts = range(self.rank * self.num_local_experts, (self.rank + 1) * self.num_local_experts)
+
+        self.devices = []
+        for layer_id, layer in enumerate(self.layers):
+            self.devices.append(layer.gate.weight.device)
+            for expert_id, expert in enumerate(layer.experts):
+                if expert_id not in self.local_experts:
+                    expert.to(offload_device)
+            layer.expert_parallel = self
+            layer.moe_layer_id = layer_id
+            layer._stacked_expert_weights = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.tokens_per_rank = torch.zeros(self.world_size, dtype=torch.int64)
+        self.expert_load = torch.zeros(len(self.layers), self.num_experts, dtype=torch.int64)
+        self.routed_assignments = 0
+        self.dropped_assignments = 0
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Routing assignments processed by every rank and by every expert of every layer since the last
+        `reset_stats`, summed over all ranks, the load imbalance (busiest rank over the mean) and the fraction of
+        assignments dropped by the capacity limit.
+        """
+        mean_tokens = self.tokens_per_rank.float().mean().item()
+        return {
+            "tokens_per_rank": self.tokens_per_rank.tolist(),
+            "expert_load": self.expert_load.tolist(),
+            "load_imbalance": self.tokens_per_rank.max().item() / mean_tokens if mean_tokens > 0 else 1.0,
+            "routed_assignments": self.routed_assignments,
+            "dropped_assignments": self.dropped_assignments,
+            "drop_rate": self.dropped_assignments / max(self.routed_assignments, 1),
+        }
+
+    def capacity(self, num_assignments: int) -> Optional[int]:
+        """Assignments an expert accepts from one rank in one layer, None without a capacity limit."""
+        if self.capacity_factor is None:
+            return None
+        return math.ceil(self.capacity_factor * num_assignments / self.num_experts)
+
+    def dispatch(self, layer_id: int, x: torch.Tensor, flat_expert_indices: torch.Tensor, top_k: int) -> ExpertDispatch:
+        num_experts, world_size = self.num_experts, self.world_size
+        order = flat_expert_indices.argsort(stable=True)
+        tokens_per_expert = torch.zeros(num_experts, dtype=torch.int64, device=x.device)
+        tokens_per_expert.index_add_(0, flat_expert_indices, torch.ones_like(flat_expert_indices))
+        sent_per_expert = tokens_per_expert
+        capacity = self.capacity(flat_expert_indices.numel())
+        if capacity is not None:
+            # assignments beyond the capacity of an expert are dropped, earlier tokens are kept
+            sorted_expert_indices = flat_expert_indices[order]
+            starts = tokens_per_expert.cumsum(0) - tokens_per_expert
+            positions = torch.arange(order.numel(), device=x.device) - starts[sorted_expert_indices]
+            order = order[positions < capacity]
+            sent_per_expert = tokens_per_expert.clamp(max=capacity)
+
+        # every rank learns what all ranks send to which expert; this is the one host sync of a layer
+        counts = torch.stack([tokens_per_expert, sent_per_expert])
+        all_counts = [torch.empty_like(counts) for _ in range(world_size)]
+        dist.all_gather(all_counts, counts, group=self.group)
+        all_counts = torch.stack(all_counts).cpu()
+        all_sent = all_counts[:, 1].view(world_size, world_size, self.num_local_experts)
+        recv_per_expert = all_sent[:, self.rank]
+        send_splits = all_sent[self.rank].sum(-1).tolist()
+        recv_splits = recv_per_expert.sum(-1).tolist()
+
+        self.tokens_per_rank += all_sent.sum((0, 2))
+        self.expert_load[layer_id] += all_counts[:, 1].sum(0)
+        routed = int(all_counts[:, 0].sum())
+        self.routed_assignments += routed
+        self.dropped_assignments += routed - int(all_counts[:, 1].sum())
+
+        tokens = x.new_empty(sum(recv_splits), x.shape[-1])
+        dist.all_to_all_single(tokens, x[order // top_k], recv_splits, send_splits, group=self.group)
+        # received rows are ordered by source rank, then expert; the local experts need them grouped by expert
+        recv_expert_indices = torch.arange(self.num_local_experts).repeat(world_size).repeat_interleave(
+            recv_per_expert.flatten()
+        )
+        grouping = recv_expert_indices.argsort(stable=True).to(x.device)
+        return ExpertDispatch(
+            tokens = tokens[grouping],
+            tokens_per_local_expert = recv_per_expert.sum(0).tolist(),
+            order = order,
+            grouping = grouping,
+            send_splits = send_splits,
+            recv_splits = recv_splits,
+        )
+
+    def combine(
+        self,
+        dispatch: ExpertDispatch,
+        expert_out: torch.Tensor,
+        x: torch.Tensor,
+        flat_expert_weights: torch.Tensor,
+        top_k: int,
+    ) -> torch.Tensor:
+        out = torch.empty_like(expert_out)
+        out[dispatch.grouping] = expert_out
+        returned = out.new_empty(dispatch.order.numel(), out.shape[-1])
+        dist.all_to_all_single(returned, out, dispatch.send_splits, dispatch.recv_splits, group=self.group)
+        returned = returned * flat_expert_weights[dispatch.order]
+        expert_cache = torch.zeros_like(x, dtype=returned.dtype)
+        expert_cache.index_add_(0, dispatch.order // top_k, returned)
+        return expert_cache
+
+    @torch.no_grad()
+    def restore(self):
+        """Moves every expert back to the device of its layer and detaches from the layers."""
+        for layer, device in zip(self.layers, self.devices):
+            layer.experts.to(device)
+            layer.expert_parallel = None
+            layer._stacked_expert_weights = None
@@ -2,9 +2,13 @@ import math
 import torch
 from torch import nn
 import torch.nn.functional as F
-from .attention import FeedForwardSwiGLU
+from .attention import FeedForwardSwiGLU, apply_in_chunks, max_chunk_rows
 from torch.distributed.nn.functional import all_gather
 
+_GROUPED_MM_AVAILABLE = hasattr(torch, "_grouped_mm")
+# (device type, dtype, expert weight shapes) the grouped kernel rejected, so it is not retried on every call
+_GROUPED_MM_UNSUPPORTED = set()
+
 _LOAD_BALANCING_LOSS = []
 def save_load_balancing_loss(loss):
     global _LOAD_BALANCING_LOSS
@@ -30,6 +34,29 @@ def batched_load_balancing_loss():
     aux_loss = (Pi * fi).sum(-1).mean() * alpha
     return aux_loss
 
+def _grouped_mm_key(x, w13, w2):
+    return (x.device.type, x.dtype, tuple(w13.shape), tuple(w2.shape))
+
+def grouped_swiglu(x, w13, w2, offsets):
+    """
+    SwiGLU experts over rows of `x` sorted by expert: `w13` is (E, 2 * hidden, dim), `w2` is (E, dim, hidden) and
+    `offsets` are the device-side end offsets of every expert's rows. Returns None if the grouped kernel cannot run
+    them, the caller then runs the experts one by one.
+    """
+    key = _grouped_mm_key(x, w13, w2)
+    if not _GROUPED_MM_AVAILABLE or key in _GROUPED_MM_UNSUPPORTED:
+        return None
+    try:
+        offs = offsets.to(torch.int32)
+        h1, h3 = torch._grouped_mm(x, w13.transpose(-2, -1), offs=offs).chunk(2, dim=-1)
+        return torch._grouped_mm(F.silu(h1) * h3, w2.transpose(-2, -1), offs=offs)
+    except torch.cuda.OutOfMemoryError:
+        raise
+    except RuntimeError:
+        # unsupported device, dtype or alignment for the grouped kernel
+        _GROUPED_MM_UNSUPPORTED.add(key)
+        return None
+
 # Modified from https://github.com/deepseek-ai/DeepSeek-V3/blob/main/inference/model.py
 class MoEGate(nn.Module):
     def __init__(self, embed_dim, num_routed_experts=4, num_activated_experts=2, aux_loss_alpha=0.01):
@@ -111,8 +138,30 @@ class MOEFeedForwardSwiGLU(nn.Module):
             num_activated_experts = num_activated_experts
         )
         self.num_activated_experts = num_activated_experts
+        # "loop" runs the experts one by one, "grouped" runs all of them on stacked weights without host syncs
+        self.moe_impl = "loop"
+        self._stacked_expert_weights = None
+        # set by `offload.ExpertOffloader` when the routed experts live in host memory
+        self.expert_offload = None
+        # set by `expert_parallel.ExpertParallel` when the routed experts are split across ranks
+        self.expert_parallel = None
+        self.moe_layer_id = None
+        # byte budget of the routing and expert activations, see `HiDreamImageTransformer2DModel.set_ffn_memory_budget`
+        self.max_chunk_bytes = None
 
     def forward(self, x):
+        # tokens are routed independently, so chunks of tokens give the same result as the full sequence; offloaded
+        # and expert-parallel layers only chunk inside the experts, since every call fetches experts or communicates
+        if not self.training and self.expert_offload is None and self.expert_parallel is None:
+            # per token: its top-k gathered copies and expert activations, plus its row of the output
+            hidden_dim = self.experts[0].hidden_dim
+            row_bytes = (self.num_activated_experts * (x.shape[-1] + 3 * hidden_dim) + x.shape[-1]) * x.element_size()
+            max_rows = max_chunk_rows(self.max_chunk_bytes, row_bytes, x.numel() // x.shape[-1])
+            if max_rows is not None:
+                return apply_in_chunks(self._forward, x, max_rows)
+        return self._forward(x)
+
+    def _forward(self, x):
         wtype = x.dtype
         identity = x
         orig_shape = x.shape
@@ -127,6 +176,12 @@ class MOEFeedForwardSwiGLU(nn.Module):
             y = (y.view(*topk_weight.shape, -1) * topk_weight.unsqueeze(-1)).sum(dim=1)
             y =  y.view(*orig_shape).to(dtype=wtype)
             #y = AddAuxiliaryLoss.apply(y, aux_loss)
+        elif self.expert_parallel is not None:
+            y = self.moe_infer_parallel(x, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
+        elif self.expert_offload is not None:
+            y = self.moe_infer_offloaded(x, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
+        elif self.moe_impl == "grouped" and self.experts_stackable:
+            y = self.moe_infer_grouped(x, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
         else:
             y = self.moe_infer(x, flat_topk_idx, topk_weight.view(-1, 1)).view(*orig_shape)
         y = y + self.shared_experts(identity)
@@ -150,5 +205,119 @@ class MOEFeedForwardSwiGLU(nn.Module):
             
             # for fp16 and other dtype
             expert_cache = expert_cache.to(expert_out.dtype)
-            expert_cache.scatter_reduce_(0, exp_token_idx.view(-1, 1).repeat(1, x.shape[-1]), expert_out, reduce='sum')
+            # unlike scatter_reduce_, index_add_ needs no (tokens, dim) index tensor
+            expert_cache.index_add_(0, exp_token_idx, expert_out)
+        return expert_cache
+
+    @torch.no_grad()
+    def moe_infer_offloaded(self, x, flat_expert_indices, flat_expert_weights):
+        offload, layer_id = self.expert_offload, self.moe_layer_id
+        tokens_per_expert = flat_expert_indices.bincount(minlength=len(self.experts)).cpu()
+        active_experts = tokens_per_expert.nonzero().flatten().tolist()
+        offload.record_routing(layer_id, tokens_per_expert)
+        # copies of the selected experts are queued first, the likely experts of the next layer behind them
+        for i in active_experts:
+            offload.fetch(layer_id, i)
+        offload.prefetch(layer_id + 1)
+
+        expert_cache = torch.zeros_like(x)
+        idxs = flat_expert_indices.argsort()
+        token_idxs = idxs // self.num_activated_experts
+        end_idxs = tokens_per_expert.cumsum(0).tolist()
+        for i in active_experts:
+            start_idx, end_idx = end_idxs[i] - int(tokens_per_expert[i]), end_idxs[i]
+            offload.ensure(layer_id, i)
+            exp_token_idx = token_idxs[start_idx:end_idx]
+            expert_out = self.experts[i](x[exp_token_idx])
+            expert_out.mul_(flat_expert_weights[idxs[start_idx:end_idx]])
+            expert_cache = expert_cache.to(expert_out.dtype)
+            expert_cache.index_add_(0, exp_token_idx, expert_out)
+            offload.release(layer_id, i)
+        return expert_cache
+
+    @torch.no_grad()
+    def moe_infer_parallel(self, x, flat_expert_indices, flat_expert_weights):
+        parallel = self.expert_parallel
+        dispatch = parallel.dispatch(self.moe_layer_id, x, flat_expert_indices, self.num_activated_experts)
+        expert_out = torch.empty_like(dispatch.tokens)
+        start_idx = 0
+        for i, num_tokens in zip(parallel.local_experts, dispatch.tokens_per_local_expert):
+            end_idx = start_idx + num_tokens
+            if num_tokens > 0:
+                expert_out[start_idx:end_idx] = self.experts[i](dispatch.tokens[start_idx:end_idx])
+            start_idx = end_idx
+        return parallel.combine(dispatch, expert_out, x, flat_expert_weights, self.num_activated_experts)
+
+    @property
+    def experts_stackable(self) -> bool:
+        # quantized experts have no floating point weights to stack and run through the loop path
+        expert = self.experts[0]
+        return isinstance(expert.w2, nn.Linear)
+
+    def stacked_expert_weights(self):
+        """
+        Returns the routed expert weights stacked as (E, 2 * hidden, dim) for w1|w3 and (E, dim, hidden) for w2. The
+        experts' own Linear weights are re-pointed to views of the stacked tensors, so no extra memory is used; the
+        stack is rebuilt whenever that aliasing was broken, e.g. by `.to()` or loading a state dict.
+        """
+        stacked = self._stacked_expert_weights
+        if stacked is not None and torch.compiler.is_compiling():
+            # built eagerly before compiling, see `prepare_forward_static`
+            return stacked
+        if stacked is not None and all(
+            ptr == view.data_ptr() for ptr, view in zip(self._expert_weight_ptrs(), self._expert_weight_views(*stacked))
+        ):
+            return stacked
+
+        w13 = torch.stack([
+            expert.w13.weight.data if expert.fused_projections
+            else torch.cat([expert.w1.weight.data, expert.w3.weight.data], dim=0)
+            for expert in self.experts
+        ])
+        w2 = torch.stack([expert.w2.weight.data for expert in self.experts])
+        views = iter(self._expert_weight_views(w13, w2))
+        for expert in self.experts:
+            linears = [expert.w13, expert.w2] if expert.fused_projections else [expert.w1, expert.w3, expert.w2]
+            for linear in linears:
+                linear.weight.data = next(views)
+        self._stacked_expert_weights = (w13, w2)
+        return self._stacked_expert_weights
+
+    def _expert_weight_ptrs(self):
+        for expert in self.experts:
+            linears = [expert.w13, expert.w2] if expert.fused_projections else [expert.w1, expert.w3, expert.w2]
+            for linear in linears:
+                yield linear.weight.data_ptr()
+
+    def _expert_weight_views(self, w13, w2):
+        views = []
+        hidden_dim = w2.shape[-1]
+        for i, expert in enumerate(self.experts):
+            if expert.fused_projections:
+                views += [w13[i], w2[i]]
+            else:
+                views += [w13[i, :hidden_dim], w13[i, hidden_dim:], w2[i]]
+        return views
+
+    @torch.no_grad()
+    def moe_infer_grouped(self, x, flat_expert_indices, flat_expert_weights):
+        w13, w2 = self.stacked_expert_weights()
+        if not _GROUPED_MM_AVAILABLE or _grouped_mm_key(x, w13, w2) in _GROUPED_MM_UNSUPPORTED:
+            return self.moe_infer(x, flat_expert_indices, flat_expert_weights)
+        num_experts = w13.shape[0]
+        idxs = flat_expert_indices.argsort()
+        token_idxs = idxs // self.num_activated_experts
+        # bincount would sync to size its output, a fixed-size index_add does not
+        tokens_per_expert = torch.zeros(num_experts, dtype=torch.int64, device=x.device)
+        tokens_per_expert.index_add_(0, flat_expert_indices, torch.ones_like(flat_expert_indices))
+        offsets = tokens_per_expert.cumsum(0)
+
+        expert_tokens = x[token_idxs]
+        expert_out = grouped_swiglu(expert_tokens, w13, w2, offsets)
+        if expert_out is None:
+            return self.moe_infer(x, flat_expert_indices, flat_expert_weights)
+        expert_out = expert_out * flat_expert_weights[idxs]
+
+        expert_cache = torch.zeros_like(x, dtype=expert_out.dtype)
+        expert_cache.index_add_(0, token_idxs, expert_out)
         return expert_cache
@@ -0,0 +1,355 @@
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+import torch
+from torch import nn
+
+def _module_tensors(module: nn.Module) -> Iterator[Tuple[str, nn.Module, str, torch.Tensor]]:
+    # parameters and buffers of `module` as (qualified name, owner, local name, tensor)
+    for prefix, owner in module.named_modules():
+        for name, tensor in [*owner._parameters.items(), *owner._buffers.items()]:
+            if tensor is not None:
+                yield f"{prefix}.{name}" if prefix else name, owner, name, tensor
+
+def _set_module_tensor(owner: nn.Module, name: str, tensor: torch.Tensor):
+    if name in owner._parameters:
+        owner._parameters[name].data = tensor
+    else:
+        owner._buffers[name] = tensor
+
+class ExpertOffloader:
+    """
+    Keeps the routed experts of MoE layers in (pinned) host memory and at most `max_device_experts` of them in
+    device slots. Every layer copies the experts its gate selected and, behind them, the experts of the next layer
+    that its routing statistics make likely, so the copies overlap with computation. Slots are reused least recently
+    used first; experts of the running layer are locked until they have been applied.
+    """
+
+    def __init__(
+        self,
+        moe_layers: List[nn.Module],
+        device: torch.device,
+        max_device_experts: int,
+        prefetch_experts: Optional[int] = None,
+        stats_momentum: float = 0.9,
+    ):
+        if max_device_experts < 1:
+            raise ValueError(f"`max_device_experts` has to be at least 1 but is {max_device_experts}")
+        self.layers = list(moe_layers)
+        self.device = torch.device(device)
+        self.prefetch_experts = prefetch_experts
+        self.stats_momentum = stats_momentum
+        self.copy_stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        pin_memory = torch.cuda.is_available()
+
+        self.host: Dict[Tuple[int, int], Dict[str, torch.Tensor]] = {}
+        for layer_id, layer in enumerate(self.layers):
+            for expert_id, expert in enumerate(layer.experts):
+                host = {}
+                for name, owner, local_name, tensor in _module_tensors(expert):
+                    host[name] = tensor.detach().to("cpu", copy=True)
+                    if pin_memory:
+                        host[name] = host[name].pin_memory()
+                    _set_module_tensor(owner, local_name, tensor.new_empty(0, device=self.device))
+                self.host[(layer_id, expert_id)] = host
+            layer.expert_offload = self
+            layer.moe_layer_id = layer_id
+            layer._stacked_expert_weights = None
+
+        template = self.host[(0, 0)]
+        self.slots = [
+            {name: torch.empty_like(tensor, device=self.device) for name, tensor in template.items()}
+            for _ in range(max_device_experts)
+        ]
+        self.free_slots = list(range(max_device_experts))
+        self.resident: "OrderedDict[Tuple[int, int], int]" = OrderedDict()
+        self.events = {}
+        self.locked = set()
+        self.prefetched = set()
+        self.routing_stats = [torch.zeros(len(layer.experts)) for layer in self.layers]
+        self.stats = {"hits": 0, "misses": 0, "prefetched": 0, "prefetch_hits": 0, "bytes_copied": 0}
+
+    @property
+    def expert_nbytes(self) -> int:
+        return sum(tensor.numel() * tensor.element_size() for tensor in self.host[(0, 0)].values())
+
+    def _expert(self, key: Tuple[int, int]) -> nn.Module:
+        return self.layers[key[0]].experts[key[1]]
+
+    def _acquire_slot(self) -> Optional[int]:
+        if self.free_slots:
+            return self.free_slots.pop()
+        for key in self.resident:
+            if key not in self.locked:
+                slot = self.resident.pop(key)
+                self.events.pop(key, None)
+                self.prefetched.discard(key)
+                for name, owner, local_name, tensor in _module_tensors(self._expert(key)):
+                    _set_module_tensor(owner, local_name, tensor.new_empty(0))
+                return slot
+        return None
+
+    def fetch(self, layer_id: int, expert_id: int, lock: bool = True, prefetch: bool = False) -> bool:
+        """Makes an expert resident, copying it asynchronously if needed. Returns False if no slot is free."""
+        key = (layer_id, expert_id)
+        if key in self.resident:
+            self.resident.move_to_end(key)
+            if not prefetch:
+                self.stats["hits"] += 1
+                if key in self.prefetched:
+                    self.stats["prefetch_hits"] += 1
+                    self.prefetched.discard(key)
+        else:
+            slot_id = self._acquire_slot()
+            if slot_id is None:
+                return False
+            slot, host = self.slots[slot_id], self.host[key]
+            if self.copy_stream is not None:
+                # the slot may still be read by kernels queued on the compute stream
+                self.copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+                with torch.cuda.stream(self.copy_stream):
+                    for name, tensor in host.items():
+                        slot[name].copy_(tensor, non_blocking=True)
+                    self.events[key] = torch.cuda.Event()
+                    self.events[key].record(self.copy_stream)
+            else:
+                for name, tensor in host.items():
+                    slot[name].copy_(tensor)
+            for name, owner, local_name, _ in _module_tensors(self._expert(key)):
+                _set_module_tensor(owner, local_name, slot[name])
+            self.resident[key] = slot_id
+            self.stats["bytes_copied"] += self.expert_nbytes
+            if prefetch:
+                self.stats["prefetched"] += 1
+                self.prefetched.add(key)
+            else:
+                self.stats["misses"] += 1
+        if lock:
+            self.locked.add(key)
+        return True
+
+    def ensure(self, layer_id: int, expert_id: int):
+        """Fetches and locks an expert if needed and makes the compute stream wait for its copy."""
+        key = (layer_id, expert_id)
+        if key not in self.resident or key not in self.locked:
+            if not self.fetch(layer_id, expert_id, lock=True):
+                raise RuntimeError("All expert slots are locked, increase `max_device_experts`")
+        event = self.events.pop(key, None)
+        if event is not None:
+            torch.cuda.current_stream(self.device).wait_event(event)
+
+    def release(self, layer_id: int, expert_id: int):
+        self.locked.discard((layer_id, expert_id))
+
+    def record_routing(self, layer_id: int, tokens_per_expert: torch.Tensor):
+        frequencies = tokens_per_expert.float() / tokens_per_expert.sum().clamp_min(1)
+        self.routing_stats[layer_id].mul_(self.stats_momentum).add_(frequencies, alpha=1 - self.stats_momentum)
+
+    def prefetch(self, layer_id: int):
+        """Copies the most frequently selected experts of `layer_id` (the first layer after the last) ahead of use."""
+        layer_id = layer_id % len(self.layers)
+        layer = self.layers[layer_id]
+        num_experts = self.prefetch_experts if self.prefetch_experts is not None else layer.num_activated_experts
+        for expert_id in self.routing_stats[layer_id].argsort(descending=True)[:num_experts].tolist():
+            if not self.fetch(layer_id, expert_id, lock=False, prefetch=True):
+                break
+
+    @torch.no_grad()
+    def restore(self):
+        """Moves every expert back to the device and detaches the offloader from its layers."""
+        for key, host in self.host.items():
+            expert = self._expert(key)
+            for name, owner, local_name, _ in _module_tensors(expert):
+                _set_module_tensor(owner, local_name, host[name].to(self.device))
+        for layer in self.layers:
+            layer.expert_offload = None
+        self.slots, self.resident, self.events = [], OrderedDict(), {}
+
+def _set_stacked_expert_weight(layer: nn.Module, index: int, tensor: torch.Tensor):
+    stacked = list(layer._stacked_expert_weights)
+    stacked[index] = tensor
+    layer._stacked_expert_weights = tuple(stacked)
+
+class BlockStreamer:
+    """
+    Streams transformer blocks from (pinned) host memory through two device slots per block layout. A forward
+    pre-hook on every block waits for its own copy and queues the copy of the next block (wrapping around to the
+    first block of the next step) on a side stream, so block N+1 is transferred while block N computes. Tensors are
+    copied per storage, which keeps views such as the stacked MoE expert weights aliased on the device. Submodules
+    named in `resident_modules` stay on the device.
+    """
+
+    def __init__(self, blocks: List[nn.Module], device: torch.device, resident_modules=("adaLN_modulation",)):
+        self.blocks = list(blocks)
+        self.device = torch.device(device)
+        self.resident_modules = set(resident_modules)
+        self.copy_stream = torch.cuda.Stream(self.device) if self.device.type == "cuda" else None
+        pin_memory = torch.cuda.is_available()
+
+        # per block: host byte buffers of the used span of every storage, and the tensors as views into them
+        self.host: List[List[torch.Tensor]] = []
+        self.views: List[list] = []
+        self.slot_ids: List[Tuple[Tuple[int, ...], int]] = []
+        layout_counts = {}
+        for block in self.blocks:
+            host, views = self._host_views(block, pin_memory)
+            self.host.append(host)
+            self.views.append(views)
+            self._unbind(len(self.views) - 1)
+            # consecutive blocks of a layout alternate between the two slots of that layout
+            layout = tuple(buffer.numel() for buffer in host)
+            self.slot_ids.append((layout, layout_counts.get(layout, 0) % 2))
+            layout_counts[layout] = layout_counts.get(layout, 0) + 1
+
+        self.slots = {}
+        for index, slot_id in enumerate(self.slot_ids):
+            if slot_id not in self.slots:
+                self.slots[slot_id] = [torch.empty_like(buffer, device=self.device) for buffer in self.host[index]]
+        self.slot_owner = {}
+        self.ready_events = {}
+        self.running = None
+        self.hooks = [
+            block.register_forward_pre_hook(self._make_hook(index)) for index, block in enumerate(self.blocks)
+        ]
+        self.reset_stats()
+
+    def _host_views(self, block: nn.Module, pin_memory: bool):
+        stacked = []
+        for module in block.modules():
+            # the grouped MoE path reads the expert weights through the stack they are views of
+            if getattr(module, "experts_stackable", False) and hasattr(module, "stacked_expert_weights"):
+                stacked += [
+                    (module, index, _set_stacked_expert_weight, tensor)
+                    for index, tensor in enumerate(module.stacked_expert_weights())
+                ]
+        entries = [
+            (owner, local_name, _set_module_tensor, tensor)
+            for name, owner, local_name, tensor in _module_tensors(block)
+            if not self.resident_modules.intersection(name.split("."))
+        ] + stacked
+
+        spans = {}
+        for *_, tensor in entries:
+            start = tensor.storage_offset() * tensor.element_size()
+            extent = 1 + sum((size - 1) * stride for size, stride in zip(tensor.shape, tensor.stride()))
+            end = start + extent * tensor.element_size() if tensor.numel() > 0 else start
+            key = tensor.untyped_storage().data_ptr()
+            span = spans.get(key, (start, end, tensor.untyped_storage()))
+            spans[key] = (min(span[0], start) // 64 * 64, max(span[1], end), span[2])
+
+        keys = list(spans)
+        host = []
+        for key in keys:
+            start, end, storage = spans[key]
+            buffer = torch.empty(0, dtype=torch.uint8).set_(storage, start, (end - start,), (1,)).to("cpu", copy=True)
+            host.append(buffer.pin_memory() if pin_memory else buffer)
+        views = []
+        for owner, local_name, setter, tensor in entries:
+            key = tensor.untyped_storage().data_ptr()
+            offset = tensor.storage_offset() - spans[key][0] // tensor.element_size()
+            views.append(
+                (owner, local_name, setter, keys.index(key), offset, tuple(tensor.shape), tensor.stride(), tensor.dtype)
+            )
+        return host, views
+
+    def _bind(self, index: int, buffers: List[torch.Tensor]):
+        for owner, local_name, setter, buffer_id, offset, size, stride, dtype in self.views[index]:
+            tensor = torch.empty(0, dtype=dtype, device=self.device)
+            setter(owner, local_name, tensor.set_(buffers[buffer_id].untyped_storage(), offset, size, stride))
+
+    def _unbind(self, index: int):
+        for owner, local_name, setter, *_, dtype in self.views[index]:
+            setter(owner, local_name, torch.empty(0, dtype=dtype, device=self.device))
+
+    def reset_stats(self):
+        self.blocks_copied = 0
+        self.bytes_copied = 0
+        self.copy_time = 0.0
+        self.stall_time = 0.0
+        self._copy_events = []
+        self._stall_events = []
+
+    def _make_hook(self, index: int):
+        def hook(module, args):
+            self.load(index)
+            self.running = index
+            self.prefetch((index + 1) % len(self.blocks))
+        return hook
+
+    def _copy(self, index: int):
+        slot_id = self.slot_ids[index]
+        slot, host = self.slots[slot_id], self.host[index]
+        previous = self.slot_owner.get(slot_id)
+        if previous is not None:
+            self._unbind(previous)
+            self.ready_events.pop(previous, None)
+        if self.copy_stream is not None:
+            # the slot is still read by the kernels of the previous block on the compute stream
+            self.copy_stream.wait_stream(torch.cuda.current_stream(self.device))
+            with torch.cuda.stream(self.copy_stream):
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record(self.copy_stream)
+                for target, buffer in zip(slot, host):
+                    target.copy_(buffer, non_blocking=True)
+                end.record(self.copy_stream)
+            self._copy_events.append((start, end))
+            self.ready_events[index] = end
+        else:
+            start = time.perf_counter()
+            for target, buffer in zip(slot, host):
+                target.copy_(buffer)
+            self.copy_time += time.perf_counter() - start
+        self._bind(index, slot)
+        self.slot_owner[slot_id] = index
+        self.blocks_copied += 1
+        self.bytes_copied += sum(buffer.numel() for buffer in host)
+
+    def load(self, index: int):
+        """Makes block `index` resident and the compute stream wait for its copy."""
+        if self.slot_owner.get(self.slot_ids[index]) != index:
+            self._copy(index)
+        event = self.ready_events.pop(index, None)
+        if event is not None:
+            stream = torch.cuda.current_stream(self.device)
+            before, after = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+            before.record(stream)
+            stream.wait_event(event)
+            after.record(stream)
+            self._stall_events.append((before, after))
+
+    def prefetch(self, index: int):
+        owner = self.slot_owner.get(self.slot_ids[index])
+        # with an odd number of blocks of a layout, the next block can map to the slot of the running one
+        if owner is None or owner not in (index, self.running):
+            self._copy(index)
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Transfer statistics since the last `reset_stats`; `overlap` is the fraction of the copy time hidden behind
+        computation, i.e. not spent by the compute stream waiting for copies. Synchronizes the device.
+        """
+        if self.copy_stream is not None:
+            torch.cuda.synchronize(self.device)
+            self.copy_time += sum(start.elapsed_time(end) for start, end in self._copy_events) / 1000
+            self.stall_time += sum(before.elapsed_time(after) for before, after in self._stall_events) / 1000
+            self._copy_events, self._stall_events = [], []
+        else:
+            # without a copy stream every copy blocks the computation
+            self.stall_time = self.copy_time
+        return {
+            "blocks_copied": self.blocks_copied,
+            "bytes_copied": self.bytes_copied,
+            "copy_time": self.copy_time,
+            "stall_time": self.stall_time,
+            "bandwidth_gbps": self.bytes_copied / self.copy_time / 1e9 if self.copy_time > 0 else 0.0,
+            "overlap": 1.0 - self.stall_time / self.copy_time if self.copy_time > 0 else 0.0,
+        }
+
+    @torch.no_grad()
+    def restore(self):
+        """Moves every block back to the device and removes the hooks."""
+        for hook in self.hooks:
+            hook.remove()
+        for index, host in enumerate(self.host):
+            self._bind(index, [buffer.to(self.device) for buffer in host])
+        self.slots, self.slot_owner, self.ready_events = {}, {}, {}
@@ -0,0 +1,222 @@
+import itertools
+import math
+from typing import List, Optional, Sequence, Tuple
+import torch
+import torch.distributed as dist
+from torch import nn
+
+def balanced_stage_starts(blocks: Sequence[nn.Module], num_stages: int) -> List[int]:
+    """First block index of every stage after the first, splitting `blocks` into stages of similar parameter count."""
+    if not 1 <= num_stages <= len(blocks):
+        raise ValueError(f"Cannot split {len(blocks)} blocks into {num_stages} stages")
+    sizes = [sum(p.numel() for p in block.parameters()) for block in blocks]
+    cumulative = list(itertools.accumulate(sizes))
+    starts = []
+    for stage in range(1, num_stages):
+        target = cumulative[-1] * stage / num_stages
+        start = min(range(1, len(blocks)), key=lambda i: abs(cumulative[i - 1] - target))
+        start = max(start, starts[-1] + 1 if starts else 1)
+        starts.append(min(start, len(blocks) - (num_stages - stage)))
+    return starts
+
+class PipelineParallel:
+    """
+    Pipeline parallelism of the block stack: contiguous ranges of the double- and single-stream blocks form stages
+    on different devices of this process (`devices`) or on the ranks of a process group (one stage per rank). The
+    batch is split into `num_micro_batches` micro-batches that flow through the stages, so stage k works on
+    micro-batch i while stage k + 1 works on micro-batch i - 1. Between stages only the block-stack state moves:
+    the image tokens followed by the initial text tokens.
+
+    With `devices`, one Python loop runs every micro-batch through every stage in turn, so the stages do not overlap
+    (the host syncs of the loop MoE serialize them further): this mode splits the weights and activations across
+    devices to save memory, not time. The micro-batches only overlap with a process group.
+
+    The embedders, caption projections, adaLN modulations and the final layer stay on the model's device and are
+    run by every rank; with a process group every rank has to run the same requests with the same inputs and ends
+    with the full output. Blocks of the stages of other ranks are moved to `offload_device`.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        devices: Optional[List[torch.device]] = None,
+        stage_starts: Optional[List[int]] = None,
+        num_micro_batches: int = 2,
+        group: Optional[dist.ProcessGroup] = None,
+        offload_device: torch.device = "cpu",
+    ):
+        if num_micro_batches < 1:
+            raise ValueError(f"`num_micro_batches` has to be at least 1 but is {num_micro_batches}")
+        self.blocks = [*model.double_stream_blocks, *model.single_stream_blocks]
+        self.num_double_blocks = len(model.double_stream_blocks)
+        self.num_micro_batches = num_micro_batches
+        self.device = model.device
+        self.group = group
+
+        if devices is not None:
+            num_stages = len(devices)
+            self.stage_devices = [torch.device(device) for device in devices]
+            self.stage_ranks = None
+            self.local_stages = set(range(num_stages))
+        else:
+            if not dist.is_initialized():
+                raise RuntimeError("Pipeline parallelism over processes needs an initialized default process group")
+            num_stages = dist.get_world_size(group)
+            rank = dist.get_rank(group)
+            self.stage_ranks = [dist.get_global_rank(group, r) if group is not None else r for r in range(num_stages)]
+            self.stage_devices = [self.device if stage == rank else torch.device(offload_device) for stage in range(num_stages)]
+            self.local_stages = {rank}
+
+        stage_starts = stage_starts if stage_starts is not None else balanced_stage_starts(self.blocks, num_stages)
+        if len(stage_starts) != num_stages - 1 or sorted(set(stage_starts)) != list(stage_starts):
+            raise ValueError(f"Invalid stage starts {stage_starts} for {num_stages} stages")
+        bounds = [0, *stage_starts, len(self.blocks)]
+        self.stages: List[Tuple[int, int]] = list(zip(bounds[:-1], bounds[1:]))
+        for (start, end), device in zip(self.stages, self.stage_devices):
+            for block in self.blocks[start:end]:
+                self._move_block(block, device)
+
+    def _move_block(self, block: nn.Module, device: torch.device):
+        # the adaLN modulations stay with the stacked adaLN weights on the model's device
+        for name, module in block.block.named_children():
+            if name != "adaLN_modulation":
+                module.to(device)
+
+    def restore(self):
+        for block in self.blocks:
+            self._move_block(block, self.device)
+
+    def _peer(self, stage: int) -> int:
+        return self.stage_ranks[stage]
+
+    def _block_modulations(self, model, adaln_input, step_conditioning):
+        if step_conditioning is not None:
+            return list(step_conditioning.block_modulations)
+        if model.adaln_fused:
+            weight, bias, split_sizes = model.stacked_adaln_weights()
+            return list(torch.nn.functional.linear(torch.nn.functional.silu(adaln_input), weight, bias).split(split_sizes, dim=-1))
+        return [block.block.adaLN_modulation(adaln_input) for block in self.blocks]
+
+    def _run_stage(self, stage, state, image_seq_len, micro_batch, context):
+        start, end = self.stages[stage]
+        device = self.stage_devices[stage]
+        adaln_input, rope, image_tokens_masks, text_tokens_masks, encoder_hidden_states, block_modulations = (
+            x.to(device, non_blocking=True) if torch.is_tensor(x) else x for x in context
+        )
+        state = state.to(device, non_blocking=True)
+
+        if start < self.num_double_blocks:
+            hidden_states, initial_encoder_hidden_states = state[:, :image_seq_len], state[:, image_seq_len:]
+            initial_seq_len = initial_encoder_hidden_states.shape[1]
+            for block_id in range(start, min(end, self.num_double_blocks)):
+                cur_encoder_hidden_states = torch.cat(
+                    [initial_encoder_hidden_states, encoder_hidden_states[block_id][micro_batch].to(device)], dim=1
+                )
+                hidden_states, initial_encoder_hidden_states = self.blocks[block_id](
+                    image_tokens = hidden_states,
+                    image_tokens_masks = image_tokens_masks,
+                    text_tokens = cur_encoder_hidden_states,
+                    adaln_input = adaln_input,
+                    rope = rope,
+                    modulation = block_modulations[block_id][micro_batch].to(device),
+                    text_tokens_masks = text_tokens_masks,
+                )
+                initial_encoder_hidden_states = initial_encoder_hidden_states[:, :initial_seq_len]
+            state = torch.cat([hidden_states, initial_encoder_hidden_states], dim=1)
+
+        state_seq_len = state.shape[1]
+        for block_id in range(max(start, self.num_double_blocks), end):
+            llama_tokens = encoder_hidden_states[block_id][micro_batch].to(device)
+            masks = image_tokens_masks
+            if masks is not None:
+                masks = torch.cat([masks, masks.new_ones(masks.shape[0], state_seq_len - image_seq_len + llama_tokens.shape[1])], dim=1)
+            state = self.blocks[block_id](
+                image_tokens = torch.cat([state, llama_tokens], dim=1),
+                image_tokens_masks = masks,
+                adaln_input = adaln_input,
+                rope = rope,
+                modulation = block_modulations[block_id][micro_batch].to(device),
+                text_tokens_masks = text_tokens_masks,
+            )[:, :state_seq_len]
+        return state
+
+    @torch.no_grad()
+    def forward(
+        self,
+        model,
+        hidden_states: torch.Tensor,
+        timesteps: Optional[torch.Tensor] = None,
+        encoder_hidden_states: Optional[List[torch.Tensor]] = None,
+        pooled_embeds: Optional[torch.Tensor] = None,
+        img_sizes: Optional[List[Tuple[int, int]]] = None,
+        img_ids: Optional[torch.Tensor] = None,
+        text_conditioning=None,
+        step_conditioning=None,
+    ) -> Tuple[torch.Tensor, Optional[torch.Tensor]]:
+        batch_size = hidden_states.shape[0]
+        dtype, device = hidden_states.dtype, hidden_states.device
+        if step_conditioning is not None:
+            adaln_input = step_conditioning.adaln_input
+        else:
+            timesteps = model.expand_timesteps(timesteps, batch_size, device)
+            adaln_input = model.t_embedder(timesteps, dtype) + model.p_embedder(pooled_embeds)
+        block_modulations = self._block_modulations(model, adaln_input, step_conditioning)
+        final_modulation = step_conditioning.final_modulation if step_conditioning is not None else None
+
+        hidden_states, image_tokens_masks, img_sizes = model.patchify(hidden_states, model.max_seq, img_sizes)
+        hidden_states = model.x_embedder(hidden_states)
+        if text_conditioning is None:
+            text_conditioning = model.prepare_text_conditioning(encoder_hidden_states)
+        image_seq_len = hidden_states.shape[1]
+        if img_ids is None:
+            rope = model.pe_embedder.get_rope(img_sizes, image_seq_len, text_conditioning.txt_ids.shape[1], device)
+        else:
+            rope = model.pe_embedder(torch.cat((img_ids, text_conditioning.txt_ids.to(img_ids.dtype)), dim=1))
+        state = torch.cat([hidden_states, text_conditioning.initial_encoder_hidden_states], dim=1)
+        text_tokens_masks = text_conditioning.text_tokens_masks
+
+        micro_batch_size = math.ceil(batch_size / self.num_micro_batches)
+        micro_batches = [slice(i, i + micro_batch_size) for i in range(0, batch_size, micro_batch_size)]
+        last_stage = len(self.stages) - 1
+        outputs, sends = [], []
+        for micro_batch in micro_batches:
+            context = (
+                adaln_input[micro_batch],
+                rope[micro_batch] if rope.shape[0] > 1 else rope,
+                image_tokens_masks[micro_batch] if image_tokens_masks is not None else None,
+                text_tokens_masks[micro_batch] if text_tokens_masks is not None else None,
+                text_conditioning.encoder_hidden_states,
+                block_modulations,
+            )
+            micro_state = state[micro_batch]
+            for stage in range(len(self.stages)):
+                if stage not in self.local_stages:
+                    continue
+                if stage > 0 and stage - 1 not in self.local_stages:
+                    micro_state = torch.empty_like(micro_state, device=self.stage_devices[stage])
+                    dist.irecv(micro_state, self._peer(stage - 1), group=self.group).wait()
+                micro_state = self._run_stage(stage, micro_state, image_seq_len, micro_batch, context)
+                if stage == last_stage:
+                    outputs.append(model.final_layer(
+                        micro_state[:, :image_seq_len].to(device), adaln_input[micro_batch],
+                        modulation=final_modulation[micro_batch] if final_modulation is not None else None,
+                    ))
+                elif stage + 1 not in self.local_stages:
+                    # the send completes in the background while the next micro-batch runs
+                    micro_state = micro_state.contiguous()
+                    sends.append((micro_state, dist.isend(micro_state, self._peer(stage + 1), group=self.group)))
+
+        if last_stage in self.local_stages:
+            output = torch.cat(outputs, dim=0)
+        else:
+            patch_dim = model.config.patch_size ** 2 * model.out_channels
+            output = hidden_states.new_empty(batch_size, image_seq_len, patch_dim)
+        for _, work in sends:
+            work.wait()
+        if self.stage_ranks is not None:
+            dist.broadcast(output, self._peer(last_stage), group=self.group)
+
+        output = model.unpatchify(output, img_sizes, False)
+        if image_tokens_masks is not None:
+            image_tokens_masks = image_tokens_masks[:, :image_seq_len]
+        return output, image_tokens_masks
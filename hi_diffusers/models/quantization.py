@@ -0,0 +1,139 @@
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, Optional, Tuple
+import torch
+from torch import nn
+import torch.nn.functional as F
+
+@dataclass
+class Int8Kernel:
+    """
+    A weight-only int8 matmul. `func` takes activations (..., in), an int8 weight (out, in), float32 per-output-channel
+    scales (out,) and an optional bias, and returns (..., out) in the activation dtype.
+    """
+    name: str
+    func: Callable
+    is_available: Callable[[torch.Tensor], bool]
+
+INT8_KERNELS: Dict[str, Int8Kernel] = {}
+# order in which the "auto" kernel picks an available implementation; faster kernels are registered in front
+AUTO_INT8_KERNELS = ["int8pack", "reference"]
+_INT8_CONFIG = {"kernel": "auto"}
+
+def int8_linear_reference(x, qweight, scale, bias=None):
+    # the per-channel scale commutes with the matmul, so it is applied to the (smaller) output, in float32
+    out = (F.linear(x, qweight.to(x.dtype)) * scale).to(x.dtype)
+    if bias is not None:
+        out = out + bias.to(x.dtype)
+    return out
+
+def int8_linear_int8pack(x, qweight, scale, bias=None):
+    # the kernel takes its scales in the activation dtype, so it runs unscaled and the float32 scales are applied after
+    unit_scale = torch.ones(qweight.shape[0], dtype=x.dtype, device=x.device)
+    out = torch._weight_int8pack_mm(x.reshape(-1, x.shape[-1]).contiguous(), qweight, unit_scale)
+    out = (out * scale).to(x.dtype).view(*x.shape[:-1], -1)
+    if bias is not None:
+        out = out + bias.to(x.dtype)
+    return out
+
+def register_int8_kernel(name: str, func: Callable, is_available: Optional[Callable[[torch.Tensor], bool]] = None):
+    INT8_KERNELS[name] = Int8Kernel(name = name, func = func, is_available = is_available or (lambda x: True))
+
+register_int8_kernel("reference", int8_linear_reference)
+# the packed CPU/MPS kernel returns garbage for reduced precision inputs whose width is not a multiple of 16
+register_int8_kernel(
+    "int8pack", int8_linear_int8pack,
+    is_available = lambda x: (
+        hasattr(torch, "_weight_int8pack_mm") and x.device.type in ("cpu", "mps") and x.shape[-1] % 16 == 0
+    ),
+)
+
+def set_int8_kernel(kernel: str = "auto"):
+    """Sets the process-wide kernel of every `Int8WeightOnlyLinear`: a registered kernel name or "auto"."""
+    if kernel != "auto" and kernel not in INT8_KERNELS:
+        raise ValueError(f"Unknown int8 kernel {kernel}, available: {list(INT8_KERNELS)} or 'auto'")
+    _INT8_CONFIG["kernel"] = kernel
+
+def get_int8_kernel(x: torch.Tensor) -> Int8Kernel:
+    kernel = _INT8_CONFIG["kernel"]
+    if kernel != "auto":
+        return INT8_KERNELS[kernel]
+    for name in AUTO_INT8_KERNELS:
+        if name in INT8_KERNELS and INT8_KERNELS[name].is_available(x):
+            return INT8_KERNELS[name]
+    return INT8_KERNELS["reference"]
+
+@torch.no_grad()
+def quantize_int8_per_channel(weight: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Symmetric int8 quantization with one float32 scale per output channel (row) of `weight`."""
+    scale = weight.float().abs().amax(dim=1).clamp_min(1e-12) / 127.0
+    qweight = (weight.float() / scale[:, None]).round().clamp(-127, 127).to(torch.int8)
+    return qweight, scale
+
+class Int8WeightOnlyLinear(nn.Module):
+    """Drop-in replacement of `nn.Linear` holding an int8 weight with per-output-channel scales."""
+
+    def __init__(self, in_features: int, out_features: int, bias: bool = True, device=None, dtype=None):
+        super().__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.register_buffer("qweight", torch.empty(out_features, in_features, dtype=torch.int8, device=device))
+        # float32 regardless of `dtype`, bf16 scales would add a systematic error of up to 0.4% per output channel
+        self.register_buffer("weight_scale", torch.empty(out_features, dtype=torch.float32, device=device))
+        if bias:
+            self.bias = nn.Parameter(torch.empty(out_features, dtype=dtype, device=device))
+        else:
+            self.register_parameter("bias", None)
+
+    @classmethod
+    @torch.no_grad()
+    def from_linear(cls, linear: nn.Linear) -> "Int8WeightOnlyLinear":
+        weight = linear.weight
+        module = cls(
+            linear.in_features, linear.out_features, linear.bias is not None, device=weight.device, dtype=weight.dtype
+        )
+        module.qweight, module.weight_scale = quantize_int8_per_channel(weight)
+        if linear.bias is not None:
+            module.bias = linear.bias
+        return module
+
+    def _apply(self, fn, recurse=True):
+        # `.to(dtype)` and `.half()` cast floating point buffers, the scales only follow the device
+        scale = self.weight_scale
+        super()._apply(fn, recurse)
+        if self.weight_scale.dtype != torch.float32:
+            self.weight_scale = scale.to(self.weight_scale.device)
+        return self
+
+    def _load_from_state_dict(self, *args, **kwargs):
+        super()._load_from_state_dict(*args, **kwargs)
+        self.align_weights()
+
+    def align_weights(self):
+        """Copies `qweight` if it is misaligned, as weights mapped from a checkpoint file can be."""
+        if self.qweight.data_ptr() % 64 != 0:
+            # misaligned int8 weights crash the vectorized int8 kernels
+            self.qweight = self.qweight.clone()
+
+    def dequantize(self) -> torch.Tensor:
+        return self.qweight.to(self.weight_scale.dtype) * self.weight_scale[:, None]
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return get_int8_kernel(x).func(x, self.qweight, self.weight_scale, self.bias)
+
+    def extra_repr(self) -> str:
+        return f"in_features={self.in_features}, out_features={self.out_features}, bias={self.bias is not None}"
+
+def replace_linears(
+    model: nn.Module, factory: Callable[[nn.Linear], nn.Module], skip_modules: Iterable[str] = ()
+) -> int:
+    """Replaces every `nn.Linear` of `model` whose qualified name has no component in `skip_modules`."""
+    skip_modules = set(skip_modules)
+    targets = [
+        (name, module) for name, module in model.named_modules()
+        if isinstance(module, nn.Linear) and not skip_modules.intersection(name.split("."))
+    ]
+    for name, linear in targets:
+        parent_name, _, child_name = name.rpartition(".")
+        parent = model.get_submodule(parent_name) if parent_name else model
+        setattr(parent, child_name, factory(linear))
+    return len(targets)
@@ -0,0 +1,123 @@
+from dataclasses import dataclass
+from typing import Optional
+import torch
+import torch.distributed as dist
+
+@dataclass
+class SequenceShard:
+    """
+    Layout of one sequence-parallel forward: every rank holds a contiguous shard of `num_image_tokens` image tokens
+    (ranks in order), followed by all text tokens, which are replicated. `image_tokens_masks` is the unsharded image
+    mask, used when padded keys are excluded from attention.
+    """
+    group: Optional[dist.ProcessGroup]
+    rank: int
+    world_size: int
+    num_image_tokens: int
+    image_tokens_masks: Optional[torch.Tensor] = None
+
+    def shard(self, x: torch.Tensor) -> torch.Tensor:
+        """This rank's shard of the image tokens of (B, S_img, ...) `x`."""
+        start = self.rank * self.num_image_tokens
+        return x[:, start:start + self.num_image_tokens]
+
+    def shard_rope(self, rope: torch.Tensor) -> torch.Tensor:
+        # the rope table covers all image tokens followed by the text tokens
+        num_image_tokens = self.num_image_tokens * self.world_size
+        return torch.cat([self.shard(rope), rope[:, num_image_tokens:]], dim=1)
+
+    def gather(self, x: torch.Tensor) -> torch.Tensor:
+        """Concatenates the image token shards (B, S_img / P, ...) of all ranks."""
+        shards = [torch.empty_like(x) for _ in range(self.world_size)]
+        dist.all_gather(shards, x.contiguous(), group=self.group)
+        return torch.cat(shards, dim=1)
+
+    def image_heads_to_sequence(self, x: torch.Tensor) -> torch.Tensor:
+        # (B, S_img / P, H, D) -> (B, S_img, H / P, D): all image tokens of this rank's heads
+        batch_size, seq_len, heads, head_dim = x.shape
+        x = x.reshape(batch_size, seq_len, self.world_size, heads // self.world_size, head_dim)
+        x = x.permute(2, 0, 1, 3, 4).contiguous()
+        out = torch.empty_like(x)
+        dist.all_to_all_single(out, x, group=self.group)
+        return out.permute(1, 0, 2, 3, 4).reshape(batch_size, self.world_size * seq_len, -1, head_dim)
+
+    def image_sequence_to_heads(self, x: torch.Tensor) -> torch.Tensor:
+        # (B, S_img, H / P, D) -> (B, S_img / P, H, D): all heads of this rank's image tokens
+        batch_size, seq_len, heads, head_dim = x.shape
+        x = x.reshape(batch_size, self.world_size, seq_len // self.world_size, heads, head_dim)
+        x = x.permute(1, 0, 2, 3, 4).contiguous()
+        out = torch.empty_like(x)
+        dist.all_to_all_single(out, x, group=self.group)
+        return out.permute(1, 2, 0, 3, 4).reshape(batch_size, seq_len // self.world_size, -1, head_dim)
+
+    def local_heads(self, x: torch.Tensor) -> torch.Tensor:
+        heads = x.shape[2] // self.world_size
+        return x[:, :, self.rank * heads:(self.rank + 1) * heads]
+
+    def gather_heads(self, x: torch.Tensor) -> torch.Tensor:
+        heads = [torch.empty_like(x) for _ in range(self.world_size)]
+        dist.all_gather(heads, x.contiguous(), group=self.group)
+        return torch.cat(heads, dim=2)
+
+class SequenceParallel:
+    """
+    Ulysses-style sequence parallelism of the transformer over the ranks of a process group. The image tokens are
+    split across ranks and the text tokens replicated; around every attention an all-to-all exchanges image token
+    shards for head shards, so each rank attends over the full sequence with 1/P of the heads. Everything else,
+    including the MoE feed-forwards, is token-local. Every rank runs the same request with the same inputs and ends
+    with the full output.
+    """
+
+    def __init__(self, group: Optional[dist.ProcessGroup] = None):
+        if not dist.is_initialized():
+            raise RuntimeError("Sequence parallelism needs an initialized default process group")
+        self.group = group
+        self.rank = dist.get_rank(group)
+        self.world_size = dist.get_world_size(group)
+
+    def layout(
+        self, num_image_tokens: int, image_tokens_masks: Optional[torch.Tensor] = None
+    ) -> Optional[SequenceShard]:
+        """The layout of a forward, or None if the image tokens do not split evenly across the ranks."""
+        if num_image_tokens % self.world_size != 0:
+            return None
+        return SequenceShard(
+            group = self.group,
+            rank = self.rank,
+            world_size = self.world_size,
+            num_image_tokens = num_image_tokens // self.world_size,
+            image_tokens_masks = image_tokens_masks,
+        )
+
+def sequence_parallel_attention(
+    attention_func,
+    query: torch.Tensor,
+    key: torch.Tensor,
+    value: torch.Tensor,
+    seq_shard: SequenceShard,
+    key_padding_mask: Optional[torch.Tensor] = None,
+) -> torch.Tensor:
+    """
+    Attention of local (B, S_img / P + S_txt, H, D) tokens over the full sequence. `attention_func` is the dense
+    function of an attention backend; the result has the layout of the inputs.
+    """
+    num_image_tokens = seq_shard.num_image_tokens
+    query, key, value = (
+        torch.cat([
+            seq_shard.image_heads_to_sequence(x[:, :num_image_tokens]),
+            seq_shard.local_heads(x[:, num_image_tokens:]),
+        ], dim=1)
+        for x in (query, key, value)
+    )
+    if key_padding_mask is not None:
+        image_tokens_masks = seq_shard.image_tokens_masks
+        if image_tokens_masks is None:
+            # only the text tokens are masked
+            image_tokens_masks = key_padding_mask.new_ones(key_padding_mask.shape[0], num_image_tokens * seq_shard.world_size)
+        key_padding_mask = torch.cat([image_tokens_masks, key_padding_mask[:, num_image_tokens:]], dim=1)
+    hidden_states = attention_func(query, key, value, key_padding_mask)
+    num_image_tokens = num_image_tokens * seq_shard.world_size
+    return torch.cat([
+        seq_shard.image_sequence_to_heads(hidden_states[:, :num_image_tokens]),
+        seq_shard.gather_heads(hidden_states[:, num_image_tokens:]),
+    ], dim=1)
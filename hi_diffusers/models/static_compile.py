@@ -0,0 +1,163 @@
+import time
+import weakref
+from typing import Any, Dict, List, Tuple
+import torch
+from torch import nn
+
+def _graph_break_count() -> int:
+    from torch._dynamo.utils import counters
+    return sum(counters["graph_break"].values())
+
+class StaticShapeBucket:
+    """
+    Preallocated inputs and the compiled `forward_static` of one (model, resolution, batch) bucket. Every call copies
+    its inputs into the same buffers, which keeps the guards of the compiled graph stable and lets CUDA graph modes
+    replay without re-recording. The rope table and padding mask of the bucket are computed once.
+    """
+
+    def __init__(
+        self,
+        model: nn.Module,
+        compiled_forward,
+        hidden_states: torch.Tensor,
+        timesteps: torch.Tensor,
+        pooled_embeds: torch.Tensor,
+        text_conditioning,
+        clone_outputs: bool = False,
+    ):
+        self.model = model
+        self.compiled_forward = compiled_forward
+        self.clone_outputs = clone_outputs
+        self.hidden_states = torch.empty_like(hidden_states)
+        self.timesteps = torch.empty_like(timesteps)
+        self.pooled_embeds = torch.empty_like(pooled_embeds)
+        self.encoder_hidden_states = [torch.empty_like(x) for x in text_conditioning.encoder_hidden_states]
+        self.initial_encoder_hidden_states = torch.empty_like(text_conditioning.initial_encoder_hidden_states)
+        self.text_tokens_masks = None
+        if text_conditioning.text_tokens_masks is not None:
+            self.text_tokens_masks = torch.empty_like(text_conditioning.text_tokens_masks)
+        # a weak reference, so the bucket does not keep the conditioning of the last request alive between requests
+        self._text_conditioning_ref = None
+
+        batch_size, _, height, width = hidden_states.shape
+        p = model.config.patch_size
+        pH, pW = height // p, width // p
+        # non-square latents are padded to `max_seq` tokens, as in `forward`
+        self.image_tokens_masks = None
+        image_seq_len = pH * pW
+        if pH != pW:
+            image_seq_len = model.max_seq
+            self.image_tokens_masks = torch.zeros(
+                batch_size, image_seq_len, dtype=hidden_states.dtype, device=hidden_states.device
+            )
+            self.image_tokens_masks[:, :pH * pW] = 1
+        self.rope = model.pe_embedder.get_rope(
+            [(pH, pW)], image_seq_len, text_conditioning.txt_ids.shape[1], hidden_states.device
+        )
+
+        self.calls = 0
+        self.graph_breaks = None
+        self.compile_time = None
+
+    def _copy_inputs(self, hidden_states, timesteps, pooled_embeds, text_conditioning):
+        self.hidden_states.copy_(hidden_states)
+        self.timesteps.copy_(timesteps)
+        self.pooled_embeds.copy_(pooled_embeds)
+        # the text conditioning of a request is the same object in every step, so it is only copied once
+        last_text_conditioning = self._text_conditioning_ref() if self._text_conditioning_ref is not None else None
+        if text_conditioning is not last_text_conditioning:
+            for buffer, x in zip(self.encoder_hidden_states, text_conditioning.encoder_hidden_states):
+                buffer.copy_(x)
+            self.initial_encoder_hidden_states.copy_(text_conditioning.initial_encoder_hidden_states)
+            if self.text_tokens_masks is not None:
+                self.text_tokens_masks.copy_(text_conditioning.text_tokens_masks)
+            self._text_conditioning_ref = weakref.ref(text_conditioning)
+
+    def __call__(self, hidden_states, timesteps, pooled_embeds, text_conditioning) -> torch.Tensor:
+        self._copy_inputs(hidden_states, timesteps, pooled_embeds, text_conditioning)
+        first_call = self.calls == 0
+        if first_call:
+            graph_breaks = _graph_break_count()
+            start = time.perf_counter()
+        output = self.compiled_forward(
+            self.hidden_states,
+            self.timesteps,
+            self.pooled_embeds,
+            self.encoder_hidden_states,
+            self.initial_encoder_hidden_states,
+            self.rope,
+            self.image_tokens_masks,
+            self.text_tokens_masks,
+        )
+        if first_call:
+            self.compile_time = time.perf_counter() - start
+            self.graph_breaks = _graph_break_count() - graph_breaks
+        self.calls += 1
+        # outputs of CUDA graph replays are overwritten by the next replay
+        return output.clone() if self.clone_outputs else output
+
+class StaticCompileCache:
+    """
+    Compiles `HiDreamImageTransformer2DModel.forward_static` once per (model, resolution, batch) bucket with static
+    shapes and serves later calls of a bucket from its graph. Text sequence lengths, dtype and device are part of the
+    bucket key. `compile_kwargs` are passed to `torch.compile` (`dynamic` defaults to False); `stats()` reports the
+    graph breaks, compile time and calls of every bucket.
+    """
+
+    def __init__(self, **compile_kwargs):
+        self.compile_kwargs = {"dynamic": False, **compile_kwargs}
+        self.buckets: Dict[Tuple, StaticShapeBucket] = {}
+
+    @staticmethod
+    def bucket_key(model, hidden_states, text_conditioning) -> Tuple:
+        return (
+            id(model),
+            tuple(hidden_states.shape),
+            tuple(tuple(x.shape) for x in text_conditioning.encoder_hidden_states),
+            tuple(text_conditioning.initial_encoder_hidden_states.shape),
+            text_conditioning.text_tokens_masks is not None,
+            hidden_states.dtype,
+            hidden_states.device,
+        )
+
+    def get(self, model, hidden_states, timesteps, pooled_embeds, text_conditioning) -> StaticShapeBucket:
+        key = self.bucket_key(model, hidden_states, text_conditioning)
+        if key not in self.buckets:
+            # every bucket is a recompilation of the same code object
+            dynamo_config = torch._dynamo.config
+            limit_name = "recompile_limit" if hasattr(dynamo_config, "recompile_limit") else "cache_size_limit"
+            setattr(dynamo_config, limit_name, max(getattr(dynamo_config, limit_name), len(self.buckets) + 1))
+            model.prepare_forward_static()
+            self.buckets[key] = StaticShapeBucket(
+                model,
+                torch.compile(model.forward_static, **self.compile_kwargs),
+                hidden_states,
+                timesteps,
+                pooled_embeds,
+                text_conditioning,
+                clone_outputs = self.compile_kwargs.get("mode") in ("reduce-overhead", "max-autotune"),
+            )
+        return self.buckets[key]
+
+    def __call__(self, model, hidden_states, timesteps, pooled_embeds, text_conditioning) -> torch.Tensor:
+        return self.get(model, hidden_states, timesteps, pooled_embeds, text_conditioning)(
+            hidden_states, timesteps, pooled_embeds, text_conditioning
+        )
+
+    @property
+    def graph_breaks(self) -> int:
+        return sum(bucket.graph_breaks or 0 for bucket in self.buckets.values())
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [
+            {
+                "shape": tuple(bucket.hidden_states.shape),
+                "graph_breaks": bucket.graph_breaks,
+                "compile_time": bucket.compile_time,
+                "calls": bucket.calls,
+            }
+            for bucket in self.buckets.values()
+        ]
+
+    def clear(self):
+        self.buckets = {}
@@ -0,0 +1,97 @@
+from dataclasses import dataclass
+from typing import Optional, Tuple
+import torch
+import torch.nn.functional as F
+
+def _gather_tokens(x: torch.Tensor, idx: torch.Tensor) -> torch.Tensor:
+    # x: (B or 1, N, ...), idx: (B, M) -> (B, M, ...)
+    x = x.expand(idx.shape[0], *x.shape[1:])
+    return x[torch.arange(idx.shape[0], device=idx.device)[:, None], idx]
+
+@dataclass
+class TokenMerge:
+    """
+    Merge/unmerge of the leading `num_tokens` image tokens of a sequence; trailing (text) tokens pass through.
+    Merged sequences hold the unmerged tokens followed by the destination tokens.
+    """
+    num_tokens: int
+    unm_idx: torch.Tensor  # (B, N - Nd - r) tokens kept as they are
+    src_idx: torch.Tensor  # (B, r) tokens averaged into a destination token
+    dst_idx: torch.Tensor  # (B, Nd) destination tokens
+    src_dst: torch.Tensor  # (B, r) position of the destination of every merged token within `dst_idx`
+    # rope table and token masks of the merged sequence, gathered once per step
+    rope: Optional[torch.Tensor] = None
+    image_tokens_masks: Optional[torch.Tensor] = None
+
+    @property
+    def num_merged_tokens(self) -> int:
+        return self.unm_idx.shape[1] + self.dst_idx.shape[1]
+
+    def _split(self, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        return x[:, :self.num_tokens], x[:, self.num_tokens:]
+
+    def merge(self, x: torch.Tensor) -> torch.Tensor:
+        tokens, tail = self._split(x)
+        dst = _gather_tokens(tokens, self.dst_idx)
+        src = _gather_tokens(tokens, self.src_idx)
+        index = self.src_dst[:, :, None].expand(-1, -1, x.shape[-1])
+        dst = dst.scatter_reduce(1, index, src, reduce="mean", include_self=True)
+        return torch.cat([_gather_tokens(tokens, self.unm_idx), dst, tail], dim=1)
+
+    def gather(self, x: torch.Tensor) -> torch.Tensor:
+        """Selects the rope entries or mask values of the merged sequence, e.g. those of the destination tokens."""
+        tokens, tail = self._split(x)
+        tail = tail.expand(self.dst_idx.shape[0], *tail.shape[1:])
+        return torch.cat([_gather_tokens(tokens, torch.cat([self.unm_idx, self.dst_idx], dim=1)), tail], dim=1)
+
+    def unmerge(self, x: torch.Tensor) -> torch.Tensor:
+        num_unm = self.unm_idx.shape[1]
+        unm, dst, tail = x.split([num_unm, self.dst_idx.shape[1], x.shape[1] - self.num_merged_tokens], dim=1)
+        batch_ids = torch.arange(x.shape[0], device=x.device)[:, None]
+        tokens = x.new_empty(x.shape[0], self.num_tokens, x.shape[-1])
+        tokens[batch_ids, self.unm_idx] = unm
+        tokens[batch_ids, self.dst_idx] = dst
+        tokens[batch_ids, self.src_idx] = _gather_tokens(dst, self.src_dst)
+        return torch.cat([tokens, tail], dim=1)
+
+class BipartiteSoftMatching:
+    """
+    ToMe-style bipartite matching of image tokens. The top-left token of every 2x2 patch of the image grid is a
+    destination, every other token a source matched to its most similar destination (cosine similarity of `metric`).
+    The matching is computed once and `plan(ratio)` merges the best matched sources for any merge ratio.
+    """
+
+    def __init__(self, metric: torch.Tensor, img_size: Tuple[int, int]):
+        batch_size, num_tokens, _ = metric.shape
+        device = metric.device
+        pH, pW = img_size
+        grid = torch.arange(pH * pW, device=device).view(pH, pW)
+        is_dst = torch.zeros(num_tokens, dtype=torch.bool, device=device)
+        is_dst[grid[::2, ::2].flatten()] = True
+        dst_idx = is_dst.nonzero().squeeze(1)
+        # padded tokens after the image grid are sources that are never merged
+        src_idx = (~is_dst).nonzero().squeeze(1)
+        self.num_tokens = num_tokens
+        self.num_image_tokens = pH * pW
+        self.max_merged = pH * pW - dst_idx.shape[0]
+
+        metric = F.normalize(metric.float(), dim=-1)
+        scores = metric[:, src_idx] @ metric[:, dst_idx].transpose(1, 2)
+        scores[:, src_idx >= pH * pW] = float("-inf")
+        node_max, node_dst = scores.max(dim=-1)
+        order = node_max.argsort(dim=-1, descending=True)
+        self.order = src_idx[order]
+        self.order_dst = node_dst.gather(-1, order)
+        self.dst_idx = dst_idx[None].expand(batch_size, -1)
+
+    def plan(self, ratio: float) -> Optional[TokenMerge]:
+        r = min(int(self.num_image_tokens * ratio), self.max_merged)
+        if r <= 0:
+            return None
+        return TokenMerge(
+            num_tokens = self.num_tokens,
+            unm_idx = self.order[:, r:].sort(dim=-1).values,
+            src_idx = self.order[:, :r],
+            dst_idx = self.dst_idx,
+            src_dst = self.order_dst[:, :r],
+        )
@@ -1,7 +1,9 @@
+from dataclasses import dataclass
 from typing import Any, Dict, Optional, Tuple, List
 
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import einops
 from einops import repeat
 
@@ -11,13 +13,25 @@ from diffusers.models.modeling_utils import ModelMixin
 from diffusers.utils import USE_PEFT_BACKEND, is_torch_version, logging, scale_lora_layers, unscale_lora_layers
 from diffusers.utils.torch_utils import maybe_allow_in_graph
 from diffusers.models.modeling_outputs import Transformer2DModelOutput
-from ..embeddings import PatchEmbed, PooledEmbed, TimestepEmbed, EmbedND, OutEmbed
+from ..embeddings import PatchEmbed, PooledEmbed, TimestepEmbed, EmbedND, OutEmbed, expand_modulation
 from ..attention import HiDreamAttention, FeedForwardSwiGLU
-from ..attention_processor import HiDreamAttnProcessor_flashattn
+from ..attention_processor import HiDreamAttnProcessor_flashattn, PackedSeqInfo, ATTENTION_BACKENDS
 from ..moe import MOEFeedForwardSwiGLU
+from ..block_cache import BlockResidualCache, BLOCK_CACHE_PRESETS
+from ..token_merging import BipartiteSoftMatching, TokenMerge
+from ..quantization import Int8WeightOnlyLinear, replace_linears
+from ..offload import BlockStreamer, ExpertOffloader
+from ..sequence_parallel import SequenceParallel, SequenceShard
+from ..pipeline_parallel import PipelineParallel
+from ..expert_parallel import ExpertParallel
+from ..workspace import BlockWorkspace
 
 logger = logging.get_logger(__name__)  # pylint: disable=invalid-name
 
+# Linear layers kept in full precision by `quantize_weights`: the embedders, the final layer and the adaLN
+# modulations, which are small per token and are stacked into one GEMM by `fuse_adaln_modulation`
+QUANTIZATION_SKIP_MODULES = ["t_embedder", "p_embedder", "x_embedder", "final_layer", "adaLN_modulation"]
+
 class TextProjection(nn.Module):
     def __init__(self, in_features, hidden_size):
         super().__init__()
@@ -27,6 +41,68 @@ class TextProjection(nn.Module):
         hidden_states = self.linear(caption)
         return hidden_states
     
+@dataclass
+class HiDreamTextConditioning:
+    """
+    Step-invariant text conditioning of one request. Built once by `prepare_text_conditioning` and passed to every
+    denoising step so the caption projections are not recomputed. `text_tokens_masks` is the (B, S_txt) key mask of
+    the text tokens of every block, [T5 | last Llama layer | Llama layer of the block], for length-bucketed prompts.
+    """
+    encoder_hidden_states: List[torch.Tensor]
+    initial_encoder_hidden_states: torch.Tensor
+    txt_ids: torch.Tensor
+    text_tokens_masks: Optional[torch.Tensor] = None
+
+    def select(self, batch: slice) -> "HiDreamTextConditioning":
+        """Conditioning of a part of the batch, e.g. the conditional half of a CFG batch."""
+        return HiDreamTextConditioning(
+            encoder_hidden_states = [x[batch] for x in self.encoder_hidden_states],
+            initial_encoder_hidden_states = self.initial_encoder_hidden_states[batch],
+            txt_ids = self.txt_ids[batch],
+            text_tokens_masks = self.text_tokens_masks[batch] if self.text_tokens_masks is not None else None,
+        )
+
+@dataclass
+class HiDreamStepConditioning:
+    """Timestep-dependent conditioning of one denoising step, see `HiDreamScheduleConditioning`."""
+    adaln_input: torch.Tensor
+    block_modulations: List[torch.Tensor]
+    final_modulation: torch.Tensor
+
+    def select(self, batch: slice) -> "HiDreamStepConditioning":
+        return HiDreamStepConditioning(
+            adaln_input = self.adaln_input[batch],
+            block_modulations = [x[batch] for x in self.block_modulations],
+            final_modulation = self.final_modulation[batch],
+        )
+
+@dataclass
+class HiDreamScheduleConditioning:
+    """
+    Timestep embeddings and adaLN modulations of every step of a schedule, computed in one batched pass by
+    `prepare_schedule_conditioning`. Indexing with a step returns the `HiDreamStepConditioning` for `forward`.
+    """
+    adaln_input: torch.Tensor
+    block_modulations: torch.Tensor
+    final_modulation: torch.Tensor
+    split_sizes: List[int]
+
+    @property
+    def nbytes(self) -> int:
+        return sum(
+            x.numel() * x.element_size() for x in (self.adaln_input, self.block_modulations, self.final_modulation)
+        )
+
+    def __len__(self) -> int:
+        return self.adaln_input.shape[0]
+
+    def __getitem__(self, step: int) -> HiDreamStepConditioning:
+        return HiDreamStepConditioning(
+            adaln_input = self.adaln_input[step],
+            block_modulations = list(self.block_modulations[step].split(self.split_sizes, dim=-1)),
+            final_modulation = self.final_modulation[step],
+        )
+
 class BlockType:
     TransformerBlock = 1
     SingleTransformerBlock = 2
@@ -79,26 +155,64 @@ class HiDreamImageSingleTransformerBlock(nn.Module):
         text_tokens: Optional[torch.FloatTensor] = None,
         adaln_input: Optional[torch.FloatTensor] = None,
         rope: torch.FloatTensor = None,
-
+        packed_seq: Optional[PackedSeqInfo] = None,
+        modulation: Optional[torch.FloatTensor] = None,
+        text_tokens_masks: Optional[torch.Tensor] = None,
+        token_merge: Optional[TokenMerge] = None,
+        seq_shard: Optional[SequenceShard] = None,
+        workspace: Optional[BlockWorkspace] = None,
     ) -> torch.FloatTensor:
         wtype = image_tokens.dtype
+        if modulation is None:
+            modulation = self.adaLN_modulation(adaln_input)
+        sample_ids = packed_seq.sample_ids if packed_seq is not None else None
         shift_msa_i, scale_msa_i, gate_msa_i, shift_mlp_i, scale_mlp_i, gate_mlp_i = \
-            self.adaLN_modulation(adaln_input)[:,None].chunk(6, dim=-1)
+            expand_modulation(modulation, sample_ids).chunk(6, dim=-1)
         
         # 1. MM-Attention
-        norm_image_tokens = self.norm1_i(image_tokens).to(dtype=wtype)
-        norm_image_tokens = norm_image_tokens * (1 + scale_msa_i) + shift_msa_i
+        if workspace is not None:
+            # the residual stream `image_tokens` is updated in place
+            norm_image_tokens = workspace.modulated_norm(
+                "single_norm_i", image_tokens, scale_msa_i, shift_msa_i, self.norm1_i.eps
+            )
+        else:
+            norm_image_tokens = self.norm1_i(image_tokens).to(dtype=wtype)
+            norm_image_tokens = norm_image_tokens * (1 + scale_msa_i) + shift_msa_i
+        if token_merge is not None:
+            # attention and feed-forward run on the merged tokens, the residual stream keeps all of them
+            norm_image_tokens = token_merge.merge(norm_image_tokens)
+            image_tokens_masks, rope = token_merge.image_tokens_masks, token_merge.rope
         attn_output_i = self.attn1(
             norm_image_tokens,
             image_tokens_masks,
             rope = rope,
+            packed_seq = packed_seq,
+            seq_shard = seq_shard,
+            text_tokens_masks = text_tokens_masks,
         )
-        image_tokens = gate_msa_i * attn_output_i + image_tokens
+        if token_merge is not None:
+            attn_output_i = token_merge.unmerge(attn_output_i)
+        if workspace is not None:
+            image_tokens.addcmul_(gate_msa_i, attn_output_i)
+        else:
+            image_tokens = gate_msa_i * attn_output_i + image_tokens
         
         # 2. Feed-forward
-        norm_image_tokens = self.norm3_i(image_tokens).to(dtype=wtype)
-        norm_image_tokens = norm_image_tokens * (1 + scale_mlp_i) + shift_mlp_i
-        ff_output_i = gate_mlp_i * self.ff_i(norm_image_tokens.to(dtype=wtype))
+        if workspace is not None:
+            norm_image_tokens = workspace.modulated_norm(
+                "single_norm_i", image_tokens, scale_mlp_i, shift_mlp_i, self.norm3_i.eps
+            )
+        else:
+            norm_image_tokens = self.norm3_i(image_tokens).to(dtype=wtype)
+            norm_image_tokens = norm_image_tokens * (1 + scale_mlp_i) + shift_mlp_i
+        if token_merge is not None:
+            norm_image_tokens = token_merge.merge(norm_image_tokens)
+        ff_output_i = self.ff_i(norm_image_tokens.to(dtype=wtype))
+        if token_merge is not None:
+            ff_output_i = token_merge.unmerge(ff_output_i)
+        if workspace is not None:
+            return image_tokens.addcmul_(gate_mlp_i, ff_output_i)
+        ff_output_i = gate_mlp_i * ff_output_i
         image_tokens = ff_output_i + image_tokens
         return image_tokens
 
@@ -153,25 +267,58 @@ class HiDreamImageTransformerBlock(nn.Module):
         text_tokens: Optional[torch.FloatTensor] = None,
         adaln_input: Optional[torch.FloatTensor] = None,
         rope: torch.FloatTensor = None,
+        packed_seq: Optional[PackedSeqInfo] = None,
+        modulation: Optional[torch.FloatTensor] = None,
+        text_tokens_masks: Optional[torch.Tensor] = None,
+        seq_shard: Optional[SequenceShard] = None,
+        workspace: Optional[BlockWorkspace] = None,
     ) -> torch.FloatTensor:
         wtype = image_tokens.dtype
-        shift_msa_i, scale_msa_i, gate_msa_i, shift_mlp_i, scale_mlp_i, gate_mlp_i, \
+        if modulation is None:
+            modulation = self.adaLN_modulation(adaln_input)
+        sample_ids_i = sample_ids_t = None
+        if packed_seq is not None:
+            sample_ids_i, sample_ids_t = packed_seq.sample_ids.split([image_tokens.shape[1], text_tokens.shape[1]])
+        modulation_i, modulation_t = modulation.chunk(2, dim=-1)
+        shift_msa_i, scale_msa_i, gate_msa_i, shift_mlp_i, scale_mlp_i, gate_mlp_i = \
+            expand_modulation(modulation_i, sample_ids_i).chunk(6, dim=-1)
         shift_msa_t, scale_msa_t, gate_msa_t, shift_mlp_t, scale_mlp_t, gate_mlp_t = \
-            self.adaLN_modulation(adaln_input)[:,None].chunk(12, dim=-1)
+            expand_modulation(modulation_t, sample_ids_t).chunk(6, dim=-1)
         
         # 1. MM-Attention
-        norm_image_tokens = self.norm1_i(image_tokens).to(dtype=wtype)
-        norm_image_tokens = norm_image_tokens * (1 + scale_msa_i) + shift_msa_i
-        norm_text_tokens = self.norm1_t(text_tokens).to(dtype=wtype)
-        norm_text_tokens = norm_text_tokens * (1 + scale_msa_t) + shift_msa_t
+        if workspace is not None:
+            # the residual streams `image_tokens` and `text_tokens` are updated in place
+            norm_image_tokens = workspace.modulated_norm(
+                "norm_i", image_tokens, scale_msa_i, shift_msa_i, self.norm1_i.eps
+            )
+            norm_text_tokens = workspace.modulated_norm("norm_t", text_tokens, scale_msa_t, shift_msa_t, self.norm1_t.eps)
+        else:
+            norm_image_tokens = self.norm1_i(image_tokens).to(dtype=wtype)
+            norm_image_tokens = norm_image_tokens * (1 + scale_msa_i) + shift_msa_i
+            norm_text_tokens = self.norm1_t(text_tokens).to(dtype=wtype)
+            norm_text_tokens = norm_text_tokens * (1 + scale_msa_t) + shift_msa_t
 
         attn_output_i, attn_output_t = self.attn1(
             norm_image_tokens,
             image_tokens_masks,
             norm_text_tokens,
             rope = rope,
+            packed_seq = packed_seq,
+            seq_shard = seq_shard,
+            text_tokens_masks = text_tokens_masks,
         )
 
+        if workspace is not None:
+            image_tokens.addcmul_(gate_msa_i, attn_output_i)
+            text_tokens.addcmul_(gate_msa_t, attn_output_t)
+            norm_image_tokens = workspace.modulated_norm(
+                "norm_i", image_tokens, scale_mlp_i, shift_mlp_i, self.norm3_i.eps
+            )
+            norm_text_tokens = workspace.modulated_norm("norm_t", text_tokens, scale_mlp_t, shift_mlp_t, self.norm3_t.eps)
+            image_tokens.addcmul_(gate_mlp_i, self.ff_i(norm_image_tokens))
+            text_tokens.addcmul_(gate_mlp_t, self.ff_t(norm_text_tokens))
+            return image_tokens, text_tokens
+
         image_tokens = gate_msa_i * attn_output_i + image_tokens
         text_tokens = gate_msa_t * attn_output_t + text_tokens
         
@@ -218,13 +365,30 @@ class HiDreamImageBlock(nn.Module):
         text_tokens: Optional[torch.FloatTensor] = None,
         adaln_input: torch.FloatTensor = None,
         rope: torch.FloatTensor = None,
+        packed_seq: Optional[PackedSeqInfo] = None,
+        modulation: Optional[torch.FloatTensor] = None,
+        text_tokens_masks: Optional[torch.Tensor] = None,
+        token_merge: Optional[TokenMerge] = None,
+        seq_shard: Optional[SequenceShard] = None,
+        workspace: Optional[BlockWorkspace] = None,
     ) -> torch.FloatTensor:
+        # token merging only applies to single-stream blocks
+        kwargs = {"token_merge": token_merge} if token_merge is not None else {}
+        if text_tokens_masks is not None:
+            kwargs["text_tokens_masks"] = text_tokens_masks
+        if seq_shard is not None:
+            kwargs["seq_shard"] = seq_shard
+        if workspace is not None:
+            kwargs["workspace"] = workspace
         return self.block(
             image_tokens,
             image_tokens_masks,
             text_tokens,
             adaln_input,
             rope,
+            packed_seq,
+            modulation,
+            **kwargs,
         )
 
 class HiDreamImageTransformer2DModel(
@@ -232,6 +396,8 @@ class HiDreamImageTransformer2DModel(
 ):
     _supports_gradient_checkpointing = True
     _no_split_modules = ["HiDreamImageBlock"]
+    # the per-channel scales of int8 weights, loading them in `torch_dtype` would round them
+    _keep_in_fp32_modules = ["weight_scale"]
 
     @register_to_config
     def __init__(
@@ -250,6 +416,9 @@ class HiDreamImageTransformer2DModel(
         axes_dims_rope: Tuple[int, int] = (32, 32),
         max_resolution: Tuple[int, int] = (128, 128),
         llama_layers: List[int] = None, 
+        fused_projections: bool = False,
+        weight_quantization: Optional[str] = None,
+        weight_quantization_skip_modules: Optional[List[str]] = None,
     ):
         super().__init__()
         self.out_channels = out_channels or in_channels
@@ -303,6 +472,409 @@ class HiDreamImageTransformer2DModel(
         self.max_seq = max_resolution[0] * max_resolution[1] // (patch_size * patch_size)
 
         self.gradient_checkpointing = False
+        self.adaln_fused = False
+        self._stacked_adaln_weights = None
+        self.block_cache = None
+        self.token_merging = None
+        self.expert_offload = None
+        self.block_streaming = None
+        self.sequence_parallel = None
+        self.pipeline_parallel = None
+        self.expert_parallel = None
+        self.block_workspace = None
+
+        # checkpoints saved after `fuse_projections` or `quantize_weights` are loaded into that layout directly
+        self.weight_quantization = None
+        if fused_projections:
+            self.fuse_projections()
+        if weight_quantization is not None:
+            self.quantize_weights(weight_quantization, weight_quantization_skip_modules)
+
+    @classmethod
+    def from_pretrained(cls, *args, **kwargs):
+        loaded = super().from_pretrained(*args, **kwargs)
+        model = loaded[0] if isinstance(loaded, tuple) else loaded
+        # diffusers assigns the checkpoint tensors to the modules directly, without `load_state_dict`
+        for module in model.modules():
+            if isinstance(module, Int8WeightOnlyLinear):
+                module.align_weights()
+        return loaded
+
+    def set_attention_backend(self, backend: Optional[str] = None, mask_padded_keys: Optional[bool] = None):
+        """
+        Selects the attention backend (a name registered in `attention_processor.ATTENTION_BACKENDS` or "auto") and
+        the handling of padded image tokens for every attention layer of the model. `None` restores the process-wide
+        defaults.
+        """
+        if backend is not None and backend != "auto" and backend not in ATTENTION_BACKENDS:
+            raise ValueError(f"Unknown attention backend {backend}, available: {list(ATTENTION_BACKENDS)} or 'auto'")
+        for module in self.modules():
+            if isinstance(module, HiDreamAttention):
+                module.set_attention_backend(backend, mask_padded_keys)
+
+    def fuse_projections(self):
+        """
+        Fuses the q/k/v projections of every attention layer and the w1/w3 projections of every SwiGLU feed-forward in
+        place, so each of them runs as one larger GEMM. Call after `from_pretrained`; `unfuse_projections` restores
+        the checkpoint layout, e.g. before loading LoRA weights or training.
+        """
+        if self.weight_quantization is not None:
+            raise ValueError("Projections have to be fused before `quantize_weights`")
+        if self.block_streaming is not None:
+            raise ValueError("Projections have to be fused before `enable_block_streaming`")
+        for module in self.modules():
+            if isinstance(module, (HiDreamAttention, FeedForwardSwiGLU)):
+                module.fuse_projections()
+        self.register_to_config(fused_projections=True)
+
+    def unfuse_projections(self):
+        if self.weight_quantization is not None:
+            raise ValueError("Quantized projections cannot be unfused")
+        for module in self.modules():
+            if isinstance(module, (HiDreamAttention, FeedForwardSwiGLU)):
+                module.unfuse_projections()
+        self.register_to_config(fused_projections=False)
+
+    def _adaln_linears(self) -> List[nn.Linear]:
+        return [block.block.adaLN_modulation[1] for block in [*self.double_stream_blocks, *self.single_stream_blocks]]
+
+    def fuse_adaln_modulation(self):
+        """
+        Computes the adaLN modulation of all blocks with a single GEMM per step instead of one small GEMM per block.
+        The block Linears are re-pointed to views of the stacked weights, so no extra memory is used.
+        """
+        self.adaln_fused = True
+        self.stacked_adaln_weights()
+
+    def unfuse_adaln_modulation(self):
+        self.adaln_fused = False
+
+    @torch.no_grad()
+    def stacked_adaln_weights(self) -> Tuple[torch.Tensor, torch.Tensor, List[int]]:
+        # rebuilt whenever the aliasing was broken, e.g. by `.to()` or loading a state dict
+        linears = self._adaln_linears()
+        stacked = self._stacked_adaln_weights
+        if stacked is not None and torch.compiler.is_compiling():
+            # checked by `prepare_forward_static` before compiling
+            return stacked
+        if stacked is not None:
+            weight, bias, split_sizes = stacked
+            views = zip(weight.split(split_sizes), bias.split(split_sizes))
+            if all(
+                linear.weight.data_ptr() == w.data_ptr() and linear.bias.data_ptr() == b.data_ptr()
+                for linear, (w, b) in zip(linears, views)
+            ):
+                return stacked
+
+        weight = torch.cat([linear.weight.data for linear in linears], dim=0)
+        bias = torch.cat([linear.bias.data for linear in linears], dim=0)
+        split_sizes = [linear.out_features for linear in linears]
+        for linear, w, b in zip(linears, weight.split(split_sizes), bias.split(split_sizes)):
+            linear.weight.data = w
+            linear.bias.data = b
+        self._stacked_adaln_weights = (weight, bias, split_sizes)
+        return self._stacked_adaln_weights
+
+    def schedule_conditioning_nbytes(self, num_steps: int, batch_size: int, dtype: torch.dtype) -> int:
+        modulation_dim = sum(linear.out_features for linear in self._adaln_linears())
+        features = self.inner_dim + modulation_dim + self.final_layer.adaLN_modulation[1].out_features
+        return num_steps * batch_size * features * torch.empty((), dtype=dtype).element_size()
+
+    @torch.no_grad()
+    def prepare_schedule_conditioning(
+        self,
+        timesteps: torch.Tensor,
+        pooled_embeds: torch.Tensor,
+        dtype: Optional[torch.dtype] = None,
+    ) -> HiDreamScheduleConditioning:
+        """
+        Runs the timestep and pooled embedders and the adaLN modulation of every block for all `timesteps` of a
+        schedule at once. Memory grows with steps x batch, see `schedule_conditioning_nbytes`.
+        """
+        num_steps, batch_size = timesteps.shape[0], pooled_embeds.shape[0]
+        dtype = dtype or pooled_embeds.dtype
+        t_embeds = self.t_embedder(timesteps.repeat_interleave(batch_size), dtype)
+        p_embeds = self.p_embedder(pooled_embeds).repeat(num_steps, 1)
+        adaln_input = t_embeds + p_embeds
+
+        weight, bias, split_sizes = self.stacked_adaln_weights()
+        block_modulations = F.linear(F.silu(adaln_input), weight, bias)
+        final_modulation = self.final_layer.adaLN_modulation(adaln_input)
+        return HiDreamScheduleConditioning(
+            adaln_input = adaln_input.view(num_steps, batch_size, -1),
+            block_modulations = block_modulations.view(num_steps, batch_size, -1),
+            final_modulation = final_modulation.view(num_steps, batch_size, -1),
+            split_sizes = split_sizes,
+        )
+
+    def set_moe_impl(self, impl: str = "loop"):
+        """
+        Selects the MoE inference path of every MoE layer: "loop" (one launch per expert) or "grouped" (one grouped
+        GEMM for all experts, running the loop where `torch._grouped_mm` is unavailable or rejects the inputs).
+        """
+        if impl not in ("loop", "grouped"):
+            raise ValueError(f"Unknown MoE implementation {impl}, expected 'loop' or 'grouped'")
+        for module in self.modules():
+            if isinstance(module, MOEFeedForwardSwiGLU):
+                module.moe_impl = impl
+
+    def set_ffn_memory_budget(self, max_bytes: Optional[int] = None):
+        """
+        Caps the intermediate activations of every feed-forward and MoE layer at roughly `max_bytes` by running the
+        sequence in slices of tokens, which lowers the peak memory of large batches or resolutions at the cost of more,
+        smaller GEMMs. MoE layers bound the gathered expert inputs and the routing buffers too. `None` runs the full
+        sequence at once.
+        """
+        if max_bytes is not None and max_bytes <= 0:
+            raise ValueError(f"`max_bytes` has to be positive but is {max_bytes}")
+        for module in self.modules():
+            if isinstance(module, (FeedForwardSwiGLU, MOEFeedForwardSwiGLU)):
+                module.max_chunk_bytes = max_bytes
+
+    def quantize_weights(self, mode: str = "int8", skip_modules: Optional[List[str]] = None):
+        """
+        Replaces the Linear layers of the model (attention projections, routed and shared experts, caption
+        projections) by weight-only quantized layers in place. "int8" stores an int8 weight with one scale per output
+        channel; the matmul kernel is selected by `quantization.set_int8_kernel`. `skip_modules` lists module names
+        kept in full precision, `QUANTIZATION_SKIP_MODULES` by default. The mode is recorded in the config, so
+        `save_pretrained` writes the quantized weights and `from_pretrained` loads them without re-quantizing.
+        """
+        if mode != "int8":
+            raise ValueError(f"Unknown weight quantization mode {mode}, expected 'int8'")
+        if self.weight_quantization is not None:
+            raise ValueError(f"The weights are already quantized ({self.weight_quantization})")
+        if self.block_streaming is not None:
+            raise ValueError("Weights have to be quantized before `enable_block_streaming`")
+        skip_modules = list(skip_modules) if skip_modules is not None else list(QUANTIZATION_SKIP_MODULES)
+        if "adaLN_modulation" not in skip_modules:
+            skip_modules.append("adaLN_modulation")
+
+        replace_linears(self, Int8WeightOnlyLinear.from_linear, skip_modules)
+        for module in self.modules():
+            if isinstance(module, MOEFeedForwardSwiGLU):
+                # the stacked expert weights alias the replaced Linear weights
+                module._stacked_expert_weights = None
+        self.weight_quantization = mode
+        self.register_to_config(weight_quantization=mode, weight_quantization_skip_modules=skip_modules)
+
+    def enable_expert_offload(
+        self,
+        max_device_experts: int,
+        prefetch_experts: Optional[int] = None,
+        device: Optional[torch.device] = None,
+    ):
+        """
+        Moves the routed experts of every MoE layer to pinned host memory and keeps at most `max_device_experts` of
+        them on `device` (the model's device by default). The experts selected by the gate are copied asynchronously
+        when a layer runs, together with the `prefetch_experts` (default: top-k) experts of the next layer that were
+        selected most often so far. Call after moving the model to its device, or before with an explicit `device` so
+        the experts never occupy device memory; inference only.
+        """
+        if self.block_streaming is not None:
+            raise ValueError("Expert offloading cannot be combined with block streaming")
+        if self.expert_parallel is not None:
+            raise ValueError("Expert offloading cannot be combined with expert parallelism")
+        if self.expert_offload is not None:
+            self.disable_expert_offload()
+        moe_layers = [module for module in self.modules() if isinstance(module, MOEFeedForwardSwiGLU)]
+        self.expert_offload = ExpertOffloader(
+            moe_layers, device or self.device, max_device_experts, prefetch_experts=prefetch_experts
+        )
+
+    def disable_expert_offload(self):
+        if self.expert_offload is not None:
+            self.expert_offload.restore()
+            self.expert_offload = None
+
+    def enable_block_streaming(
+        self, device: Optional[torch.device] = None, resident_modules: Tuple[str, ...] = ("adaLN_modulation",)
+    ):
+        """
+        Keeps the transformer blocks in pinned host memory and streams them through two device slots per block type
+        (the model's device by default), copying the next block while the current one runs. Submodules named in
+        `resident_modules` stay on the device; the adaLN modulations are small and are also read for blocks that the
+        block cache skips. The embedders, caption projections and final layer stay on the device. Call before moving
+        the model to its device with an explicit `device`, so the blocks never occupy device memory; inference only.
+        `block_streaming.stats()` reports the copied bytes, bandwidth and the fraction of copy time overlapped with
+        computation.
+        """
+        if self.expert_offload is not None:
+            raise ValueError("Block streaming cannot be combined with expert offloading")
+        if self.pipeline_parallel is not None:
+            raise ValueError("Block streaming cannot be combined with pipeline parallelism")
+        if self.expert_parallel is not None:
+            raise ValueError("Block streaming cannot be combined with expert parallelism")
+        if self.block_streaming is not None:
+            self.disable_block_streaming()
+        self.block_streaming = BlockStreamer(
+            [*self.double_stream_blocks, *self.single_stream_blocks], device or self.device, resident_modules
+        )
+
+    def disable_block_streaming(self):
+        if self.block_streaming is not None:
+            self.block_streaming.restore()
+            self.block_streaming = None
+
+    def enable_sequence_parallel(self, group: Optional["torch.distributed.ProcessGroup"] = None):
+        """
+        Splits the image tokens of every forward across the ranks of `group` (the default process group by default)
+        and exchanges them for attention heads around every attention, see `sequence_parallel.SequenceParallel`.
+        Every rank has to run the same requests with the same inputs. Sequences whose image tokens do not split
+        evenly, packed sequences and training run unsharded; the block cache and token merging are not applied to
+        sharded forwards. Works with any `torch.distributed` backend, including gloo on CPU.
+        """
+        if self.pipeline_parallel is not None:
+            raise ValueError("Sequence parallelism cannot be combined with pipeline parallelism")
+        sequence_parallel = SequenceParallel(group)
+        num_heads = self.config.num_attention_heads
+        if num_heads % sequence_parallel.world_size != 0:
+            raise ValueError(
+                f"{num_heads} attention heads cannot be split across {sequence_parallel.world_size} ranks"
+            )
+        self.sequence_parallel = sequence_parallel
+
+    def disable_sequence_parallel(self):
+        self.sequence_parallel = None
+
+    def enable_pipeline_parallel(
+        self,
+        devices: Optional[List[torch.device]] = None,
+        stage_starts: Optional[List[int]] = None,
+        num_micro_batches: int = 2,
+        group: Optional["torch.distributed.ProcessGroup"] = None,
+    ):
+        """
+        Splits the double- and single-stream blocks into contiguous stages, one per entry of `devices` or, without
+        `devices`, one per rank of `group` (the default process group by default), and runs every forward as
+        `num_micro_batches` micro-batches flowing through the stages, e.g. the two halves of a CFG batch.
+        `stage_starts` are the first block indices of the stages after the first, counting the double-stream blocks
+        first; by default the stages hold similar numbers of parameters. Stages on `devices` of one process run one
+        after another and only save memory. See `pipeline_parallel.PipelineParallel`.
+        Packed sequences and training run unsplit; the block cache and token merging are not applied. Call after
+        moving the model to its device.
+        """
+        if self.sequence_parallel is not None:
+            raise ValueError("Pipeline parallelism cannot be combined with sequence parallelism")
+        if self.block_streaming is not None:
+            raise ValueError("Pipeline parallelism cannot be combined with block streaming")
+        if self.pipeline_parallel is not None:
+            self.disable_pipeline_parallel()
+        self.pipeline_parallel = PipelineParallel(self, devices, stage_starts, num_micro_batches, group)
+
+    def disable_pipeline_parallel(self):
+        if self.pipeline_parallel is not None:
+            self.pipeline_parallel.restore()
+            self.pipeline_parallel = None
+
+    def enable_expert_parallel(
+        self,
+        group: Optional["torch.distributed.ProcessGroup"] = None,
+        capacity_factor: Optional[float] = None,
+        offload_device: torch.device = "cpu",
+    ):
+        """
+        Splits the routed experts of every MoE layer across the ranks of `group` (the default process group by
+        default); every rank keeps its 1/P of the experts and moves the others to `offload_device` ("meta" frees
+        them). Tokens are exchanged with the expert-owning ranks by all-to-all, see `expert_parallel.ExpertParallel`
+        for the capacity limit and `expert_parallel.stats()` for the per-rank load. Ranks may run different requests,
+        e.g. under data parallelism, but have to run the same number of forwards. Call after moving the model to its
+        device; inference only.
+        """
+        if self.expert_offload is not None:
+            raise ValueError("Expert parallelism cannot be combined with expert offloading")
+        if self.block_streaming is not None:
+            raise ValueError("Expert parallelism cannot be combined with block streaming")
+        if self.expert_parallel is not None:
+            self.disable_expert_parallel()
+        moe_layers = [module for module in self.modules() if isinstance(module, MOEFeedForwardSwiGLU)]
+        self.expert_parallel = ExpertParallel(moe_layers, group, capacity_factor, offload_device)
+
+    def disable_expert_parallel(self):
+        if self.expert_parallel is not None:
+            self.expert_parallel.restore()
+            self.expert_parallel = None
+
+    def enable_block_workspace(self):
+        """
+        Runs the blocks of inference forwards in place: LayerNorm and modulation write into preallocated buffers, the
+        gated residual updates modify the token streams in place and the token sequences of the blocks are assembled
+        in reused buffers instead of being concatenated and sliced per block, see `workspace.BlockWorkspace`. The
+        buffers are kept across blocks, steps and requests, one per name at its largest shape so far;
+        `block_workspace.stats()` reports the allocator counters before and after the last forward. Packed
+        sequences, pipeline parallelism and training use the regular path.
+        """
+        self.block_workspace = BlockWorkspace()
+
+    def disable_block_workspace(self):
+        self.block_workspace = None
+
+    def enable_block_cache(self, preset: Optional[str] = None, **kwargs):
+        """
+        Enables step-to-step residual caching of the block stack, see `BlockResidualCache` for the arguments.
+        `preset` selects the defaults of a model variant ("full", "dev" or "fast") that `kwargs` override. The
+        pipeline resets the cache at the start of every request.
+        """
+        if preset is not None:
+            if preset not in BLOCK_CACHE_PRESETS:
+                raise ValueError(f"Unknown block cache preset {preset}, available: {list(BLOCK_CACHE_PRESETS)}")
+            kwargs = {**BLOCK_CACHE_PRESETS[preset], **kwargs}
+        self.block_cache = BlockResidualCache(**kwargs)
+
+    def disable_block_cache(self):
+        self.block_cache = None
+
+    def enable_token_merging(self, ratio: float = 0.5, block_ranges: Optional[List[Tuple[int, int, float]]] = None):
+        """
+        Merges similar image tokens (ToMe) before the attention and feed-forward of single-stream blocks and unmerges
+        their outputs, so both run on `1 - ratio` of the image tokens. `block_ranges` lists `(start, end, ratio)`
+        ranges of single-stream block indices; by default all single-stream blocks merge `ratio`. The matching is
+        computed once per step at the first merging block. Inference only; batches of mixed image sizes and packed
+        sequences run unmerged.
+        """
+        num_blocks = len(self.single_stream_blocks)
+        block_ranges = block_ranges if block_ranges is not None else [(0, num_blocks, ratio)]
+        for start, end, range_ratio in block_ranges:
+            if not 0 <= start < end <= num_blocks or not 0.0 <= range_ratio < 1.0:
+                raise ValueError(f"Invalid token merging range {(start, end, range_ratio)} for {num_blocks} blocks")
+        self.token_merging = list(block_ranges)
+
+    def disable_token_merging(self):
+        self.token_merging = None
+
+    def _token_merges(
+        self, block_id, hidden_states, image_tokens_seq_len, img_size, adaln_input, block_modulations, rope,
+        image_tokens_masks,
+    ) -> List[Optional[TokenMerge]]:
+        # bipartite matching on the keys of the first merging block, shared by all merging blocks of the step
+        if self.block_streaming is not None:
+            self.block_streaming.load(block_id)
+        block = [*self.double_stream_blocks, *self.single_stream_blocks][block_id].block
+        metric = block.attn1.image_keys(self._modulated_block_input(
+            block_id, hidden_states[:, :image_tokens_seq_len], adaln_input, block_modulations
+        ))
+        matching = BipartiteSoftMatching(metric, img_size)
+        token_merges = [None] * len(self.single_stream_blocks)
+        plans = {}
+        for start, end, ratio in self.token_merging:
+            if ratio not in plans:
+                plan = matching.plan(ratio)
+                if plan is not None:
+                    plan.rope = plan.gather(rope)
+                    if image_tokens_masks is not None:
+                        plan.image_tokens_masks = plan.gather(image_tokens_masks)
+                plans[ratio] = plan
+            token_merges[start:end] = [plans[ratio]] * (end - start)
+        return token_merges
+
+    def _modulated_block_input(self, block_id, image_tokens, adaln_input, block_modulations, sample_ids=None):
+        # modulated attention input of a block; the modulation is kept so the block does not recompute it
+        block = [*self.double_stream_blocks, *self.single_stream_blocks][block_id].block
+        if block_modulations[block_id] is None:
+            block_modulations[block_id] = block.adaLN_modulation(adaln_input)
+        shift, scale = expand_modulation(
+            block_modulations[block_id][..., :2 * self.inner_dim], sample_ids
+        ).chunk(2, dim=-1)
+        return block.norm1_i(image_tokens).to(dtype=image_tokens.dtype) * (1 + scale) + shift
 
     def _set_gradient_checkpointing(self, module, value=False):
         if hasattr(module, "gradient_checkpointing"):
@@ -361,6 +933,83 @@ class HiDreamImageTransformer2DModel(
             raise NotImplementedError
         return x, x_masks, img_sizes
 
+    @property
+    def llama_layer_ids(self) -> List[int]:
+        """The Llama layers the blocks read, in the order of a stack that holds only them."""
+        return sorted(set(self.llama_layers))
+
+    def prepare_text_conditioning(
+        self,
+        encoder_hidden_states: List[torch.Tensor],
+        lora_scale: Optional[float] = None,
+    ) -> HiDreamTextConditioning:
+        # `encoder_hidden_states` are [T5, Llama stack] or, for length-bucketed prompts, [T5, Llama stack, T5 mask,
+        # Llama mask]; `forward` has already scaled the lora layers when it builds the conditioning itself
+        if USE_PEFT_BACKEND and lora_scale is not None:
+            scale_lora_layers(self, lora_scale)
+
+        T5_encoder_hidden_states = encoder_hidden_states[0]
+        text_masks = encoder_hidden_states[2:]
+        encoder_hidden_states = encoder_hidden_states[1]
+        layer_ids = self.llama_layer_ids
+        if len(encoder_hidden_states) == len(layer_ids):
+            # a stack of only the layers in `llama_layer_ids`; for a full stack of that length both layouts agree
+            rows = {layer: row for row, layer in enumerate(layer_ids)}
+            encoder_hidden_states = [encoder_hidden_states[rows[k]] for k in self.llama_layers]
+        else:
+            encoder_hidden_states = [encoder_hidden_states[k] for k in self.llama_layers]
+        batch_size = T5_encoder_hidden_states.shape[0]
+
+        if self.caption_projection is not None:
+            new_encoder_hidden_states = []
+            for i, enc_hidden_state in enumerate(encoder_hidden_states):
+                enc_hidden_state = self.caption_projection[i](enc_hidden_state)
+                enc_hidden_state = enc_hidden_state.view(batch_size, -1, self.inner_dim)
+                new_encoder_hidden_states.append(enc_hidden_state)
+            encoder_hidden_states = new_encoder_hidden_states
+            T5_encoder_hidden_states = self.caption_projection[-1](T5_encoder_hidden_states)
+            T5_encoder_hidden_states = T5_encoder_hidden_states.view(batch_size, -1, self.inner_dim)
+            encoder_hidden_states.append(T5_encoder_hidden_states)
+
+        txt_ids = torch.zeros(
+            batch_size,
+            encoder_hidden_states[-1].shape[1] + encoder_hidden_states[-2].shape[1] + encoder_hidden_states[0].shape[1],
+            3,
+            device=T5_encoder_hidden_states.device
+        )
+        initial_encoder_hidden_states = torch.cat([encoder_hidden_states[-1], encoder_hidden_states[-2]], dim=1)
+        text_tokens_masks = None
+        if text_masks:
+            # the text tokens of every block are the initial tokens followed by the tokens of its Llama layer
+            T5_mask, llama_mask = text_masks
+            text_tokens_masks = torch.cat([T5_mask, llama_mask, llama_mask], dim=1).bool()
+
+        if USE_PEFT_BACKEND and lora_scale is not None:
+            unscale_lora_layers(self, lora_scale)
+
+        return HiDreamTextConditioning(
+            encoder_hidden_states = encoder_hidden_states,
+            initial_encoder_hidden_states = initial_encoder_hidden_states,
+            txt_ids = txt_ids,
+            text_tokens_masks = text_tokens_masks,
+        )
+
+    def patchify_packed(self, x: List[torch.Tensor]) -> Tuple[torch.Tensor, List[Tuple[int, int]]]:
+        p = self.config.patch_size
+        img_sizes = [(latent.shape[-2] // p, latent.shape[-1] // p) for latent in x]
+        x = torch.cat(
+            [einops.rearrange(latent, 'C (H p1) (W p2) -> (H W) (p1 p2 C)', p1=p, p2=p) for latent in x], dim=0
+        )
+        return x[None], img_sizes
+
+    def unpatchify_packed(self, x: torch.Tensor, img_sizes: List[Tuple[int, int]]) -> List[torch.Tensor]:
+        p = self.config.patch_size
+        x_arr = x[0].split([pH * pW for pH, pW in img_sizes], dim=0)
+        return [
+            einops.rearrange(x_i, '(H W) (p1 p2 C) -> C (H p1) (W p2)', H=pH, W=pW, p1=p, p2=p)
+            for x_i, (pH, pW) in zip(x_arr, img_sizes)
+        ]
+
     def forward(
         self,
         hidden_states: torch.Tensor,
@@ -371,6 +1020,8 @@ class HiDreamImageTransformer2DModel(
         img_ids: Optional[torch.Tensor] = None,
         joint_attention_kwargs: Optional[Dict[str, Any]] = None,
         return_dict: bool = True,
+        text_conditioning: Optional[HiDreamTextConditioning] = None,
+        step_conditioning: Optional[HiDreamStepConditioning] = None,
     ):
         if joint_attention_kwargs is not None:
             joint_attention_kwargs = joint_attention_kwargs.copy()
@@ -387,57 +1038,130 @@ class HiDreamImageTransformer2DModel(
                     "Passing `scale` via `joint_attention_kwargs` when not using the PEFT backend is ineffective."
                 )
 
+        # a list of latents of arbitrary sizes is packed into one sequence without padding
+        packed = isinstance(hidden_states, (list, tuple))
+
+        if self.pipeline_parallel is not None and not packed and not self.training:
+            output, image_tokens_masks = self.pipeline_parallel.forward(
+                self, hidden_states, timesteps, encoder_hidden_states, pooled_embeds, img_sizes, img_ids,
+                text_conditioning, step_conditioning,
+            )
+            if USE_PEFT_BACKEND:
+                unscale_lora_layers(self, lora_scale)
+            if not return_dict:
+                return (output, image_tokens_masks)
+            return Transformer2DModelOutput(sample=output, mask=image_tokens_masks)
+
         # spatial forward
-        batch_size = hidden_states.shape[0]
-        hidden_states_type = hidden_states.dtype
+        batch_size = len(hidden_states) if packed else hidden_states.shape[0]
+        hidden_states_type = hidden_states[0].dtype
+        device = hidden_states[0].device
+        workspace = self.block_workspace if not self.training and not packed else None
+        if workspace is not None:
+            workspace.begin_forward(device)
 
         # 0. time
-        timesteps = self.expand_timesteps(timesteps, batch_size, hidden_states.device)
-        timesteps = self.t_embedder(timesteps, hidden_states_type)
-        p_embedder = self.p_embedder(pooled_embeds)
-        adaln_input = timesteps + p_embedder
-
-        hidden_states, image_tokens_masks, img_sizes = self.patchify(hidden_states, self.max_seq, img_sizes)
-        if image_tokens_masks is None:
-            pH, pW = img_sizes[0]
-            img_ids = torch.zeros(pH, pW, 3, device=hidden_states.device)
-            img_ids[..., 1] = img_ids[..., 1] + torch.arange(pH, device=hidden_states.device)[:, None]
-            img_ids[..., 2] = img_ids[..., 2] + torch.arange(pW, device=hidden_states.device)[None, :]
-            img_ids = repeat(img_ids, "h w c -> b (h w) c", b=batch_size)
+        if step_conditioning is not None:
+            adaln_input = step_conditioning.adaln_input
+        else:
+            timesteps = self.expand_timesteps(timesteps, batch_size, device)
+            timesteps = self.t_embedder(timesteps, hidden_states_type)
+            p_embedder = self.p_embedder(pooled_embeds)
+            adaln_input = timesteps + p_embedder
+
+        if packed:
+            hidden_states, img_sizes = self.patchify_packed(hidden_states)
+            image_tokens_masks = None
+        else:
+            hidden_states, image_tokens_masks, img_sizes = self.patchify(hidden_states, self.max_seq, img_sizes)
         hidden_states = self.x_embedder(hidden_states)
 
-        T5_encoder_hidden_states = encoder_hidden_states[0]
-        encoder_hidden_states = encoder_hidden_states[-1]
-        encoder_hidden_states = [encoder_hidden_states[k] for k in self.llama_layers]
+        if text_conditioning is None:
+            text_conditioning = self.prepare_text_conditioning(encoder_hidden_states)
+        encoder_hidden_states = text_conditioning.encoder_hidden_states
+        initial_encoder_hidden_states = text_conditioning.initial_encoder_hidden_states
+        text_tokens_masks = text_conditioning.text_tokens_masks
+        if packed and text_tokens_masks is not None:
+            raise ValueError("Length-bucketed text tokens are not supported with packed sequences")
+        double_packed_seq = single_packed_seq = None
+        if packed:
+            image_seq_lens = [pH * pW for pH, pW in img_sizes]
+            initial_seq_len = initial_encoder_hidden_states.shape[1]
+            llama_seq_len = encoder_hidden_states[0].shape[1]
+            # double-stream attention sees [image | text] per stream, single-stream blocks append
+            # the current llama tokens of all samples after the initial text tokens
+            double_packed_seq = PackedSeqInfo.from_segments(
+                [image_seq_lens, [initial_seq_len + llama_seq_len] * batch_size], device
+            )
+            single_packed_seq = PackedSeqInfo.from_segments(
+                [image_seq_lens, [initial_seq_len] * batch_size, [llama_seq_len] * batch_size], device
+            )
+            rope = self.pe_embedder.get_packed_rope(
+                img_sizes, batch_size * text_conditioning.txt_ids.shape[1], device
+            )
+        elif img_ids is None:
+            # position ids follow from the image grid, so the rope table is served from the embedder cache
+            rope = self.pe_embedder.get_rope(
+                img_sizes, hidden_states.shape[1], text_conditioning.txt_ids.shape[1], hidden_states.device
+            )
+        else:
+            ids = torch.cat((img_ids, text_conditioning.txt_ids.to(img_ids.dtype)), dim=1)
+            rope = self.pe_embedder(ids)
 
-        if self.caption_projection is not None:
-            new_encoder_hidden_states = []
-            for i, enc_hidden_state in enumerate(encoder_hidden_states):
-                enc_hidden_state = self.caption_projection[i](enc_hidden_state)
-                enc_hidden_state = enc_hidden_state.view(batch_size, -1, hidden_states.shape[-1])
-                new_encoder_hidden_states.append(enc_hidden_state)
-            encoder_hidden_states = new_encoder_hidden_states
-            T5_encoder_hidden_states = self.caption_projection[-1](T5_encoder_hidden_states)
-            T5_encoder_hidden_states = T5_encoder_hidden_states.view(batch_size, -1, hidden_states.shape[-1])
-            encoder_hidden_states.append(T5_encoder_hidden_states)
+        # 1. adaLN modulation of every block in one GEMM
+        block_modulations = [None] * (len(self.double_stream_blocks) + len(self.single_stream_blocks))
+        if step_conditioning is not None:
+            block_modulations = step_conditioning.block_modulations
+        elif self.adaln_fused:
+            weight, bias, split_sizes = self.stacked_adaln_weights()
+            block_modulations = F.linear(F.silu(adaln_input), weight, bias).split(split_sizes, dim=-1)
+        block_modulations = list(block_modulations)
 
-        txt_ids = torch.zeros(
-            batch_size, 
-            encoder_hidden_states[-1].shape[1] + encoder_hidden_states[-2].shape[1] + encoder_hidden_states[0].shape[1], 
-            3, 
-            device=img_ids.device, dtype=img_ids.dtype
-        )
-        ids = torch.cat((img_ids, txt_ids), dim=1)
-        rope = self.pe_embedder(ids)
+        # sequence parallelism shards the image tokens across ranks, the text tokens are replicated
+        seq_shard = None
+        if self.sequence_parallel is not None and not self.training and not packed:
+            seq_shard = self.sequence_parallel.layout(hidden_states.shape[1], image_tokens_masks)
+        if seq_shard is not None:
+            hidden_states = seq_shard.shard(hidden_states)
+            rope = seq_shard.shard_rope(rope)
+            if image_tokens_masks is not None:
+                image_tokens_masks = seq_shard.shard(image_tokens_masks)
+
+        # residual caching of blocks [cache_start, cache_end); in the double-stream part the cached state is
+        # the image tokens followed by the initial text tokens, i.e. the input layout of the single-stream part
+        # skip decisions taken on local tokens could differ between ranks
+        block_cache = self.block_cache if not self.training and seq_shard is None else None
+        cache_start = cache_end = -1
+        skip_cached_blocks = False
+        if block_cache is not None:
+            cache_start, cache_end = block_cache.get_block_range(len(block_modulations))
 
         # 2. Blocks
         block_id = 0
-        initial_encoder_hidden_states = torch.cat([encoder_hidden_states[-1], encoder_hidden_states[-2]], dim=1)
         initial_encoder_hidden_states_seq_len = initial_encoder_hidden_states.shape[1]
         for bid, block in enumerate(self.double_stream_blocks):
+            if block_id == cache_start:
+                image_seq_len = hidden_states.shape[1]
+                skip_cached_blocks = block_cache.should_skip(self._modulated_block_input(
+                    block_id, hidden_states, adaln_input, block_modulations,
+                    double_packed_seq.sample_ids[:image_seq_len] if packed else None,
+                ))
+                cache_input = torch.cat(
+                    [hidden_states, initial_encoder_hidden_states.reshape(hidden_states.shape[0], -1, self.inner_dim)],
+                    dim=1,
+                )
             cur_llama31_encoder_hidden_states = encoder_hidden_states[block_id]
-            cur_encoder_hidden_states = torch.cat([initial_encoder_hidden_states, cur_llama31_encoder_hidden_states], dim=1)
-            if self.training and self.gradient_checkpointing:
+            if workspace is not None:
+                cur_encoder_hidden_states = workspace.tokens(
+                    "double_stream_text_tokens", initial_encoder_hidden_states, cur_llama31_encoder_hidden_states
+                )
+            else:
+                cur_encoder_hidden_states = torch.cat([initial_encoder_hidden_states, cur_llama31_encoder_hidden_states], dim=1)
+            if packed:
+                cur_encoder_hidden_states = cur_encoder_hidden_states.reshape(1, -1, self.inner_dim)
+            if skip_cached_blocks and cache_start <= block_id < cache_end:
+                initial_encoder_hidden_states = cur_encoder_hidden_states
+            elif self.training and self.gradient_checkpointing:
                 def create_custom_forward(module, return_dict=None):
                     def custom_forward(*inputs):
                         if return_dict is not None:
@@ -454,6 +1178,9 @@ class HiDreamImageTransformer2DModel(
                     cur_encoder_hidden_states,
                     adaln_input,
                     rope,
+                    double_packed_seq,
+                    block_modulations[block_id],
+                    text_tokens_masks,
                     **ckpt_kwargs,
                 )
             else:
@@ -463,11 +1190,34 @@ class HiDreamImageTransformer2DModel(
                     text_tokens = cur_encoder_hidden_states,
                     adaln_input = adaln_input,
                     rope = rope,
+                    packed_seq = double_packed_seq,
+                    modulation = block_modulations[block_id],
+                    text_tokens_masks = text_tokens_masks,
+                    seq_shard = seq_shard,
+                    workspace = workspace,
                 )
+            if packed:
+                initial_encoder_hidden_states = initial_encoder_hidden_states.reshape(batch_size, -1, self.inner_dim)
             initial_encoder_hidden_states = initial_encoder_hidden_states[:, :initial_encoder_hidden_states_seq_len]
             block_id += 1
+            if block_id == cache_end:
+                cache_output = torch.cat(
+                    [hidden_states, initial_encoder_hidden_states.reshape(hidden_states.shape[0], -1, self.inner_dim)],
+                    dim=1,
+                )
+                if skip_cached_blocks:
+                    cache_output = block_cache.apply(cache_input)
+                else:
+                    block_cache.update(cache_input, cache_output)
+                image_seq_len = hidden_states.shape[1]
+                hidden_states = cache_output[:, :image_seq_len]
+                initial_encoder_hidden_states = cache_output[:, image_seq_len:].reshape(
+                    initial_encoder_hidden_states.shape
+                )
 
         image_tokens_seq_len = hidden_states.shape[1]
+        if packed:
+            initial_encoder_hidden_states = initial_encoder_hidden_states.reshape(1, -1, self.inner_dim)
         hidden_states = torch.cat([hidden_states, initial_encoder_hidden_states], dim=1)
         hidden_states_seq_len = hidden_states.shape[1]
         if image_tokens_masks is not None:
@@ -477,10 +1227,35 @@ class HiDreamImageTransformer2DModel(
             )
             image_tokens_masks = torch.cat([image_tokens_masks, encoder_attention_mask_ones], dim=1)
 
+        token_merges = [None] * len(self.single_stream_blocks)
+        merge_start = -1
+        merge_img_sizes = {tuple(int(v) for v in img_size) for img_size in img_sizes}
+        if (
+            self.token_merging is not None and not self.training and not packed and seq_shard is None
+            and len(merge_img_sizes) == 1
+        ):
+            merge_start = min(start for start, _, _ in self.token_merging)
+
         for bid, block in enumerate(self.single_stream_blocks):
+            if block_id == cache_start:
+                skip_cached_blocks = block_cache.should_skip(self._modulated_block_input(
+                    block_id, hidden_states[:, :image_tokens_seq_len], adaln_input, block_modulations,
+                    single_packed_seq.sample_ids[:image_tokens_seq_len] if packed else None,
+                ))
+                # the in-place blocks overwrite the token buffer
+                cache_input = hidden_states.clone() if workspace is not None else hidden_states
             cur_llama31_encoder_hidden_states = encoder_hidden_states[block_id]
-            hidden_states = torch.cat([hidden_states, cur_llama31_encoder_hidden_states], dim=1)
-            if self.training and self.gradient_checkpointing:
+            if packed:
+                cur_llama31_encoder_hidden_states = cur_llama31_encoder_hidden_states.reshape(1, -1, self.inner_dim)
+            if workspace is not None:
+                hidden_states = workspace.tokens(
+                    "single_stream_tokens", hidden_states, cur_llama31_encoder_hidden_states
+                )
+            else:
+                hidden_states = torch.cat([hidden_states, cur_llama31_encoder_hidden_states], dim=1)
+            if skip_cached_blocks and cache_start <= block_id < cache_end:
+                pass
+            elif self.training and self.gradient_checkpointing:
                 def create_custom_forward(module, return_dict=None):
                     def custom_forward(*inputs):
                         if return_dict is not None:
@@ -497,25 +1272,58 @@ class HiDreamImageTransformer2DModel(
                     None,
                     adaln_input,
                     rope,
+                    single_packed_seq,
+                    block_modulations[block_id],
+                    text_tokens_masks,
                     **ckpt_kwargs,
                 )
             else:
+                if bid == merge_start:
+                    token_merges = self._token_merges(
+                        block_id, hidden_states, image_tokens_seq_len, next(iter(merge_img_sizes)), adaln_input, block_modulations,
+                        rope, image_tokens_masks,
+                    )
                 hidden_states = block(
                     image_tokens = hidden_states,
                     image_tokens_masks = image_tokens_masks,
                     text_tokens = None,
                     adaln_input = adaln_input,
                     rope = rope,
+                    packed_seq = single_packed_seq,
+                    modulation = block_modulations[block_id],
+                    text_tokens_masks = text_tokens_masks,
+                    token_merge = token_merges[bid],
+                    seq_shard = seq_shard,
+                    workspace = workspace,
                 )
             hidden_states = hidden_states[:, :hidden_states_seq_len]
             block_id += 1
+            if block_id == cache_end:
+                if skip_cached_blocks:
+                    hidden_states = block_cache.apply(cache_input)
+                else:
+                    block_cache.update(cache_input, hidden_states)
         
         hidden_states = hidden_states[:, :image_tokens_seq_len, ...]
-        output = self.final_layer(hidden_states, adaln_input)
-        output = self.unpatchify(output, img_sizes, self.training)
-        if image_tokens_masks is not None:
+        final_modulation = step_conditioning.final_modulation if step_conditioning is not None else None
+        if packed:
+            output = self.final_layer(
+                hidden_states, adaln_input, double_packed_seq.sample_ids[:image_tokens_seq_len], final_modulation
+            )
+            output = self.unpatchify_packed(output, img_sizes)
+        else:
+            output = self.final_layer(hidden_states, adaln_input, modulation=final_modulation)
+            if seq_shard is not None:
+                output = seq_shard.gather(output)
+            output = self.unpatchify(output, img_sizes, self.training)
+        if seq_shard is not None:
+            image_tokens_masks = seq_shard.image_tokens_masks
+        elif image_tokens_masks is not None:
             image_tokens_masks = image_tokens_masks[:, :image_tokens_seq_len]
 
+        if workspace is not None:
+            workspace.end_forward(device)
+
         if USE_PEFT_BACKEND:
             # remove `lora_scale` from each PEFT layer
             unscale_lora_layers(self, lora_scale)
@@ -523,4 +1331,99 @@ class HiDreamImageTransformer2DModel(
         if not return_dict:
             return (output, image_tokens_masks)
         return Transformer2DModelOutput(sample=output, mask=image_tokens_masks)
-        
+
+    @torch.no_grad()
+    def prepare_forward_static(self):
+        """
+        Builds the stacked adaLN and expert weights eagerly, so compiled graphs of `forward_static` read them
+        directly instead of checking their aliasing (a graph break) or re-stacking them inside the graph.
+        """
+        if self.adaln_fused:
+            self.stacked_adaln_weights()
+        for module in self.modules():
+            if (
+                isinstance(module, MOEFeedForwardSwiGLU) and module.moe_impl == "grouped" and module.experts_stackable
+                and module.expert_parallel is None
+            ):
+                module.stacked_expert_weights()
+
+    def forward_static(
+        self,
+        hidden_states: torch.Tensor,
+        timesteps: torch.Tensor,
+        pooled_embeds: torch.Tensor,
+        encoder_hidden_states: List[torch.Tensor],
+        initial_encoder_hidden_states: torch.Tensor,
+        rope: torch.Tensor,
+        image_tokens_masks: Optional[torch.Tensor] = None,
+        text_tokens_masks: Optional[torch.Tensor] = None,
+    ) -> torch.Tensor:
+        """
+        Inference forward of a batch of equally sized latents (B, C, H, W) without data-dependent control flow, so
+        `torch.compile` traces it into one graph per input geometry. The text inputs are the tensors of a
+        `HiDreamTextConditioning` and `rope` is the table of `pe_embedder.get_rope` for the image grid. Like
+        `forward`, non-square latents are padded to the length of `image_tokens_masks` (`max_seq`). See
+        `static_compile.StaticCompileCache`, which keeps these inputs in preallocated buffers per resolution bucket.
+        The block cache, token merging, packed sequences and LoRA scales are not applied.
+        """
+        batch_size, _, height, width = hidden_states.shape
+        p = self.config.patch_size
+        pH, pW = height // p, width // p
+
+        timesteps = self.t_embedder(timesteps, hidden_states.dtype)
+        adaln_input = timesteps + self.p_embedder(pooled_embeds)
+        block_modulations = [None] * (len(self.double_stream_blocks) + len(self.single_stream_blocks))
+        if self.adaln_fused:
+            weight, bias, split_sizes = self.stacked_adaln_weights()
+            block_modulations = F.linear(F.silu(adaln_input), weight, bias).split(split_sizes, dim=-1)
+
+        hidden_states = hidden_states.reshape(batch_size, -1, pH, p, pW, p).permute(0, 2, 4, 3, 5, 1)
+        hidden_states = hidden_states.reshape(batch_size, pH * pW, -1)
+        image_tokens_seq_len = pH * pW
+        if image_tokens_masks is not None:
+            image_tokens_seq_len = image_tokens_masks.shape[1]
+            hidden_states = F.pad(hidden_states, (0, 0, 0, image_tokens_seq_len - pH * pW))
+        hidden_states = self.x_embedder(hidden_states)
+        initial_encoder_hidden_states_seq_len = initial_encoder_hidden_states.shape[1]
+
+        block_id = 0
+        for block in self.double_stream_blocks:
+            cur_encoder_hidden_states = torch.cat(
+                [initial_encoder_hidden_states, encoder_hidden_states[block_id]], dim=1
+            )
+            hidden_states, initial_encoder_hidden_states = block(
+                image_tokens = hidden_states,
+                image_tokens_masks = image_tokens_masks,
+                text_tokens = cur_encoder_hidden_states,
+                adaln_input = adaln_input,
+                rope = rope,
+                modulation = block_modulations[block_id],
+                text_tokens_masks = text_tokens_masks,
+            )
+            initial_encoder_hidden_states = initial_encoder_hidden_states[:, :initial_encoder_hidden_states_seq_len]
+            block_id += 1
+
+        # one sequence buffer for the single-stream part; every block writes its llama tokens behind the image and
+        # initial text tokens of the previous block's output instead of growing the sequence with `torch.cat`
+        hidden_states_seq_len = image_tokens_seq_len + initial_encoder_hidden_states_seq_len
+        llama_seq_len = encoder_hidden_states[block_id].shape[1]
+        tokens = hidden_states.new_empty(batch_size, hidden_states_seq_len + llama_seq_len, self.inner_dim)
+        tokens[:, :image_tokens_seq_len] = hidden_states
+        tokens[:, image_tokens_seq_len:hidden_states_seq_len] = initial_encoder_hidden_states
+        if image_tokens_masks is not None:
+            image_tokens_masks = F.pad(image_tokens_masks, (0, tokens.shape[1] - image_tokens_seq_len), value=1)
+        for block in self.single_stream_blocks:
+            tokens[:, hidden_states_seq_len:] = encoder_hidden_states[block_id]
+            tokens = block(
+                image_tokens = tokens,
+                image_tokens_masks = image_tokens_masks,
+                adaln_input = adaln_input,
+                rope = rope,
+                modulation = block_modulations[block_id],
+                text_tokens_masks = text_tokens_masks,
+            )
+            block_id += 1
+
+        output = self.final_layer(tokens[:, :pH * pW], adaln_input)
+        output = output.reshape(batch_size, pH, pW, p, p, -1).permute(0, 5, 1, 3, 2, 4)
+        return output.reshape(batch_size, -1, height, width)
@@ -0,0 +1,103 @@
+import math
+from typing import Any, Dict, Tuple
+import torch
+
+def allocator_stats(device: torch.device) -> Dict[str, int]:
+    """
+    Counters of the CUDA caching allocator that show allocation churn and fragmentation: the number of allocations
+    and frees so far, the allocated, reserved and inactive split (fragmented) bytes and the number of retries after
+    a failed cudaMalloc. Empty on other devices.
+    """
+    device = torch.device(device)
+    if device.type != "cuda":
+        return {}
+    stats = torch.cuda.memory_stats(device)
+    return {
+        "allocations": stats.get("allocation.all.allocated", 0),
+        "frees": stats.get("allocation.all.freed", 0),
+        "allocated_bytes": stats.get("allocated_bytes.all.current", 0),
+        "reserved_bytes": stats.get("reserved_bytes.all.current", 0),
+        "inactive_split_bytes": stats.get("inactive_split_bytes.all.current", 0),
+        "alloc_retries": stats.get("num_alloc_retries", 0),
+    }
+
+class BlockWorkspace:
+    """
+    Buffers reused by the in-place inference path of the transformer blocks: the modulated LayerNorm outputs and the
+    token sequences of the double- and single-stream blocks. There is one buffer per name, kept across blocks, steps
+    and requests and viewed in the shape of each call; it is only reallocated to grow or change dtype or device, so
+    a long-running worker holds one set of buffers of its largest shapes whatever mix of resolutions, batch sizes
+    and text lengths it serves. Every forward records the allocator counters before and after, see `stats()`.
+    """
+
+    def __init__(self):
+        self.buffers: Dict[str, torch.Tensor] = {}
+        self.forwards = 0
+        self.before: Dict[str, int] = {}
+        self.after: Dict[str, int] = {}
+
+    def buffer(self, name: str, shape: Tuple[int, ...], dtype: torch.dtype, device: torch.device) -> torch.Tensor:
+        numel = math.prod(shape)
+        flat = self.buffers.get(name)
+        if flat is None or flat.dtype != dtype or flat.device != torch.device(device) or flat.numel() < numel:
+            # released before allocating, so the allocator can reuse the old block for the new buffer
+            self.buffers.pop(name, None)
+            flat = None
+            self.buffers[name] = torch.empty(numel, dtype=dtype, device=device)
+        return self.buffers[name][:numel].view(shape)
+
+    def modulated_norm(
+        self, name: str, x: torch.Tensor, scale: torch.Tensor, shift: torch.Tensor, eps: float = 1e-6
+    ) -> torch.Tensor:
+        """
+        `layer_norm(x) * (1 + scale) + shift` written into the workspace buffer `name`. The statistics are
+        computed in float32 like `layer_norm`; apart from them, nothing of the size of `x` is allocated.
+        """
+        out = self.buffer(name, x.shape, x.dtype, x.device)
+        mean = x.mean(dim=-1, keepdim=True, dtype=torch.float32)
+        torch.sub(x, mean, out=out)
+        norm = torch.linalg.vector_norm(out, dim=-1, keepdim=True, dtype=torch.float32)
+        out.mul_(norm.square_().div_(x.shape[-1]).add_(eps).rsqrt_())
+        return torch.addcmul(shift, out, 1 + scale, out=out)
+
+    def tokens(self, name: str, head: torch.Tensor, tail: torch.Tensor) -> torch.Tensor:
+        """
+        `torch.cat([head, tail], dim=1)` in the workspace buffer `name`. `head` is not copied when it already is the
+        head of that buffer, e.g. the output of the previous block.
+        """
+        out = self.buffer(
+            name, (head.shape[0], head.shape[1] + tail.shape[1], *head.shape[2:]), head.dtype, head.device
+        )
+        out_head = out[:, :head.shape[1]]
+        if head.data_ptr() != out.data_ptr() or head.stride() != out_head.stride():
+            out_head.copy_(head)
+        out[:, head.shape[1]:] = tail
+        return out
+
+    def begin_forward(self, device: torch.device):
+        self.before = allocator_stats(device)
+
+    def end_forward(self, device: torch.device):
+        self.after = allocator_stats(device)
+        self.forwards += 1
+
+    @property
+    def nbytes(self) -> int:
+        return sum(buffer.numel() * buffer.element_size() for buffer in self.buffers.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Workspace size and the allocator counters before and after the last forward together with their difference,
+        e.g. the allocations a forward made.
+        """
+        return {
+            "buffers": len(self.buffers),
+            "workspace_bytes": self.nbytes,
+            "forwards": self.forwards,
+            "before": self.before,
+            "after": self.after,
+            "delta": {key: self.after[key] - self.before.get(key, 0) for key in self.after},
+        }
+
+    def clear(self):
+        self.buffers = {}
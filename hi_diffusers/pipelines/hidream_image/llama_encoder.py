@@ -0,0 +1,53 @@
+from typing import List, Optional
+import torch
+from torch import nn
+
+class _StopEncoding(Exception):
+    pass
+
+def _decoder(text_encoder: nn.Module) -> nn.Module:
+    # LlamaForCausalLM wraps the decoder stack in `.model`, a bare LlamaModel holds it itself
+    return getattr(text_encoder, "model", text_encoder)
+
+@torch.no_grad()
+def encode_llama_layers(
+    text_encoder: nn.Module,
+    input_ids: torch.Tensor,
+    attention_mask: Optional[torch.Tensor],
+    layers: List[int],
+) -> torch.Tensor:
+    """
+    Hidden states of the decoder layers `layers` of a Llama text encoder as a (len(layers), B, S, D) stack, in the
+    layout of `outputs.hidden_states[1:]`: entry k is the output of layer k and the last layer's output is passed
+    through the final norm. Forward hooks capture only these layers, the forward stops after the deepest of them,
+    and neither attention maps nor the LM head are computed. The forward runs through `text_encoder` itself, so
+    hooks on it, e.g. those of `enable_model_cpu_offload`, still apply.
+    """
+    decoder = _decoder(text_encoder)
+    num_layers = len(decoder.layers)
+    if not all(0 <= layer < num_layers for layer in layers):
+        raise ValueError(f"Layers {layers} out of range for a text encoder with {num_layers} layers")
+    deepest = max(layers)
+    captured = {}
+
+    def make_hook(layer):
+        def hook(module, args, output):
+            captured[layer] = output[0] if isinstance(output, tuple) else output
+            if layer == deepest:
+                raise _StopEncoding
+        return hook
+
+    handles = [decoder.layers[layer].register_forward_hook(make_hook(layer)) for layer in set(layers)]
+    try:
+        text_encoder(
+            input_ids, attention_mask=attention_mask, use_cache=False, output_hidden_states=False,
+            output_attentions=False,
+        )
+    except _StopEncoding:
+        pass
+    finally:
+        for handle in handles:
+            handle.remove()
+    if num_layers - 1 in captured:
+        captured[num_layers - 1] = decoder.norm(captured[num_layers - 1])
+    return torch.stack([captured[layer] for layer in layers], dim=0)
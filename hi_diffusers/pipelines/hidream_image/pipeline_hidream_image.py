@@ -1,5 +1,5 @@
 import inspect
-from typing import Any, Callable, Dict, List, Optional, Union
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import math
 import einops
 import torch
@@ -25,6 +25,11 @@ from diffusers.utils.torch_utils import randn_tensor
 from diffusers.pipelines.pipeline_utils import DiffusionPipeline
 from .pipeline_output import HiDreamImagePipelineOutput
 from ...models.transformers.transformer_hidream_image import HiDreamImageTransformer2DModel
+from ...models.static_compile import StaticCompileCache
+from .llama_encoder import encode_llama_layers
+from .prompt_cache import PromptEmbeddingCache, encoder_state
+from .text_buckets import bucket_length, concat_prompt_embeds, expand_prompt_embeds, repeat_prompt_embeds
+from .text_encoder_service import RemoteTextEncoder
 from ...schedulers.fm_solvers_unipc import FlowUniPCMultistepScheduler
 
 if is_torch_xla_available():
@@ -147,7 +152,40 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         # by the patch size. So the vae scale factor is multiplied by the patch size to account for this
         self.image_processor = VaeImageProcessor(vae_scale_factor=self.vae_scale_factor * 2)
         self.default_sample_size = 128
-        self.tokenizer_4.pad_token = self.tokenizer_4.eos_token
+        if self.tokenizer_4 is not None:
+            self.tokenizer_4.pad_token = self.tokenizer_4.eos_token
+        self.static_compile = None
+        self.prompt_cache = None
+        self._negative_prompt_embeds = {}
+        self.text_length_buckets = None
+        self.remote_text_encoder = None
+        self._step_conditioning_bytes = 0
+        self._skipped_steps = 0
+
+    def _tokenize(self, tokenizer, prompt: List[str], max_length: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        # prompts are tokenized once without truncation, so truncation shows in their length; only the prompts
+        # that are too long are tokenized again with truncation
+        input_ids = tokenizer(prompt, add_special_tokens=True)["input_ids"]
+        truncated = [i for i, ids in enumerate(input_ids) if len(ids) > max_length]
+        if truncated:
+            removed_text = tokenizer.batch_decode([input_ids[i][max_length - 1 : -1] for i in truncated])
+            logger.warning(
+                "The following part of your input was truncated because `max_sequence_length` is set to "
+                f" {max_length} tokens: {removed_text}"
+            )
+            truncated_ids = tokenizer(
+                [prompt[i] for i in truncated], max_length=max_length, truncation=True, add_special_tokens=True
+            )["input_ids"]
+            for i, ids in zip(truncated, truncated_ids):
+                input_ids[i] = ids
+
+        length = max_length
+        if self.text_length_buckets is not None:
+            length = bucket_length(max(len(ids) for ids in input_ids), self.text_length_buckets, max_length)
+        text_inputs = tokenizer.pad(
+            {"input_ids": input_ids}, padding="max_length", max_length=length, return_tensors="pt"
+        )
+        return text_inputs.input_ids, text_inputs.attention_mask
 
     def _get_t5_prompt_embeds(
         self,
@@ -156,6 +194,7 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         max_sequence_length: int = 128,
         device: Optional[torch.device] = None,
         dtype: Optional[torch.dtype] = None,
+        return_attention_mask: bool = False,
     ):
         device = device or self._execution_device
         dtype = dtype or self.text_encoder_3.dtype
@@ -163,24 +202,9 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         prompt = [prompt] if isinstance(prompt, str) else prompt
         batch_size = len(prompt)
 
-        text_inputs = self.tokenizer_3(
-            prompt,
-            padding="max_length",
-            max_length=min(max_sequence_length, self.tokenizer_3.model_max_length),
-            truncation=True,
-            add_special_tokens=True,
-            return_tensors="pt",
+        text_input_ids, attention_mask = self._tokenize(
+            self.tokenizer_3, prompt, min(max_sequence_length, self.tokenizer_3.model_max_length)
         )
-        text_input_ids = text_inputs.input_ids
-        attention_mask = text_inputs.attention_mask
-        untruncated_ids = self.tokenizer_3(prompt, padding="longest", return_tensors="pt").input_ids
-
-        if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not torch.equal(text_input_ids, untruncated_ids):
-            removed_text = self.tokenizer_3.batch_decode(untruncated_ids[:, min(max_sequence_length, self.tokenizer_3.model_max_length) - 1 : -1])
-            logger.warning(
-                "The following part of your input was truncated because `max_sequence_length` is set to "
-                f" {min(max_sequence_length, self.tokenizer_3.model_max_length)} tokens: {removed_text}"
-            )
 
         prompt_embeds = self.text_encoder_3(text_input_ids.to(device), attention_mask=attention_mask.to(device))[0]
         prompt_embeds = prompt_embeds.to(dtype=dtype, device=device)
@@ -189,6 +213,8 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         # duplicate text embeddings and attention mask for each generation per prompt, using mps friendly method
         prompt_embeds = prompt_embeds.repeat(1, num_images_per_prompt, 1)
         prompt_embeds = prompt_embeds.view(batch_size * num_images_per_prompt, seq_len, -1)
+        if return_attention_mask:
+            return prompt_embeds, attention_mask.to(device).repeat_interleave(num_images_per_prompt, dim=0)
         return prompt_embeds
     
     def _get_clip_prompt_embeds(
@@ -242,46 +268,43 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         max_sequence_length: int = 128,
         device: Optional[torch.device] = None,
         dtype: Optional[torch.dtype] = None,
+        return_attention_mask: bool = False,
+        llama_layers: Optional[List[int]] = None,
     ):
         device = device or self._execution_device
         dtype = dtype or self.text_encoder_4.dtype
+        if llama_layers is None and self.transformer is not None:
+            llama_layers = self.transformer.llama_layer_ids
 
         prompt = [prompt] if isinstance(prompt, str) else prompt
         batch_size = len(prompt)
 
-        text_inputs = self.tokenizer_4(
-            prompt,
-            padding="max_length",
-            max_length=min(max_sequence_length, self.tokenizer_4.model_max_length),
-            truncation=True,
-            add_special_tokens=True,
-            return_tensors="pt",
+        text_input_ids, attention_mask = self._tokenize(
+            self.tokenizer_4, prompt, min(max_sequence_length, self.tokenizer_4.model_max_length)
         )
-        text_input_ids = text_inputs.input_ids
-        attention_mask = text_inputs.attention_mask
-        untruncated_ids = self.tokenizer_4(prompt, padding="longest", return_tensors="pt").input_ids
 
-        if untruncated_ids.shape[-1] >= text_input_ids.shape[-1] and not torch.equal(text_input_ids, untruncated_ids):
-            removed_text = self.tokenizer_4.batch_decode(untruncated_ids[:, min(max_sequence_length, self.tokenizer_4.model_max_length) - 1 : -1])
-            logger.warning(
-                "The following part of your input was truncated because `max_sequence_length` is set to "
-                f" {min(max_sequence_length, self.tokenizer_4.model_max_length)} tokens: {removed_text}"
+        if llama_layers is not None:
+            # only the layers the transformer reads, see `HiDreamImageTransformer2DModel.llama_layer_ids`
+            prompt_embeds = encode_llama_layers(
+                self.text_encoder_4,
+                text_input_ids.to(device),
+                attention_mask.to(device),
+                llama_layers,
             )
-
-        outputs = self.text_encoder_4(
-            text_input_ids.to(device), 
-            attention_mask=attention_mask.to(device), 
-            output_hidden_states=True,
-            output_attentions=True
-        )
-
-        prompt_embeds = outputs.hidden_states[1:]
-        prompt_embeds = torch.stack(prompt_embeds, dim=0)
+        else:
+            outputs = self.text_encoder_4(
+                text_input_ids.to(device), 
+                attention_mask=attention_mask.to(device), 
+                output_hidden_states=True,
+            )
+            prompt_embeds = torch.stack(outputs.hidden_states[1:], dim=0)
         _, _, seq_len, dim = prompt_embeds.shape
 
         # duplicate text embeddings and attention mask for each generation per prompt, using mps friendly method
         prompt_embeds = prompt_embeds.repeat(1, 1, num_images_per_prompt, 1)
         prompt_embeds = prompt_embeds.view(-1, batch_size * num_images_per_prompt, seq_len, dim)
+        if return_attention_mask:
+            return prompt_embeds, attention_mask.to(device).repeat_interleave(num_images_per_prompt, dim=0)
         return prompt_embeds
     
     def encode_prompt(
@@ -353,21 +376,79 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
                     f" {prompt} has batch size {batch_size}. Please make sure that passed `negative_prompt` matches"
                     " the batch size of `prompt`."
                 )
-            
-            negative_prompt_embeds, negative_pooled_prompt_embeds = self._encode_prompt(
-                prompt = negative_prompt,
-                prompt_2 = negative_prompt_2,
-                prompt_3 = negative_prompt_3,
-                prompt_4 = negative_prompt_4,
-                device = device,
-                dtype = dtype,
-                num_images_per_prompt = num_images_per_prompt,
-                prompt_embeds = negative_prompt_embeds,
-                pooled_prompt_embeds = negative_pooled_prompt_embeds,
-                max_sequence_length = max_sequence_length,
-            )
+
+            negative_prompts = list(zip(negative_prompt, negative_prompt_2, negative_prompt_3, negative_prompt_4))
+            if len(set(negative_prompts)) == 1:
+                # one negative prompt for the whole batch is encoded for one sample and broadcast
+                negative_prompt_embeds, negative_pooled = self._constant_negative_prompt_embeds(
+                    negative_prompts[0], device, dtype, max_sequence_length
+                )
+                num_samples = batch_size * num_images_per_prompt
+                negative_prompt_embeds = expand_prompt_embeds(negative_prompt_embeds, num_samples)
+                negative_pooled_prompt_embeds = negative_pooled.expand(num_samples, -1)
+            else:
+                negative_prompt_embeds, negative_pooled_prompt_embeds = self._encode_prompt(
+                    prompt = negative_prompt,
+                    prompt_2 = negative_prompt_2,
+                    prompt_3 = negative_prompt_3,
+                    prompt_4 = negative_prompt_4,
+                    device = device,
+                    dtype = dtype,
+                    num_images_per_prompt = num_images_per_prompt,
+                    prompt_embeds = negative_prompt_embeds,
+                    pooled_prompt_embeds = negative_pooled_prompt_embeds,
+                    max_sequence_length = max_sequence_length,
+                )
         return prompt_embeds, negative_prompt_embeds, pooled_prompt_embeds, negative_pooled_prompt_embeds
 
+    def _constant_negative_prompt_embeds(
+        self,
+        negative_prompts: Tuple[str, str, str, str],
+        device: Optional[torch.device],
+        dtype: Optional[torch.dtype],
+        max_sequence_length: int,
+        store: bool = False,
+    ):
+        # only the prompts given to `precompute_negative_prompt_embeds` are kept, so free-text negative prompts do
+        # not accumulate on the device; replacing, moving or casting an encoder re-encodes them on their next use
+        device = device or self._execution_device
+        encoders = [self.text_encoder, self.text_encoder_2, self.text_encoder_3, self.text_encoder_4]
+        state = tuple(encoder_state(encoder) for encoder in encoders)
+        llama_layers = tuple(self.transformer.llama_layer_ids) if self.transformer is not None else None
+        buckets = tuple(self.text_length_buckets) if self.text_length_buckets is not None else None
+        key = (negative_prompts, max_sequence_length, str(dtype), str(device), llama_layers, buckets)
+        entry = self._negative_prompt_embeds.get(key)
+        if entry is not None and entry[0] == state:
+            return entry[1]
+        embeds = self._encode_prompt(
+            *[[prompt] for prompt in negative_prompts],
+            device = device,
+            dtype = dtype,
+            num_images_per_prompt = 1,
+            max_sequence_length = max_sequence_length,
+        )
+        if store or entry is not None:
+            self._negative_prompt_embeds[key] = (state, embeds)
+        return embeds
+
+    def precompute_negative_prompt_embeds(
+        self,
+        negative_prompts: List[str] = ("",),
+        max_sequence_length: int = 128,
+        device: Optional[torch.device] = None,
+        dtype: Optional[torch.dtype] = None,
+    ):
+        r"""
+        Encodes the negative prompts used for classifier-free guidance ahead of the first request, e.g. the empty
+        prompt at load time. Their embeddings stay on the device and are broadcast to the batch, and are re-encoded
+        when an encoder changes. Any other negative prompt shared by the whole batch is encoded once per request
+        (through the prompt cache, if enabled) and broadcast, but not kept.
+        """
+        for negative_prompt in negative_prompts:
+            self._constant_negative_prompt_embeds(
+                (negative_prompt,) * 4, device, dtype, max_sequence_length, store=True
+            )
+
     def _encode_prompt(
         self,
         prompt: Union[str, List[str]],
@@ -393,44 +474,101 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
             prompt_4 = prompt_4 or prompt
             prompt_4 = [prompt_4] if isinstance(prompt_4, str) else prompt_4
 
-            pooled_prompt_embeds_1 = self._get_clip_prompt_embeds(
-                self.tokenizer,
-                self.text_encoder,
-                prompt = prompt,
-                num_images_per_prompt = num_images_per_prompt,
-                max_sequence_length = max_sequence_length,
-                device = device,
-                dtype = dtype,
-            )
+            if self.prompt_cache is not None:
+                prompt_embeds, pooled_prompt_embeds = self.prompt_cache.encode(
+                    self,
+                    list(zip(prompt, prompt_2, prompt_3, prompt_4)),
+                    device = device,
+                    dtype = dtype,
+                    num_images_per_prompt = num_images_per_prompt,
+                    max_sequence_length = max_sequence_length,
+                )
+            else:
+                prompt_embeds, pooled_prompt_embeds = self._encode_prompt_embeds(
+                    prompt, prompt_2, prompt_3, prompt_4, device, dtype, num_images_per_prompt, max_sequence_length
+                )
+
+        return prompt_embeds, pooled_prompt_embeds
 
-            pooled_prompt_embeds_2 = self._get_clip_prompt_embeds(
-                self.tokenizer_2,
-                self.text_encoder_2,
-                prompt = prompt_2,
-                num_images_per_prompt = num_images_per_prompt,
-                max_sequence_length = max_sequence_length,
-                device = device,
-                dtype = dtype,
+    def _encode_prompt_embeds(
+        self,
+        prompt: List[str],
+        prompt_2: List[str],
+        prompt_3: List[str],
+        prompt_4: List[str],
+        device: torch.device,
+        dtype: Optional[torch.dtype] = None,
+        num_images_per_prompt: int = 1,
+        max_sequence_length: int = 128,
+        llama_layers: Optional[List[int]] = None,
+    ):
+        if self.remote_text_encoder is not None:
+            prompt_embeds, pooled_prompt_embeds = self.remote_text_encoder.encode(
+                list(zip(prompt, prompt_2, prompt_3, prompt_4)),
+                max_sequence_length,
+                llama_layers if llama_layers is not None else self.transformer.llama_layer_ids,
+                self.text_length_buckets,
+            )
+            # without local encoders the embeddings take the dtype of the transformer, the masks stay integer
+            dtype = dtype or self.transformer.dtype
+            prompt_embeds = [
+                x.to(device=device, dtype=dtype if x.is_floating_point() else x.dtype, non_blocking=True)
+                for x in prompt_embeds
+            ]
+            pooled_prompt_embeds = pooled_prompt_embeds.to(device=device, dtype=dtype, non_blocking=True)
+            return (
+                repeat_prompt_embeds(prompt_embeds, num_images_per_prompt),
+                pooled_prompt_embeds.repeat_interleave(num_images_per_prompt, dim=0),
             )
 
-            pooled_prompt_embeds = torch.cat([pooled_prompt_embeds_1, pooled_prompt_embeds_2], dim=-1)
+        pooled_prompt_embeds_1 = self._get_clip_prompt_embeds(
+            self.tokenizer,
+            self.text_encoder,
+            prompt = prompt,
+            num_images_per_prompt = num_images_per_prompt,
+            max_sequence_length = max_sequence_length,
+            device = device,
+            dtype = dtype,
+        )
+
+        pooled_prompt_embeds_2 = self._get_clip_prompt_embeds(
+            self.tokenizer_2,
+            self.text_encoder_2,
+            prompt = prompt_2,
+            num_images_per_prompt = num_images_per_prompt,
+            max_sequence_length = max_sequence_length,
+            device = device,
+            dtype = dtype,
+        )
 
-            t5_prompt_embeds = self._get_t5_prompt_embeds(
-                prompt = prompt_3,
-                num_images_per_prompt = num_images_per_prompt,
-                max_sequence_length = max_sequence_length,
-                device = device,
-                dtype = dtype
-            )
-            llama3_prompt_embeds = self._get_llama3_prompt_embeds(
-                prompt = prompt_4,
-                num_images_per_prompt = num_images_per_prompt,
-                max_sequence_length = max_sequence_length,
-                device = device,
-                dtype = dtype
+        pooled_prompt_embeds = torch.cat([pooled_prompt_embeds_1, pooled_prompt_embeds_2], dim=-1)
+
+        bucketed = self.text_length_buckets is not None
+        t5_prompt_embeds = self._get_t5_prompt_embeds(
+            prompt = prompt_3,
+            num_images_per_prompt = num_images_per_prompt,
+            max_sequence_length = max_sequence_length,
+            device = device,
+            dtype = dtype,
+            return_attention_mask = bucketed,
+        )
+        llama3_prompt_embeds = self._get_llama3_prompt_embeds(
+            prompt = prompt_4,
+            num_images_per_prompt = num_images_per_prompt,
+            max_sequence_length = max_sequence_length,
+            device = device,
+            dtype = dtype,
+            return_attention_mask = bucketed,
+            llama_layers = llama_layers,
+        )
+        if bucketed:
+            # the masks exclude the padding of the length bucket from attention in the transformer
+            (t5_prompt_embeds, t5_attention_mask), (llama3_prompt_embeds, llama3_attention_mask) = (
+                t5_prompt_embeds, llama3_prompt_embeds
             )
+            prompt_embeds = [t5_prompt_embeds, llama3_prompt_embeds, t5_attention_mask, llama3_attention_mask]
+        else:
             prompt_embeds = [t5_prompt_embeds, llama3_prompt_embeds]
-
         return prompt_embeds, pooled_prompt_embeds
 
     def enable_vae_slicing(self):
@@ -462,6 +600,64 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         """
         self.vae.disable_tiling()
 
+    def enable_prompt_cache(
+        self,
+        device_bytes: int = 256 * 2**20,
+        host_bytes: int = 2 * 2**30,
+        disk_dir: Optional[str] = None,
+        disk_bytes: Optional[int] = None,
+    ):
+        r"""
+        Caches the text embeddings of every prompt, so repeated prompts (several seeds, retries, the empty negative
+        prompt) skip the four text encoders. Entries live in a device LRU of `device_bytes`, then in pinned host
+        memory of `host_bytes` and, with `disk_dir`, in safetensors files of at most `disk_bytes` in total, see
+        `PromptEmbeddingCache`. `prompt_cache.stats()` reports the hit rate and the saved encoding time.
+        """
+        self.prompt_cache = PromptEmbeddingCache(device_bytes, host_bytes, disk_dir, disk_bytes)
+
+    def disable_prompt_cache(self):
+        self.prompt_cache = None
+
+    def enable_text_length_buckets(self, buckets: List[int] = (32, 64, 96, 128)):
+        r"""
+        Pads the T5 and Llama tokens of a batch to the smallest of `buckets` that holds its longest prompt instead of
+        to `max_sequence_length`, and masks the padding out of the attention of every transformer block. Short
+        prompts then run the text encoders and every block with a fraction of the text tokens. The released
+        checkpoints were run attending to the padding tokens, so outputs change slightly. Packed sequences are not
+        supported; the static compile cache compiles one graph per bucket.
+        """
+        self.text_length_buckets = sorted(buckets)
+
+    def disable_text_length_buckets(self):
+        self.text_length_buckets = None
+
+    def enable_remote_text_encoder(self, socket_path: str, **kwargs):
+        r"""
+        Encodes prompts with a `TextEncoderServer` listening on the Unix socket `socket_path` instead of the local
+        text encoders, so the pipeline can be loaded without them (`text_encoder=None`, ..., `tokenizer_4=None`).
+        The server batches the prompts of all its clients; the prompt cache and the precomputed negative prompt
+        embeddings apply on top. `kwargs` are passed to `RemoteTextEncoder`.
+        """
+        self.remote_text_encoder = RemoteTextEncoder(socket_path, **kwargs)
+
+    def disable_remote_text_encoder(self):
+        if self.remote_text_encoder is not None:
+            self.remote_text_encoder.close()
+        self.remote_text_encoder = None
+
+    def enable_static_compile(self, **compile_kwargs):
+        r"""
+        Runs the transformer through `forward_static`, compiled once per (resolution, batch) bucket with
+        `torch.compile(**compile_kwargs)`. Requests with packed sequences, the block cache, token merging, pipeline
+        parallelism or a LoRA scale use the regular forward. The compiled graph computes the step conditioning itself,
+        so `precompute_step_conditioning` does not apply. `static_compile.stats()` reports the graph breaks and compile
+        time per bucket.
+        """
+        self.static_compile = StaticCompileCache(**compile_kwargs)
+
+    def disable_static_compile(self):
+        self.static_compile = None
+
     def prepare_latents(
         self,
         batch_size,
@@ -507,6 +703,14 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
     @property
     def interrupt(self):
         return self._interrupt
+
+    @property
+    def step_conditioning_bytes(self):
+        return self._step_conditioning_bytes
+
+    @property
+    def skipped_steps(self):
+        return self._skipped_steps
     
     @torch.no_grad()
     def __call__(
@@ -537,7 +741,20 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         callback_on_step_end: Optional[Callable[[int, int, Dict], None]] = None,
         callback_on_step_end_tensor_inputs: List[str] = ["latents"],
         max_sequence_length: int = 128,
+        # runs the batch as one packed sequence without padding to `max_seq`; all images of a call share `height` and
+        # `width`, so packing images of mixed sizes needs a list of latents passed to the transformer directly
+        packed_sequences: bool = False,
+        precompute_step_conditioning: bool = False,
+        max_step_conditioning_bytes: int = 1 << 30,
+        guidance_interval: Optional[Tuple[float, float]] = None,
+        uncond_refresh_steps: int = 1,
+        uncond_reuse: str = "reuse",
     ):
+        if uncond_refresh_steps < 1:
+            raise ValueError(f"`uncond_refresh_steps` has to be at least 1 but is {uncond_refresh_steps}")
+        if uncond_reuse not in ("reuse", "extrapolate"):
+            raise ValueError(f"Unknown `uncond_reuse` {uncond_reuse}, expected 'reuse' or 'extrapolate'")
+
         height = height or self.default_sample_size * self.vae_scale_factor
         width = width or self.default_sample_size * self.vae_scale_factor
 
@@ -590,15 +807,13 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         )
 
         if self.do_classifier_free_guidance:
-            prompt_embeds_arr = []
-            for n, p in zip(negative_prompt_embeds, prompt_embeds):
-                if len(n.shape) == 3:
-                    prompt_embeds_arr.append(torch.cat([n, p], dim=0))
-                else:
-                    prompt_embeds_arr.append(torch.cat([n, p], dim=1))
-            prompt_embeds = prompt_embeds_arr
+            # negative and positive prompts of different length buckets are padded to the longer one
+            prompt_embeds = concat_prompt_embeds([negative_prompt_embeds, prompt_embeds])
             pooled_prompt_embeds = torch.cat([negative_pooled_prompt_embeds, pooled_prompt_embeds], dim=0)
 
+        # the caption projections only depend on the prompt, so they are computed once for all denoising steps
+        text_conditioning = self.transformer.prepare_text_conditioning(prompt_embeds, lora_scale=lora_scale)
+
         # 4. Prepare latent variables
         num_channels_latents = self.transformer.config.in_channels
         latents = self.prepare_latents(
@@ -612,25 +827,14 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
             latents,
         )
 
-        if latents.shape[-2] != latents.shape[-1]:
+        if latents.shape[-2] != latents.shape[-1] and not packed_sequences:
             B, C, H, W = latents.shape
             pH, pW = H // self.transformer.config.patch_size, W // self.transformer.config.patch_size
-
-            img_sizes = torch.tensor([pH, pW], dtype=torch.int64).reshape(-1)
-            img_ids = torch.zeros(pH, pW, 3)
-            img_ids[..., 1] = img_ids[..., 1] + torch.arange(pH)[:, None]
-            img_ids[..., 2] = img_ids[..., 2] + torch.arange(pW)[None, :]
-            img_ids = img_ids.reshape(pH * pW, -1)
-            img_ids_pad = torch.zeros(self.transformer.max_seq, 3)
-            img_ids_pad[:pH*pW, :] = img_ids
-
-            img_sizes = img_sizes.unsqueeze(0).to(latents.device) 
-            img_ids = img_ids_pad.unsqueeze(0).to(latents.device) 
-            if self.do_classifier_free_guidance:
-                img_sizes = img_sizes.repeat(2 * B, 1)
-                img_ids = img_ids.repeat(2 * B, 1, 1)
+            # position ids and the rope table are derived from `img_sizes` inside the transformer
+            img_sizes = [(pH, pW)] * (2 * B if self.do_classifier_free_guidance else B)
         else:
-            img_sizes = img_ids = None
+            img_sizes = None
+        img_ids = None
 
         # 5. Prepare timesteps
         mu = calculate_shift(self.transformer.max_seq)
@@ -649,44 +853,127 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         num_warmup_steps = max(len(timesteps) - num_inference_steps * self.scheduler.order, 0)
         self._num_timesteps = len(timesteps)
 
+        # the block residual cache of the transformer must not carry state over from the previous request
+        block_cache = self.transformer.block_cache
+        if block_cache is not None:
+            block_cache.reset(num_steps=len(timesteps))
+
+        static_compile = self.static_compile
+        if (
+            packed_sequences or block_cache is not None or self.transformer.token_merging is not None
+            or self.transformer.pipeline_parallel is not None or lora_scale is not None
+        ):
+            static_compile = None
+
+        # the schedule and the pooled embeddings are fixed now, so the timestep embeddings and adaLN modulations
+        # of all steps can be computed in one pass instead of inside every transformer call
+        schedule_conditioning = None
+        self._step_conditioning_bytes = 0
+        if precompute_step_conditioning and static_compile is not None:
+            logger.info("Static compile computes the step conditioning inside its graph; skipping the precompute.")
+        elif precompute_step_conditioning:
+            nbytes = self.transformer.schedule_conditioning_nbytes(
+                len(timesteps), pooled_prompt_embeds.shape[0], pooled_prompt_embeds.dtype
+            )
+            if nbytes <= max_step_conditioning_bytes:
+                schedule_conditioning = self.transformer.prepare_schedule_conditioning(timesteps, pooled_prompt_embeds)
+                self._step_conditioning_bytes = schedule_conditioning.nbytes
+                logger.info(f"Precomputed step conditioning for {len(timesteps)} steps: {nbytes / 2**20:.1f} MiB")
+            else:
+                logger.warning(
+                    f"Step conditioning needs {nbytes / 2**20:.1f} MiB, more than `max_step_conditioning_bytes`"
+                    f" ({max_step_conditioning_bytes / 2**20:.1f} MiB); computing it per step instead."
+                )
+
+        # CFG runs only for sigmas inside `guidance_interval` and the conditional branch alone outside it; inside,
+        # the unconditional prediction is recomputed every `uncond_refresh_steps` guided steps and reused or
+        # linearly extrapolated from the last two computed ones in between
+        step_sigmas = (timesteps.float() / self.scheduler.config.num_train_timesteps).tolist()
+        cond_batch = slice(latents.shape[0], None)
+        # selected once per request, so the static compile buckets see the same conditioning object in every step
+        cond_text_conditioning = None
+        num_guided_steps = 0
+        uncond_history = []
+
         # 6. Denoising loop
         with self.progress_bar(total=num_inference_steps) as progress_bar:
             for i, t in enumerate(timesteps):
                 if self.interrupt:
                     continue
 
+                guided = self.do_classifier_free_guidance and (
+                    guidance_interval is None or guidance_interval[0] <= step_sigmas[i] <= guidance_interval[1]
+                )
+                compute_uncond = guided and (not uncond_history or num_guided_steps % uncond_refresh_steps == 0)
+                num_guided_steps += guided
+                cond_only = self.do_classifier_free_guidance and not compute_uncond
+                step_text_conditioning = text_conditioning
+                if cond_only:
+                    if cond_text_conditioning is None:
+                        cond_text_conditioning = text_conditioning.select(cond_batch)
+                    step_text_conditioning = cond_text_conditioning
+                step_conditioning = schedule_conditioning[i] if schedule_conditioning is not None else None
+                if cond_only and step_conditioning is not None:
+                    step_conditioning = step_conditioning.select(cond_batch)
+                step_pooled_prompt_embeds = pooled_prompt_embeds[cond_batch] if cond_only else pooled_prompt_embeds
+                step_img_sizes = img_sizes[cond_batch] if cond_only and img_sizes is not None else img_sizes
+
                 # expand the latents if we are doing classifier free guidance
-                latent_model_input = torch.cat([latents] * 2) if self.do_classifier_free_guidance else latents
+                latent_model_input = torch.cat([latents] * 2) if compute_uncond else latents
                 # broadcast to batch dimension in a way that's compatible with ONNX/Core ML
                 timestep = t.expand(latent_model_input.shape[0])
 
-                if latent_model_input.shape[-2] != latent_model_input.shape[-1]:
-                    B, C, H, W = latent_model_input.shape
-                    patch_size = self.transformer.config.patch_size
-                    pH, pW = H // patch_size, W // patch_size
-                    out = torch.zeros(
-                        (B, C, self.transformer.max_seq, patch_size * patch_size), 
-                        dtype=latent_model_input.dtype, 
-                        device=latent_model_input.device
+                if static_compile is not None:
+                    # the compiled bucket pads non-square latents to `max_seq` itself
+                    noise_pred = static_compile(
+                        self.transformer, latent_model_input, timestep, step_pooled_prompt_embeds,
+                        step_text_conditioning,
                     )
-                    latent_model_input = einops.rearrange(latent_model_input, 'B C (H p1) (W p2) -> B C (H W) (p1 p2)', p1=patch_size, p2=patch_size)
-                    out[:, :, 0:pH*pW] = latent_model_input
-                    latent_model_input = out
-
-                noise_pred = self.transformer(
-                    hidden_states = latent_model_input,
-                    timesteps = timestep,
-                    encoder_hidden_states = prompt_embeds,
-                    pooled_embeds = pooled_prompt_embeds,
-                    img_sizes = img_sizes,
-                    img_ids = img_ids,
-                    return_dict = False,
-                )[0]
+                else:
+                    if packed_sequences:
+                        # the transformer packs a list of latents without padding them to `max_seq`
+                        latent_model_input = list(latent_model_input)
+                    elif latent_model_input.shape[-2] != latent_model_input.shape[-1]:
+                        B, C, H, W = latent_model_input.shape
+                        patch_size = self.transformer.config.patch_size
+                        pH, pW = H // patch_size, W // patch_size
+                        out = torch.zeros(
+                            (B, C, self.transformer.max_seq, patch_size * patch_size), 
+                            dtype=latent_model_input.dtype, 
+                            device=latent_model_input.device
+                        )
+                        latent_model_input = einops.rearrange(latent_model_input, 'B C (H p1) (W p2) -> B C (H W) (p1 p2)', p1=patch_size, p2=patch_size)
+                        out[:, :, 0:pH*pW] = latent_model_input
+                        latent_model_input = out
+
+                    noise_pred = self.transformer(
+                        hidden_states = latent_model_input,
+                        timesteps = timestep,
+                        encoder_hidden_states = prompt_embeds,
+                        pooled_embeds = step_pooled_prompt_embeds,
+                        img_sizes = step_img_sizes,
+                        img_ids = img_ids,
+                        return_dict = False,
+                        text_conditioning = step_text_conditioning,
+                        step_conditioning = step_conditioning,
+                    )[0]
+                    if packed_sequences:
+                        noise_pred = torch.stack(noise_pred)
                 noise_pred = -noise_pred
 
                 # perform guidance
-                if self.do_classifier_free_guidance:
+                if compute_uncond:
                     noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+                    if uncond_refresh_steps > 1:
+                        uncond_history = [(i, noise_pred_uncond), *uncond_history[:1]]
+                    noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
+                elif guided:
+                    noise_pred_text = noise_pred
+                    (last_step, noise_pred_uncond), *previous = uncond_history
+                    if uncond_reuse == "extrapolate" and previous:
+                        previous_step, previous_uncond = previous[0]
+                        slope = (noise_pred_uncond - previous_uncond) / (last_step - previous_step)
+                        noise_pred_uncond = noise_pred_uncond + slope * (i - last_step)
                     noise_pred = noise_pred_uncond + self.guidance_scale * (noise_pred_text - noise_pred_uncond)
 
                 # compute the previous noisy sample x_t -> x_t-1
@@ -705,7 +992,12 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
                     callback_outputs = callback_on_step_end(self, i, t, callback_kwargs)
 
                     latents = callback_outputs.pop("latents", latents)
-                    prompt_embeds = callback_outputs.pop("prompt_embeds", prompt_embeds)
+                    if "prompt_embeds" in callback_outputs:
+                        prompt_embeds = callback_outputs.pop("prompt_embeds")
+                        text_conditioning = self.transformer.prepare_text_conditioning(
+                            prompt_embeds, lora_scale=lora_scale
+                        )
+                        cond_text_conditioning = None
                     negative_prompt_embeds = callback_outputs.pop("negative_prompt_embeds", negative_prompt_embeds)
 
                 # call the callback, if provided
@@ -715,6 +1007,11 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
                 if XLA_AVAILABLE:
                     xm.mark_step()
 
+        skipped_steps = block_cache.skipped_steps if block_cache is not None else 0
+        self._skipped_steps = skipped_steps
+        if block_cache is not None:
+            logger.info(f"Block cache skipped {skipped_steps} of {len(timesteps)} steps")
+
         if output_type == "latent":
             image = latents
 
@@ -730,4 +1027,4 @@ class HiDreamImagePipeline(DiffusionPipeline, FromSingleFileMixin):
         if not return_dict:
             return (image,)
 
-        return HiDreamImagePipelineOutput(images=image)
\ No newline at end of file
+        return HiDreamImagePipelineOutput(images=image, skipped_steps=skipped_steps)
\ No newline at end of file
@@ -16,6 +16,9 @@ class HiDreamImagePipelineOutput(BaseOutput):
         images (`List[PIL.Image.Image]` or `np.ndarray`)
             List of denoised PIL images of length `batch_size` or numpy array of shape `(batch_size, height, width,
             num_channels)`. PIL images or numpy array present the denoised images of the diffusion pipeline.
+        skipped_steps (`int`)
+            Number of denoising steps of this request the block cache skipped; 0 without the block cache.
     """
 
-    images: Union[List[PIL.Image.Image], np.ndarray]
\ No newline at end of file
+    images: Union[List[PIL.Image.Image], np.ndarray]
+    skipped_steps: int = 0
\ No newline at end of file
@@ -0,0 +1,260 @@
+import hashlib
+import os
+import time
+import weakref
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import torch
+from torch import nn
+from .text_buckets import PROMPT_EMBEDS_NAMES, concat_prompt_embeds, repeat_prompt_embeds, select_prompt_embeds
+
+# the embeddings of one prompt: T5 (1, S, D), Llama layer stack (L, 1, S, D) and pooled CLIP (1, D), for
+# length-bucketed prompts also the (1, S) masks of the T5 and Llama tokens
+PromptEntry = Dict[str, torch.Tensor]
+
+def _entry_nbytes(entry: PromptEntry) -> int:
+    return sum(tensor.numel() * tensor.element_size() for tensor in entry.values())
+
+def encoder_state(module: Optional[nn.Module]) -> Optional[Tuple]:
+    """
+    Cheap identity of the current weights of a module, without reading them: it changes when the module is replaced,
+    moved, cast, or its first or last parameter is reassigned or modified in place.
+    """
+    if module is None:
+        return None
+    params = list(module.parameters())
+    ends = [params[0], params[-1]] if params else []
+    return (id(module), *[(param.data_ptr(), param._version, param.dtype) for param in ends])
+
+class _BytesLRU:
+    """Entries in least recently used order with their total size in bytes."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: "OrderedDict[str, PromptEntry]" = OrderedDict()
+        self.nbytes = 0
+
+    def get(self, key: str) -> Optional[PromptEntry]:
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.entries.move_to_end(key)
+        return entry
+
+    def put(self, key: str, entry: PromptEntry) -> List[Tuple[str, PromptEntry]]:
+        """Inserts `entry` and returns the entries evicted to stay within `max_bytes`."""
+        self.pop(key)
+        self.entries[key] = entry
+        self.nbytes += _entry_nbytes(entry)
+        evicted = []
+        while self.nbytes > self.max_bytes:
+            evicted_key, evicted_entry = self.entries.popitem(last=False)
+            self.nbytes -= _entry_nbytes(evicted_entry)
+            evicted.append((evicted_key, evicted_entry))
+        return evicted
+
+    def pop(self, key: str) -> Optional[PromptEntry]:
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.nbytes -= _entry_nbytes(entry)
+        return entry
+
+class PromptEmbeddingCache:
+    """
+    Cache of the text embeddings of single prompts in three tiers: a least recently used tier in device memory of
+    at most `device_bytes`, a (pinned) host memory tier of at most `host_bytes` that receives the entries evicted from
+    the device, and an optional directory of safetensors files, written on insertion and limited to `disk_bytes`
+    (unlimited if None) by removing the least recently used files. Hits are promoted to the device tier.
+
+    Entries are keyed by the prompt of every encoder, `max_sequence_length`, the dtype, the Llama layers the
+    transformer reads, the text length buckets and a fingerprint of the weights of every text encoder, so changing any of them misses.
+    `stats()` reports the hits per tier, the hit rate and the encoder time the hits saved, estimated from the
+    measured encoding time per prompt.
+    """
+
+    def __init__(
+        self,
+        device_bytes: int = 256 * 2**20,
+        host_bytes: int = 2 * 2**30,
+        disk_dir: Optional[str] = None,
+        disk_bytes: Optional[int] = None,
+    ):
+        self.device_tier = _BytesLRU(device_bytes)
+        self.host_tier = _BytesLRU(host_bytes)
+        self.disk_dir = disk_dir
+        self.disk_bytes = disk_bytes
+        if disk_dir is not None:
+            # safetensors ships with transformers and diffusers, but is only needed for the disk tier
+            import safetensors.torch  # noqa: F401
+            os.makedirs(disk_dir, exist_ok=True)
+        self.pin_memory = torch.cuda.is_available()
+        self._fingerprints = weakref.WeakKeyDictionary()
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.hits = {"device": 0, "host": 0, "disk": 0}
+        self.misses = 0
+        self.encode_time = 0.0
+
+    @property
+    def time_per_prompt(self) -> float:
+        return self.encode_time / self.misses if self.misses else 0.0
+
+    def stats(self) -> Dict[str, Any]:
+        hits = sum(self.hits.values())
+        lookups = hits + self.misses
+        return {
+            "lookups": lookups,
+            "hits": dict(self.hits),
+            "misses": self.misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "saved_time": hits * self.time_per_prompt,
+            "device_bytes": self.device_tier.nbytes,
+            "host_bytes": self.host_tier.nbytes,
+        }
+
+    def clear(self, disk: bool = False):
+        self.device_tier = _BytesLRU(self.device_tier.max_bytes)
+        self.host_tier = _BytesLRU(self.host_tier.max_bytes)
+        self._fingerprints = weakref.WeakKeyDictionary()
+        if disk and self.disk_dir is not None:
+            for path, _, _ in self._disk_files():
+                os.remove(path)
+
+    @torch.no_grad()
+    def fingerprint(self, module: Optional[nn.Module]) -> str:
+        """
+        Identity of the weights of a text encoder: its checkpoint name, dtype, parameter count and a checksum of a
+        sample of its first and last parameter. Computed once per module; call `clear` after changing weights in
+        place.
+        """
+        if module is None:
+            return "none"
+        if module not in self._fingerprints:
+            params = list(module.parameters())
+            # a strided sample of the parameters, reading all of them would cost as much as an encoder forward
+            checksum = [
+                float(params[i].detach().flatten()[::max(1, params[i].numel() // 4096)].double().sum())
+                for i in (0, -1)
+            ] if params else []
+            self._fingerprints[module] = repr((
+                type(module).__name__,
+                getattr(getattr(module, "config", None), "_name_or_path", None),
+                str(module.dtype) if hasattr(module, "dtype") else None,
+                sum(param.numel() for param in params),
+                checksum,
+            ))
+        return self._fingerprints[module]
+
+    def key(self, pipeline, prompts: Sequence[str], max_sequence_length: int, dtype: Optional[torch.dtype]) -> str:
+        encoders = [pipeline.text_encoder, pipeline.text_encoder_2, pipeline.text_encoder_3, pipeline.text_encoder_4]
+        llama_layers = pipeline.transformer.llama_layer_ids if pipeline.transformer is not None else None
+        key = repr((
+            tuple(prompts), max_sequence_length, str(dtype), llama_layers, pipeline.text_length_buckets,
+            [self.fingerprint(encoder) for encoder in encoders],
+        ))
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+    def _disk_path(self, key: str) -> str:
+        return os.path.join(self.disk_dir, f"{key}.safetensors")
+
+    def _disk_files(self):
+        for entry in os.scandir(self.disk_dir):
+            if entry.name.endswith(".safetensors"):
+                stat = entry.stat()
+                yield entry.path, stat.st_mtime, stat.st_size
+
+    def _write_disk(self, key: str, entry: PromptEntry):
+        from safetensors.torch import save_file
+        path = self._disk_path(key)
+        save_file({name: tensor.detach().cpu().contiguous() for name, tensor in entry.items()}, path + ".tmp")
+        os.replace(path + ".tmp", path)
+        if self.disk_bytes is not None:
+            files = sorted(self._disk_files(), key=lambda file: file[1])
+            total = sum(size for _, _, size in files)
+            for path, _, size in files:
+                if total <= self.disk_bytes:
+                    break
+                os.remove(path)
+                total -= size
+
+    def _to_host(self, entry: PromptEntry) -> PromptEntry:
+        host = {name: tensor.to("cpu") for name, tensor in entry.items()}
+        if self.pin_memory:
+            host = {name: tensor.pin_memory() for name, tensor in host.items()}
+        return host
+
+    def _put_device(self, key: str, entry: PromptEntry):
+        for evicted_key, evicted_entry in self.device_tier.put(key, entry):
+            self.host_tier.put(evicted_key, self._to_host(evicted_entry))
+
+    def get(self, key: str, device: torch.device) -> Optional[PromptEntry]:
+        entry = self.device_tier.get(key)
+        if entry is not None:
+            self.hits["device"] += 1
+            return entry
+        entry = self.host_tier.pop(key)
+        tier = "host"
+        if entry is None and self.disk_dir is not None and os.path.exists(self._disk_path(key)):
+            from safetensors.torch import load_file
+            entry = load_file(self._disk_path(key))
+            os.utime(self._disk_path(key))
+            tier = "disk"
+        if entry is None:
+            return None
+        self.hits[tier] += 1
+        entry = {name: tensor.to(device, non_blocking=True) for name, tensor in entry.items()}
+        self._put_device(key, entry)
+        return entry
+
+    def put(self, key: str, entry: PromptEntry):
+        self._put_device(key, entry)
+        if self.disk_dir is not None:
+            self._write_disk(key, entry)
+
+    def encode(
+        self,
+        pipeline,
+        prompts: List[Sequence[str]],
+        device: torch.device,
+        dtype: Optional[torch.dtype],
+        num_images_per_prompt: int,
+        max_sequence_length: int,
+    ) -> Tuple[List[torch.Tensor], torch.Tensor]:
+        """
+        `prompt_embeds` and `pooled_prompt_embeds` of a batch; `prompts` holds the prompts of the four encoders of
+        every sample. Prompts missing from the cache are encoded together by `pipeline._encode_prompt_embeds`.
+        """
+        keys = [self.key(pipeline, sample, max_sequence_length, dtype) for sample in prompts]
+        entries = {}
+        for key in keys:
+            if key not in entries:
+                entries[key] = self.get(key, device)
+        missing = [key for key, entry in entries.items() if entry is None]
+        if missing:
+            samples = [prompts[keys.index(key)] for key in missing]
+            start = time.perf_counter()
+            prompt_embeds, pooled = pipeline._encode_prompt_embeds(
+                *[list(texts) for texts in zip(*samples)],
+                device = device,
+                dtype = dtype,
+                num_images_per_prompt = 1,
+                max_sequence_length = max_sequence_length,
+            )
+            if pooled.device.type == "cuda":
+                torch.cuda.synchronize(pooled.device)
+            self.encode_time += time.perf_counter() - start
+            self.misses += len(missing)
+            for i, key in enumerate(missing):
+                # clones, so an entry does not keep the embeddings of the whole batch alive
+                sample = select_prompt_embeds(prompt_embeds, slice(i, i + 1))
+                entries[key] = {name: x.clone() for name, x in zip(PROMPT_EMBEDS_NAMES, sample)}
+                entries[key]["pooled"] = pooled[i:i + 1].clone()
+                self.put(key, entries[key])
+
+        batch = [{name: tensor.to(device) for name, tensor in entries[key].items()} for key in keys]
+        # entries encoded in different batches can have different length buckets
+        prompt_embeds = concat_prompt_embeds(
+            [[entry[name] for name in PROMPT_EMBEDS_NAMES if name in entry] for entry in batch]
+        )
+        pooled = torch.cat([entry["pooled"] for entry in batch], dim=0).repeat_interleave(num_images_per_prompt, dim=0)
+        return repeat_prompt_embeds(prompt_embeds, num_images_per_prompt), pooled
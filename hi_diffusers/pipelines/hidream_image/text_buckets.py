@@ -0,0 +1,58 @@
+from typing import List, Sequence
+import torch
+import torch.nn.functional as F
+
+# `prompt_embeds` are [T5 (B, S, D), Llama stack (L, B, S, D)] or, for length-bucketed prompts, additionally the
+# (B, S) attention masks of the T5 and the Llama tokens
+PROMPT_EMBEDS_NAMES = ["t5", "llama", "t5_mask", "llama_mask"]
+
+def bucket_length(length: int, buckets: Sequence[int], max_length: int) -> int:
+    """The smallest bucket that holds `length` tokens, at most `max_length`."""
+    return min([bucket for bucket in buckets if bucket >= length] + [max_length])
+
+def batch_dim(x: torch.Tensor) -> int:
+    # the Llama stack has the layers in front of the batch
+    return 1 if x.dim() == 4 else 0
+
+def select_prompt_embeds(prompt_embeds: List[torch.Tensor], batch: slice) -> List[torch.Tensor]:
+    return [x.narrow(batch_dim(x), batch.start, batch.stop - batch.start) for x in prompt_embeds]
+
+def repeat_prompt_embeds(prompt_embeds: List[torch.Tensor], repeats: int) -> List[torch.Tensor]:
+    return [x.repeat_interleave(repeats, dim=batch_dim(x)) for x in prompt_embeds]
+
+def expand_prompt_embeds(prompt_embeds: List[torch.Tensor], batch_size: int) -> List[torch.Tensor]:
+    """Broadcasts the `prompt_embeds` of one sample to `batch_size` samples without copying them."""
+    return [x.expand(*[batch_size if dim == batch_dim(x) else -1 for dim in range(x.dim())]) for x in prompt_embeds]
+
+def _pad_prompt_embeds(
+    prompt_embeds: List[torch.Tensor], t5_length: int, llama_length: int
+) -> List[torch.Tensor]:
+    t5, llama = prompt_embeds[:2]
+    if len(prompt_embeds) == 4:
+        t5_mask, llama_mask = prompt_embeds[2:]
+    else:
+        t5_mask = torch.ones(t5.shape[:2], dtype=torch.int64, device=t5.device)
+        llama_mask = torch.ones(llama.shape[1:3], dtype=torch.int64, device=llama.device)
+    t5_padding, llama_padding = t5_length - t5.shape[1], llama_length - llama.shape[2]
+    return [
+        F.pad(t5, (0, 0, 0, t5_padding)),
+        F.pad(llama, (0, 0, 0, llama_padding)),
+        F.pad(t5_mask, (0, t5_padding)),
+        F.pad(llama_mask, (0, llama_padding)),
+    ]
+
+def concat_prompt_embeds(prompt_embeds: List[List[torch.Tensor]]) -> List[torch.Tensor]:
+    """
+    Concatenates the `prompt_embeds` of several batches along the batch, e.g. the negative and the positive prompts
+    of a CFG batch. If any of them is masked or the token counts differ, the shorter ones are padded with masked
+    tokens and the result holds the masks.
+    """
+    t5_length = max(embeds[0].shape[1] for embeds in prompt_embeds)
+    llama_length = max(embeds[1].shape[2] for embeds in prompt_embeds)
+    masked = any(
+        len(embeds) == 4 or embeds[0].shape[1] != t5_length or embeds[1].shape[2] != llama_length
+        for embeds in prompt_embeds
+    )
+    if masked:
+        prompt_embeds = [_pad_prompt_embeds(embeds, t5_length, llama_length) for embeds in prompt_embeds]
+    return [torch.cat(parts, dim=batch_dim(parts[0])) for parts in zip(*prompt_embeds)]
@@ -0,0 +1,268 @@
+import json
+import math
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+import time
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+import torch
+from .text_buckets import select_prompt_embeds
+
+# a message is a length-prefixed JSON header followed by the raw bytes of the tensors it describes
+
+def _recv_exactly(sock: socket.socket, nbytes: int) -> bytearray:
+    buffer = bytearray(nbytes)
+    view = memoryview(buffer)
+    received = 0
+    while received < nbytes:
+        count = sock.recv_into(view[received:], nbytes - received)
+        if count == 0:
+            raise ConnectionError("Connection closed")
+        received += count
+    return buffer
+
+def send_message(sock: socket.socket, header: Dict[str, Any], tensors: Sequence[torch.Tensor] = ()):
+    tensors = [x.detach().cpu().contiguous() for x in tensors]
+    header = dict(header, tensors=[{"shape": list(x.shape), "dtype": str(x.dtype).split(".")[-1]} for x in tensors])
+    data = json.dumps(header).encode("utf-8")
+    sock.sendall(struct.pack("!Q", len(data)) + data)
+    for x in tensors:
+        if x.numel() > 0:
+            sock.sendall(x.reshape(-1).view(torch.uint8).numpy())
+
+def recv_message(sock: socket.socket) -> Tuple[Dict[str, Any], List[torch.Tensor]]:
+    (length,) = struct.unpack("!Q", _recv_exactly(sock, 8))
+    header = json.loads(_recv_exactly(sock, length))
+    tensors = []
+    for spec in header.pop("tensors"):
+        dtype = getattr(torch, spec["dtype"])
+        numel = math.prod(spec["shape"])
+        if numel == 0:
+            tensors.append(torch.empty(spec["shape"], dtype=dtype))
+            continue
+        data = _recv_exactly(sock, numel * torch.empty((), dtype=dtype).element_size())
+        tensors.append(torch.frombuffer(data, dtype=dtype).view(spec["shape"]))
+    return header, tensors
+
+@dataclass
+class _EncodeRequest:
+    prompts: List[Tuple[str, str, str, str]]
+    max_sequence_length: int
+    llama_layers: Optional[Tuple[int, ...]]
+    text_length_buckets: Optional[Tuple[int, ...]]
+    result: Future = field(default_factory=Future)
+
+    @property
+    def key(self) -> Tuple:
+        # requests are only batched with requests that encode the same way
+        return (self.max_sequence_length, self.llama_layers, self.text_length_buckets)
+
+class _ConnectionHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server.text_encoder_server
+        while True:
+            try:
+                header, _ = recv_message(self.request)
+            except ConnectionError:
+                return
+            request = _EncodeRequest(
+                prompts = [tuple(prompts) for prompts in header["prompts"]],
+                max_sequence_length = header["max_sequence_length"],
+                llama_layers = tuple(header["llama_layers"]) if header["llama_layers"] is not None else None,
+                text_length_buckets = (
+                    tuple(header["text_length_buckets"]) if header["text_length_buckets"] is not None else None
+                ),
+            )
+            server.requests.put(request)
+            try:
+                prompt_embeds, pooled_prompt_embeds = request.result.result()
+            except Exception as error:
+                send_message(self.request, {"error": f"{type(error).__name__}: {error}"})
+                continue
+            send_message(self.request, {"error": None}, [*prompt_embeds, pooled_prompt_embeds])
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class TextEncoderServer:
+    """
+    Serves the four text encoders of a `HiDreamImagePipeline` to the workers of a host over a Unix socket, so the
+    workers only load the transformer and the VAE (see `HiDreamImagePipeline.enable_remote_text_encoder`). The
+    requests of all connections that arrive within `batch_timeout` seconds of each other, up to `max_batch_size`
+    prompts, are encoded in one batch per (`max_sequence_length`, Llama layers, length buckets), and the
+    embeddings are returned as raw tensor bytes. `stats()` reports the requests, prompts and batches served.
+    """
+
+    def __init__(
+        self,
+        pipeline,
+        socket_path: str,
+        max_batch_size: int = 32,
+        batch_timeout: float = 0.01,
+    ):
+        self.pipeline = pipeline
+        self.socket_path = socket_path
+        self.max_batch_size = max_batch_size
+        self.batch_timeout = batch_timeout
+        self.requests: "queue.Queue[_EncodeRequest]" = queue.Queue()
+        self.num_requests = 0
+        self.num_prompts = 0
+        self.num_batches = 0
+        self.encode_time = 0.0
+
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+        self.server = _UnixServer(socket_path, _ConnectionHandler)
+        self.server.text_encoder_server = self
+        self._closed = threading.Event()
+        self._batcher = threading.Thread(target=self._batch_loop, daemon=True)
+        self._batcher.start()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requests": self.num_requests,
+            "prompts": self.num_prompts,
+            "batches": self.num_batches,
+            "mean_batch_size": self.num_prompts / self.num_batches if self.num_batches else 0.0,
+            "encode_time": self.encode_time,
+        }
+
+    def serve_forever(self):
+        self.server.serve_forever()
+
+    def shutdown(self):
+        self._closed.set()
+        self.server.shutdown()
+        self.server.server_close()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+    def _batch_loop(self):
+        while not self._closed.is_set():
+            try:
+                pending = [self.requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.batch_timeout
+            while sum(len(request.prompts) for request in pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self.requests.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            groups: Dict[Tuple, List[_EncodeRequest]] = {}
+            for request in pending:
+                groups.setdefault(request.key, []).append(request)
+            for requests in groups.values():
+                self._encode(requests)
+
+    @torch.no_grad()
+    def _encode_prompts(self, prompts, max_sequence_length, llama_layers, text_length_buckets):
+        # the batcher is the only thread that runs the encoders; the buckets of the client apply to this batch only
+        pipeline_buckets = self.pipeline.text_length_buckets
+        self.pipeline.text_length_buckets = list(text_length_buckets) if text_length_buckets is not None else None
+        try:
+            prompt_embeds, pooled_prompt_embeds = self.pipeline._encode_prompt_embeds(
+                *[list(texts) for texts in zip(*prompts)],
+                device = self.pipeline._execution_device,
+                num_images_per_prompt = 1,
+                max_sequence_length = max_sequence_length,
+                llama_layers = list(llama_layers) if llama_layers is not None else None,
+            )
+        finally:
+            self.pipeline.text_length_buckets = pipeline_buckets
+        return [x.cpu() for x in prompt_embeds], pooled_prompt_embeds.cpu()
+
+    def _encode(self, requests: List[_EncodeRequest]):
+        prompts = [prompt for request in requests for prompt in request.prompts]
+        start = time.perf_counter()
+        try:
+            prompt_embeds, pooled_prompt_embeds = self._encode_prompts(prompts, *requests[0].key)
+        except Exception as error:
+            if len(requests) == 1:
+                requests[0].result.set_exception(error)
+                return
+            # the batch holds requests of several clients, each is encoded on its own so only the failing ones fail
+            for request in requests:
+                self._encode([request])
+            return
+        self.encode_time += time.perf_counter() - start
+
+        self.num_requests += len(requests)
+        self.num_prompts += len(prompts)
+        self.num_batches += 1
+        start = 0
+        for request in requests:
+            batch = slice(start, start + len(request.prompts))
+            request.result.set_result((select_prompt_embeds(prompt_embeds, batch), pooled_prompt_embeds[batch]))
+            start = batch.stop
+
+class RemoteTextEncoder:
+    """
+    Client of a `TextEncoderServer`. Requests are sent one at a time over one connection; the connection is opened on
+    first use, waiting up to `connect_timeout` seconds for the server to come up, and reopened after an error.
+    """
+
+    def __init__(self, socket_path: str, timeout: Optional[float] = 300.0, connect_timeout: float = 600.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self._sock: Optional[socket.socket] = None
+        self._lock = threading.Lock()
+
+    def _connect(self) -> socket.socket:
+        deadline = time.monotonic() + self.connect_timeout
+        while True:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                sock.connect(self.socket_path)
+            except (FileNotFoundError, ConnectionRefusedError):
+                sock.close()
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(1.0)
+                continue
+            sock.settimeout(self.timeout)
+            return sock
+
+    def close(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def encode(
+        self,
+        prompts: List[Sequence[str]],
+        max_sequence_length: int,
+        llama_layers: Optional[List[int]] = None,
+        text_length_buckets: Optional[List[int]] = None,
+    ) -> Tuple[List[torch.Tensor], torch.Tensor]:
+        """
+        `prompt_embeds` and `pooled_prompt_embeds` on the host of a batch, one embedding per sample; `prompts` holds
+        the prompts of the four encoders of every sample.
+        """
+        header = {
+            "prompts": [list(sample) for sample in prompts],
+            "max_sequence_length": max_sequence_length,
+            "llama_layers": list(llama_layers) if llama_layers is not None else None,
+            "text_length_buckets": list(text_length_buckets) if text_length_buckets is not None else None,
+        }
+        with self._lock:
+            if self._sock is None:
+                self._sock = self._connect()
+            try:
+                send_message(self._sock, header)
+                response, tensors = recv_message(self._sock)
+            except OSError:
+                self.close()
+                raise
+        if response["error"] is not None:
+            raise RuntimeError(f"Text encoder service failed: {response['error']}")
+        return tensors[:-1], tensors[-1]
@@ -61,7 +61,6 @@ def load_models(model_type):
     text_encoder_4 = LlamaForCausalLM.from_pretrained(
         LLAMA_MODEL_NAME,
         output_hidden_states=True,
-        output_attentions=True,
         torch_dtype=torch.bfloat16).to("cuda")
 
     transformer = HiDreamImageTransformer2DModel.from_pretrained(
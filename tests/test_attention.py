@@ -0,0 +1,99 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from hi_diffusers.models import attention_processor
+from hi_diffusers.models.attention_processor import (
+    _ATTENTION_CONFIG,
+    _flash_attn_with_key_mask,
+    attention,
+    benchmark_attention_backends,
+    get_attention_backend,
+    select_fastest_attention_backend,
+)
+
+LENGTHS = [5, 9]
+
+
+@pytest.fixture(autouse=True)
+def restore_attention_config():
+    config = dict(_ATTENTION_CONFIG)
+    yield
+    _ATTENTION_CONFIG.update(config)
+
+
+def _padded_batch(seed=0):
+    """Query/key/value of samples with `LENGTHS` keys, padded with garbage keys to the longest, and its key mask."""
+    generator = torch.Generator().manual_seed(seed)
+    seq_len, heads, head_dim = max(LENGTHS), 2, 8
+    query, key, value = (torch.randn(len(LENGTHS), seq_len, heads, head_dim, generator=generator) for _ in range(3))
+    key_padding_mask = torch.zeros(len(LENGTHS), seq_len, dtype=torch.int64)
+    for i, length in enumerate(LENGTHS):
+        key_padding_mask[i, :length] = 1
+        key[i, length:] *= 100
+        value[i, length:] *= 100
+    return query, key, value, key_padding_mask
+
+
+def _unpadded_attention(query, key, value):
+    # every sample on its own, with only its real keys
+    return torch.stack([
+        F.scaled_dot_product_attention(
+            query[i].transpose(0, 1), key[i, :length].transpose(0, 1), value[i, :length].transpose(0, 1)
+        ).transpose(0, 1)
+        for i, length in enumerate(LENGTHS)
+    ])
+
+
+@pytest.mark.parametrize("backend", ["sdpa", "chunked"])
+def test_padded_keys_are_excluded(backend):
+    query, key, value, key_padding_mask = _padded_batch()
+    expected = _unpadded_attention(query, key, value).flatten(-2)
+    output = attention(query, key, value, key_padding_mask, backend=backend)
+    torch.testing.assert_close(output, expected, rtol=1e-5, atol=1e-5)
+
+
+def test_chunked_backend_chunks_match_full():
+    query, key, value, key_padding_mask = _padded_batch()
+    full = attention_processor.chunked_backend(query, key, value, key_padding_mask)
+    chunked = attention_processor.chunked_backend(query, key, value, key_padding_mask, chunk_size=2)
+    torch.testing.assert_close(chunked, full)
+
+
+def test_flash_attn_key_mask_drops_padded_keys():
+    query, key, value, key_padding_mask = _padded_batch()
+
+    def varlen_reference(q, k, v, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k, causal):
+        # the layout flash-attn's varlen kernels take: samples back to back, delimited by the cumulative lengths
+        outputs = []
+        for i in range(len(cu_seqlens_q) - 1):
+            qi = q[cu_seqlens_q[i]:cu_seqlens_q[i + 1]].transpose(0, 1)
+            ki = k[cu_seqlens_k[i]:cu_seqlens_k[i + 1]].transpose(0, 1)
+            vi = v[cu_seqlens_k[i]:cu_seqlens_k[i + 1]].transpose(0, 1)
+            outputs.append(F.scaled_dot_product_attention(qi, ki, vi, is_causal=causal).transpose(0, 1))
+        return torch.cat(outputs)
+
+    output = _flash_attn_with_key_mask(varlen_reference, query, key, value, key_padding_mask)
+    torch.testing.assert_close(output.view(query.shape), _unpadded_attention(query, key, value))
+
+
+def test_auto_without_flash_attn(monkeypatch):
+    monkeypatch.setattr(attention_processor, "USE_FLASH_ATTN3", False)
+    monkeypatch.setattr(attention_processor, "USE_FLASH_ATTN2", False)
+    attention_processor.set_attention_backend("auto")
+    query, key, value, key_padding_mask = _padded_batch()
+    assert get_attention_backend(query).name == "sdpa"
+    output = attention(query, key, value, key_padding_mask)
+    torch.testing.assert_close(output, _unpadded_attention(query, key, value).flatten(-2), rtol=1e-5, atol=1e-5)
+
+
+def test_select_fastest_attention_backend(monkeypatch):
+    monkeypatch.setattr(attention_processor, "USE_FLASH_ATTN3", False)
+    monkeypatch.setattr(attention_processor, "USE_FLASH_ATTN2", False)
+    timings = benchmark_attention_backends(1, 16, 2, 8, torch.device("cpu"), dtype=torch.float32, warmup=1, iters=1)
+    # the flash backends are unavailable on CPU and skipped
+    assert set(timings) == {"sdpa", "chunked"}
+    backend = select_fastest_attention_backend(
+        1, 16, 2, 8, torch.device("cpu"), dtype=torch.float32, warmup=1, iters=1
+    )
+    assert backend in timings and _ATTENTION_CONFIG["backend"] == backend
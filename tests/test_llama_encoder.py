@@ -0,0 +1,27 @@
+import pytest
+import torch
+from transformers import LlamaConfig, LlamaForCausalLM, LlamaModel
+
+from hi_diffusers.pipelines.hidream_image.llama_encoder import encode_llama_layers
+
+
+@pytest.mark.parametrize("cls", [LlamaForCausalLM, LlamaModel])
+def test_encode_llama_layers_matches_hidden_states(cls):
+    config = LlamaConfig(
+        vocab_size=100, hidden_size=32, intermediate_size=64, num_hidden_layers=4, num_attention_heads=4,
+        num_key_value_heads=2,
+    )
+    torch.manual_seed(0)
+    text_encoder = cls(config).eval()
+    input_ids = torch.randint(0, 100, (2, 7))
+    attention_mask = torch.ones(2, 7, dtype=torch.int64)
+    attention_mask[0, 5:] = 0
+    with torch.no_grad():
+        outputs = text_encoder(input_ids, attention_mask=attention_mask, output_hidden_states=True)
+    expected = torch.stack(outputs.hidden_states[1:], dim=0)[[3, 0, 2]]
+
+    calls = []
+    # stands in for the accelerate hook `enable_model_cpu_offload` installs on the top-level module
+    text_encoder.register_forward_pre_hook(lambda module, args: calls.append(module))
+    torch.testing.assert_close(encode_llama_layers(text_encoder, input_ids, attention_mask, [3, 0, 2]), expected)
+    assert calls == [text_encoder]
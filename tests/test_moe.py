@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from hi_diffusers.models import moe
+from hi_diffusers.models.moe import MOEFeedForwardSwiGLU
+
+
+def _moe_layer(dim=32, hidden_dim=64, num_experts=4, top_k=2):
+    torch.manual_seed(0)
+    layer = MOEFeedForwardSwiGLU(dim, hidden_dim, num_experts, top_k).eval()
+    for param in layer.parameters():
+        torch.nn.init.normal_(param, std=0.1)
+    return layer
+
+
+def _run(layer, impl, x):
+    layer.moe_impl = impl
+    with torch.no_grad():
+        return layer(x)
+
+
+@pytest.mark.skipif(not moe._GROUPED_MM_AVAILABLE, reason="torch._grouped_mm is not available")
+def test_grouped_matches_loop():
+    layer = _moe_layer()
+    x = torch.randn(2, 24, 32)
+    torch.testing.assert_close(_run(layer, "grouped", x), _run(layer, "loop", x), rtol=1e-4, atol=1e-5)
+
+
+def test_grouped_falls_back_to_loop_once(monkeypatch):
+    calls = []
+
+    def unsupported(*args, **kwargs):
+        calls.append(args)
+        raise RuntimeError("unsupported")
+
+    monkeypatch.setattr(moe, "_GROUPED_MM_AVAILABLE", True)
+    monkeypatch.setattr(moe, "_GROUPED_MM_UNSUPPORTED", set())
+    monkeypatch.setattr(torch, "_grouped_mm", unsupported, raising=False)
+    layer = _moe_layer()
+    x = torch.randn(2, 24, 32)
+    expected = _run(layer, "loop", x)
+    for _ in range(3):
+        torch.testing.assert_close(_run(layer, "grouped", x), expected)
+    assert len(calls) == 1
@@ -0,0 +1,120 @@
+import os
+import socket
+
+import pytest
+import torch
+import torch.distributed as dist
+
+from tiny_model import tiny_inputs, tiny_model
+
+pytestmark = pytest.mark.skipif(not dist.is_available(), reason="torch.distributed is not available")
+
+
+def _free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _spawn(worker, world_size, *args):
+    """Runs `worker(rank, world_size, *args, results)` on `world_size` gloo processes and returns rank 0's result."""
+    context = torch.multiprocessing.get_context("spawn")
+    results = context.SimpleQueue()
+    torch.multiprocessing.start_processes(
+        _init_and_run, args=(world_size, _free_port(), worker, args, results), nprocs=world_size,
+        start_method="spawn",
+    )
+    return results.get()
+
+
+def _init_and_run(rank, world_size, port, worker, args, results):
+    os.environ["MASTER_ADDR"] = "127.0.0.1"
+    os.environ["MASTER_PORT"] = str(port)
+    dist.init_process_group("gloo", rank=rank, world_size=world_size)
+    try:
+        result = worker(rank, world_size, *args)
+        if rank == 0:
+            results.put(result)
+    finally:
+        dist.destroy_process_group()
+
+
+def _expert_parallel_worker(rank, world_size, capacity_factor):
+    model = tiny_model()
+    # every rank runs its own requests, as under data parallelism
+    inputs = tiny_inputs(rank + 1, 32, 32, seed=rank)
+    reference = model(**inputs)[0]
+    model.enable_expert_parallel(capacity_factor=capacity_factor)
+    error = (model(**inputs)[0] - reference).abs().max()
+    dist.all_reduce(error, op=dist.ReduceOp.MAX)
+    return error.item(), model.expert_parallel.stats()
+
+
+@pytest.mark.parametrize("world_size", [2, 4])
+def test_expert_parallel_matches_unsplit(world_size):
+    error, stats = _spawn(_expert_parallel_worker, world_size, None)
+    assert error < 1e-4
+    assert stats["drop_rate"] == 0.0
+
+
+def test_expert_parallel_capacity_factor_drops_tokens():
+    error, stats = _spawn(_expert_parallel_worker, 2, 1.0)
+    assert 0.0 <= stats["drop_rate"] < 1.0
+
+
+def _pipeline_parallel_worker(rank, world_size, num_micro_batches):
+    model = tiny_model()
+    inputs = tiny_inputs(3, 32, 32)
+    reference = model(**inputs)[0]
+    model.enable_pipeline_parallel(num_micro_batches=num_micro_batches)
+    error = (model(**inputs)[0] - reference).abs().max()
+    dist.all_reduce(error, op=dist.ReduceOp.MAX)
+    return error.item()
+
+
+@pytest.mark.parametrize("num_micro_batches", [1, 2])
+def test_pipeline_parallel_devices_matches_unsplit(num_micro_batches):
+    model = tiny_model()
+    inputs = tiny_inputs(3, 32, 32)
+    reference = model(**inputs)[0]
+    model.enable_pipeline_parallel(devices=["cpu", "cpu"], num_micro_batches=num_micro_batches)
+    torch.testing.assert_close(model(**inputs)[0], reference, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize("world_size,num_micro_batches", [(2, 1), (2, 2), (3, 3)])
+def test_pipeline_parallel_processes_match_unsplit(world_size, num_micro_batches):
+    assert _spawn(_pipeline_parallel_worker, world_size, num_micro_batches) < 1e-4
+
+
+def _sequence_parallel_worker(rank, world_size, height, width):
+    model = tiny_model(num_attention_heads=4)
+    inputs = tiny_inputs(2, height, width)
+    reference = model(**inputs)[0]
+    model.enable_sequence_parallel()
+    layouts = []
+    layout = model.sequence_parallel.layout
+
+    def recording_layout(*args):
+        layouts.append(layout(*args))
+        return layouts[-1]
+
+    model.sequence_parallel.layout = recording_layout
+    error = (model(**inputs)[0] - reference).abs().max()
+    dist.all_reduce(error, op=dist.ReduceOp.MAX)
+    return error.item(), [seq_shard is not None for seq_shard in layouts]
+
+
+@pytest.mark.parametrize("world_size", [2, 4])
+@pytest.mark.parametrize("height,width", [(32, 32), (8, 16)], ids=["square", "non-square"])
+def test_sequence_parallel_matches_unsplit(world_size, height, width):
+    error, sharded = _spawn(_sequence_parallel_worker, world_size, height, width)
+    assert error < 1e-4
+    assert sharded == [True]
+
+
+@pytest.mark.parametrize("world_size", [2, 4])
+def test_sequence_parallel_uneven_image_tokens_run_unsharded(world_size):
+    # 3x3 patches, 9 image tokens split evenly across neither 2 nor 4 ranks
+    error, sharded = _spawn(_sequence_parallel_worker, world_size, 6, 6)
+    assert error < 1e-4
+    assert sharded == [False]
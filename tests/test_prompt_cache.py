@@ -0,0 +1,125 @@
+from types import SimpleNamespace
+
+import torch
+from torch import nn
+
+from hi_diffusers.pipelines.hidream_image.prompt_cache import PromptEmbeddingCache, _entry_nbytes
+
+DEVICE = torch.device("cpu")
+
+
+def _pipeline():
+    torch.manual_seed(0)
+    encoded = []
+
+    def encode_prompt_embeds(
+        prompt, prompt_2, prompt_3, prompt_4, device, dtype, num_images_per_prompt, max_sequence_length
+    ):
+        encoded.extend(prompt)
+        # embeddings that identify their prompt
+        lengths = torch.tensor([float(len(text)) for text in prompt])
+        t5 = lengths[:, None, None] + torch.arange(4 * 8.0).view(1, 4, 8)
+        llama = lengths[None, :, None, None] + torch.arange(3 * 5 * 12.0).view(3, 1, 5, 12)
+        return [t5, llama], lengths[:, None] + torch.arange(10.0)
+
+    return SimpleNamespace(
+        text_encoder=nn.Linear(4, 4), text_encoder_2=nn.Linear(4, 4), text_encoder_3=nn.Linear(4, 4),
+        text_encoder_4=nn.Linear(4, 4), transformer=None, text_length_buckets=None,
+        _encode_prompt_embeds=encode_prompt_embeds, encoded=encoded,
+    )
+
+
+def _encode(cache, pipeline, prompts, num_images_per_prompt=1):
+    return cache.encode(pipeline, [(prompt,) * 4 for prompt in prompts], DEVICE, None, num_images_per_prompt, 128)
+
+
+def _entry(value, nbytes=1024):
+    return {"t5": torch.full((nbytes // 4,), float(value))}
+
+
+def test_hits_return_the_encoded_embeddings():
+    pipeline = _pipeline()
+    cache = PromptEmbeddingCache()
+    (t5, llama), pooled = _encode(cache, pipeline, ["a", "bb"])
+    # a repeated prompt is encoded once; cached prompts are not encoded again
+    (cached_t5, cached_llama), cached_pooled = _encode(cache, pipeline, ["bb", "a", "ccc", "ccc"], 2)
+    assert pipeline.encoded == ["a", "bb", "ccc"]
+    assert cache.stats()["hits"]["device"] == 2 and cache.stats()["misses"] == 3
+    torch.testing.assert_close(cached_t5[:4], t5[[1, 1, 0, 0]])
+    torch.testing.assert_close(cached_llama[:, :4], llama[:, [1, 1, 0, 0]])
+    torch.testing.assert_close(cached_pooled[:4], pooled[[1, 1, 0, 0]])
+
+
+def test_device_tier_evicts_least_recently_used_bytes_to_host():
+    cache = PromptEmbeddingCache(device_bytes=2048, host_bytes=1024)
+    cache.put("a", _entry(0))
+    cache.put("b", _entry(1))
+    # touching "a" makes "b" the least recently used entry
+    assert cache.get("a", DEVICE) is not None
+    cache.put("c", _entry(2))
+    assert list(cache.device_tier.entries) == ["a", "c"] and list(cache.host_tier.entries) == ["b"]
+    assert cache.device_tier.nbytes == 2 * _entry_nbytes(_entry(0))
+
+    # a host hit moves the entry back to the device, whose evicted entry pushes the oldest one out of the host tier
+    assert torch.all(cache.get("b", DEVICE)["t5"] == 1)
+    assert cache.hits == {"device": 1, "host": 1, "disk": 0}
+    assert list(cache.device_tier.entries) == ["c", "b"] and list(cache.host_tier.entries) == ["a"]
+    cache.put("d", _entry(3))
+    assert list(cache.host_tier.entries) == ["c"]
+    assert cache.get("a", DEVICE) is None
+
+
+def test_disk_round_trip(tmp_path):
+    pipeline = _pipeline()
+    entry = {
+        "t5": torch.randn(1, 4, 8, dtype=torch.bfloat16), "llama": torch.randn(3, 1, 5, 12),
+        "t5_mask": torch.tensor([[1, 1, 0, 0]]), "pooled": torch.randn(1, 10),
+    }
+    PromptEmbeddingCache(disk_dir=str(tmp_path)).put("prompt", entry)
+
+    # a new cache, e.g. after a restart, reads the entry from disk and promotes it to the device tier
+    cache = PromptEmbeddingCache(disk_dir=str(tmp_path))
+    loaded = cache.get("prompt", DEVICE)
+    assert loaded.keys() == entry.keys()
+    for name, tensor in entry.items():
+        assert loaded[name].dtype == tensor.dtype
+        torch.testing.assert_close(loaded[name], tensor)
+    assert cache.hits["disk"] == 1
+    cache.get("prompt", DEVICE)
+    assert cache.hits["device"] == 1
+
+    (t5, llama), pooled = _encode(cache, pipeline, ["a"])
+    cache.clear()
+    (disk_t5, disk_llama), disk_pooled = _encode(cache, pipeline, ["a"])
+    assert pipeline.encoded == ["a"] and cache.hits["disk"] == 2
+    torch.testing.assert_close(disk_t5, t5)
+    torch.testing.assert_close(disk_llama, llama)
+
+
+def test_disk_bytes_removes_least_recently_used_files(tmp_path):
+    cache = PromptEmbeddingCache(disk_dir=str(tmp_path))
+    cache.put("a", _entry(0))
+    file_size = next(cache._disk_files())[2]
+    cache = PromptEmbeddingCache(device_bytes=0, host_bytes=0, disk_dir=str(tmp_path), disk_bytes=2 * file_size)
+    cache.put("b", _entry(1))
+    cache.put("c", _entry(2))
+    assert sorted(path.stem for path in tmp_path.iterdir()) == ["b", "c"]
+
+
+def test_key_changes_with_the_encoder_weights():
+    pipeline = _pipeline()
+    cache = PromptEmbeddingCache()
+    key = cache.key(pipeline, ("a",) * 4, 128, None)
+    assert cache.key(pipeline, ("a",) * 4, 128, None) == key
+    with torch.no_grad():
+        pipeline.text_encoder_4.weight.mul_(2)
+    # fingerprints are computed once per module; `clear` forgets them after in-place changes
+    cache.clear()
+    changed_key = cache.key(pipeline, ("a",) * 4, 128, None)
+    assert changed_key != key
+
+    pipeline.text_encoder_4 = nn.Linear(4, 4)
+    replaced_key = cache.key(pipeline, ("a",) * 4, 128, None)
+    assert replaced_key not in (key, changed_key)
+    pipeline.text_length_buckets = [32, 64]
+    assert cache.key(pipeline, ("a",) * 4, 128, None) != replaced_key
@@ -0,0 +1,79 @@
+import pytest
+import torch
+
+from hi_diffusers.pipelines.hidream_image.text_buckets import (
+    bucket_length,
+    concat_prompt_embeds,
+    expand_prompt_embeds,
+    repeat_prompt_embeds,
+    select_prompt_embeds,
+)
+from tiny_model import tiny_inputs, tiny_model
+
+
+@pytest.mark.parametrize("length,expected", [(1, 32), (32, 32), (33, 64), (100, 128), (129, 128)])
+def test_bucket_length(length, expected):
+    assert bucket_length(length, [32, 64, 96], 128) == expected
+    assert bucket_length(length, [32, 64, 96, 256], 128) == expected
+
+
+def _prompt_embeds(batch_size, t5_length, llama_length, real_lengths=None, seed=0):
+    """Prompt embeddings of `batch_size` samples; with `real_lengths` the (t5, llama) tokens behind them are masked."""
+    generator = torch.Generator().manual_seed(seed)
+    prompt_embeds = [
+        torch.randn(batch_size, t5_length, 8, generator=generator),
+        torch.randn(5, batch_size, llama_length, 12, generator=generator),
+    ]
+    if real_lengths is not None:
+        t5_real, llama_real = real_lengths
+        prompt_embeds += [
+            (torch.arange(t5_length) < t5_real).long().expand(batch_size, -1),
+            (torch.arange(llama_length) < llama_real).long().expand(batch_size, -1),
+        ]
+    return prompt_embeds
+
+
+def test_select_and_expand_follow_the_batch_dim():
+    t5, llama, t5_mask, llama_mask = _prompt_embeds(3, 4, 5, real_lengths=(2, 3))
+    selected = select_prompt_embeds([t5, llama, t5_mask, llama_mask], slice(1, 3))
+    assert [tuple(x.shape) for x in selected] == [(2, 4, 8), (5, 2, 5, 12), (2, 4), (2, 5)]
+    torch.testing.assert_close(selected[1], llama[:, 1:3])
+    expanded = expand_prompt_embeds(select_prompt_embeds([t5, llama], slice(0, 1)), 3)
+    assert [tuple(x.shape) for x in expanded] == [(3, 4, 8), (5, 3, 5, 12)]
+    assert expanded[1].data_ptr() == llama.data_ptr()
+
+
+def test_masks_survive_repeat_and_cfg_concat():
+    # a bucketed prompt of 3 real T5 and 4 real Llama tokens and the unbucketed, longer negative prompt
+    negative = _prompt_embeds(1, 6, 7)
+    positive = repeat_prompt_embeds(_prompt_embeds(1, 4, 5, real_lengths=(3, 4), seed=1), 2)
+    t5, llama, t5_mask, llama_mask = concat_prompt_embeds([repeat_prompt_embeds(negative, 2), positive])
+
+    assert t5.shape == (4, 6, 8) and llama.shape == (5, 4, 7, 12)
+    assert t5_mask.tolist() == [[1] * 6] * 2 + [[1, 1, 1, 0, 0, 0]] * 2
+    assert llama_mask.tolist() == [[1] * 7] * 2 + [[1, 1, 1, 1, 0, 0, 0]] * 2
+    torch.testing.assert_close(t5[:2], negative[0].expand(2, -1, -1))
+    torch.testing.assert_close(t5[2:, :4], positive[0])
+    torch.testing.assert_close(llama[:, 2:, :5], positive[1])
+    assert torch.all(t5[2:, 4:] == 0) and torch.all(llama[:, 2:, 5:] == 0)
+
+
+def test_concat_of_equal_unmasked_embeds_stays_unmasked():
+    prompt_embeds = concat_prompt_embeds([_prompt_embeds(1, 6, 7), _prompt_embeds(2, 6, 7, seed=1)])
+    assert len(prompt_embeds) == 2 and prompt_embeds[1].shape == (5, 3, 7, 12)
+
+
+def test_masked_padding_matches_unpadded():
+    model = tiny_model()
+    inputs = tiny_inputs(2, 32, 32)
+    t5, llama = inputs["encoder_hidden_states"]
+    # padded to a larger bucket with tokens that change the output unless they are masked
+    padding = _prompt_embeds(2, 4, 3, seed=2)
+    padded = [torch.cat([t5, padding[0]], dim=1), torch.cat([llama, padding[1]], dim=2)]
+    masks = [(torch.arange(10) < 6).long().expand(2, -1), (torch.arange(10) < 7).long().expand(2, -1)]
+    with torch.no_grad():
+        reference = model(**inputs)[0]
+        output = model(**{**inputs, "encoder_hidden_states": padded + masks})[0]
+        unmasked_output = model(**{**inputs, "encoder_hidden_states": padded})[0]
+    torch.testing.assert_close(output, reference, rtol=0, atol=1e-4)
+    assert not torch.allclose(unmasked_output, reference, rtol=0, atol=1e-4)
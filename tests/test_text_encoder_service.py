@@ -0,0 +1,70 @@
+import os
+import tempfile
+import threading
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from hi_diffusers.pipelines.hidream_image.text_encoder_service import RemoteTextEncoder, TextEncoderServer
+
+
+def _encode_prompt_embeds(
+    prompt, prompt_2, prompt_3, prompt_4, device, num_images_per_prompt, max_sequence_length, llama_layers
+):
+    if "fail" in prompt:
+        raise ValueError("cannot encode this prompt")
+    # embeddings that identify their prompt, so misrouted results show
+    lengths = torch.tensor([float(len(text)) for text in prompt])
+    t5 = lengths[:, None, None].expand(-1, 4, 8).clone()
+    llama = lengths[None, :, None, None].expand(3, -1, 5, 12).clone()
+    return [t5, llama], lengths[:, None].expand(-1, 10).clone()
+
+
+@pytest.fixture
+def server():
+    pipeline = SimpleNamespace(
+        _encode_prompt_embeds=_encode_prompt_embeds, _execution_device=torch.device("cpu"), text_length_buckets=None
+    )
+    server = TextEncoderServer(pipeline, os.path.join(tempfile.mkdtemp(), "encoder.sock"), batch_timeout=0.5)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+
+
+def test_failing_request_does_not_fail_its_batch(server):
+    prompts = {0: "a", 1: "fail", 2: "ccc", 3: "dddd"}
+    results = {}
+
+    def client(i):
+        try:
+            results[i] = RemoteTextEncoder(server.socket_path).encode([(prompts[i],) * 4], 128)
+        except RuntimeError as error:
+            results[i] = error
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in prompts]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert isinstance(results[1], RuntimeError) and "ValueError" in str(results[1])
+    for i in (0, 2, 3):
+        (t5, llama), pooled = results[i]
+        assert t5.shape == (1, 4, 8) and llama.shape == (3, 1, 5, 12)
+        assert torch.all(t5 == len(prompts[i])) and torch.all(pooled == len(prompts[i]))
+    assert server.stats()["requests"] == 3
+
+
+def test_request_buckets_do_not_outlive_the_request(server):
+    server.pipeline.text_length_buckets = [64, 128]
+    seen_buckets = []
+
+    def encode_prompt_embeds(*args, **kwargs):
+        seen_buckets.append(server.pipeline.text_length_buckets)
+        return _encode_prompt_embeds(*args, **kwargs)
+
+    server.pipeline._encode_prompt_embeds = encode_prompt_embeds
+    RemoteTextEncoder(server.socket_path).encode([("a",) * 4], 128, text_length_buckets=[32])
+    assert seen_buckets == [[32]]
+    assert server.pipeline.text_length_buckets == [64, 128]
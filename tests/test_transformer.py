@@ -0,0 +1,163 @@
+import tempfile
+
+import pytest
+import torch
+from torch import nn
+
+from hi_diffusers import HiDreamImageTransformer2DModel
+from hi_diffusers.models.quantization import Int8WeightOnlyLinear
+from tiny_model import tiny_inputs, tiny_model
+
+# every toggle below changes how the forward is computed, not what it computes
+ATOL = 1e-4
+
+
+@pytest.fixture(params=[(32, 32), (8, 16)], ids=["square", "non-square"])
+def inputs(request):
+    return tiny_inputs(2, *request.param)
+
+
+def _forward(model, inputs, **kwargs):
+    with torch.no_grad():
+        return model(**inputs, **kwargs)[0]
+
+
+def _assert_parity(model, inputs, reference, **kwargs):
+    torch.testing.assert_close(_forward(model, inputs, **kwargs), reference, rtol=0, atol=ATOL)
+
+
+def test_text_conditioning(inputs):
+    model = tiny_model()
+    reference = _forward(model, inputs)
+    with torch.no_grad():
+        text_conditioning = model.prepare_text_conditioning(inputs["encoder_hidden_states"])
+    _assert_parity(model, inputs, reference, text_conditioning=text_conditioning)
+
+
+def test_rope_cache(inputs):
+    model = tiny_model()
+    model.pe_embedder.cache_size = 0
+    reference = _forward(model, inputs)
+    model.pe_embedder.cache_size = 16
+    _forward(model, inputs)
+    _assert_parity(model, inputs, reference)
+    assert model.pe_embedder.cache_info()["hits"] > 0
+
+
+def test_fuse_projections(inputs):
+    model = tiny_model()
+    reference = _forward(model, inputs)
+    model.fuse_projections()
+    _assert_parity(model, inputs, reference)
+    model.unfuse_projections()
+    _assert_parity(model, inputs, reference)
+
+
+def test_fuse_adaln_modulation(inputs):
+    model = tiny_model()
+    reference = _forward(model, inputs)
+    model.fuse_adaln_modulation()
+    _assert_parity(model, inputs, reference)
+
+
+def test_schedule_conditioning(inputs):
+    model = tiny_model()
+    timesteps = torch.tensor([500.0, 250.0])
+    references = [_forward(model, {**inputs, "timesteps": t.expand(2)}) for t in timesteps]
+    with torch.no_grad():
+        schedule_conditioning = model.prepare_schedule_conditioning(timesteps, inputs["pooled_embeds"])
+    for step, reference in enumerate(references):
+        _assert_parity(model, inputs, reference, step_conditioning=schedule_conditioning[step])
+
+
+def test_block_cache_without_skips(inputs):
+    model = tiny_model()
+    reference = _forward(model, inputs)
+    model.enable_block_cache(threshold=0.0, warmup_steps=0)
+    model.block_cache.reset(num_steps=3)
+    for _ in range(3):
+        _assert_parity(model, inputs, reference)
+    assert model.block_cache.skipped_steps == 0
+
+
+def test_token_merging_without_merges():
+    inputs = tiny_inputs(2, 32, 32)
+    model = tiny_model()
+    reference = _forward(model, inputs)
+    model.enable_token_merging(ratio=0.0)
+    _assert_parity(model, inputs, reference)
+
+
+def test_int8_matches_dequantized_weights(inputs):
+    model = tiny_model()
+    model.quantize_weights()
+    output = _forward(model, inputs)
+    for name, module in list(model.named_modules()):
+        if isinstance(module, Int8WeightOnlyLinear):
+            linear = nn.Linear(module.in_features, module.out_features, bias=module.bias is not None)
+            linear.weight.data = module.dequantize()
+            if module.bias is not None:
+                linear.bias.data = module.bias.data
+            parent_name, _, child_name = name.rpartition(".")
+            setattr(model.get_submodule(parent_name), child_name, linear)
+    for module in model.modules():
+        if hasattr(module, "_stacked_expert_weights"):
+            module._stacked_expert_weights = None
+    torch.testing.assert_close(output, _forward(model, inputs), rtol=0, atol=ATOL)
+
+
+def test_int8_save_load_round_trip():
+    inputs = tiny_inputs(2, 32, 32)
+    model = tiny_model()
+    model.quantize_weights()
+    reference = _forward(model, inputs)
+    with tempfile.TemporaryDirectory() as directory:
+        model.save_pretrained(directory)
+        loaded = HiDreamImageTransformer2DModel.from_pretrained(directory).eval()
+        loaded_bf16 = HiDreamImageTransformer2DModel.from_pretrained(directory, torch_dtype=torch.bfloat16)
+    _assert_parity(loaded, inputs, reference)
+    # the weights mapped from the checkpoint file are realigned once, at load time
+    qweights = [module.qweight for module in loaded.modules() if isinstance(module, Int8WeightOnlyLinear)]
+    assert all(qweight.data_ptr() % 64 == 0 for qweight in qweights)
+    _assert_int8_scales_float32(loaded_bf16)
+    # casting the model keeps them too
+    _assert_int8_scales_float32(loaded_bf16.to(torch.float16))
+
+
+def _assert_int8_scales_float32(model):
+    scales = [module.weight_scale for module in model.modules() if isinstance(module, Int8WeightOnlyLinear)]
+    assert scales and all(scale.dtype == torch.float32 for scale in scales)
+
+
+def test_expert_offload(inputs):
+    model = tiny_model()
+    reference = _forward(model, inputs)
+    model.enable_expert_offload(max_device_experts=2)
+    _assert_parity(model, inputs, reference)
+    model.disable_expert_offload()
+    _assert_parity(model, inputs, reference)
+
+
+def test_block_streaming(inputs):
+    model = tiny_model()
+    reference = _forward(model, inputs)
+    model.enable_block_streaming()
+    _assert_parity(model, inputs, reference)
+    model.disable_block_streaming()
+    _assert_parity(model, inputs, reference)
+
+
+def test_ffn_memory_budget(inputs):
+    model = tiny_model()
+    reference = _forward(model, inputs)
+    # a few rows per slice, so every feed-forward and MoE layer runs in several chunks
+    model.set_ffn_memory_budget(4096)
+    _assert_parity(model, inputs, reference)
+
+
+def test_block_workspace(inputs):
+    model = tiny_model()
+    reference = _forward(model, inputs)
+    model.enable_block_workspace()
+    for _ in range(2):
+        _assert_parity(model, inputs, reference)
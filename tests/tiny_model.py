@@ -0,0 +1,39 @@
+import torch
+
+from hi_diffusers import HiDreamImageTransformer2DModel
+
+
+def tiny_model(num_attention_heads=2):
+    torch.manual_seed(0)
+    model = HiDreamImageTransformer2DModel(
+        patch_size=2, in_channels=4, num_layers=2, num_single_layers=3, attention_head_dim=16,
+        num_attention_heads=num_attention_heads, caption_channels=[8, 12], text_emb_dim=10, axes_dims_rope=(8, 4, 4),
+        max_resolution=(16, 16), llama_layers=[0, 1, 2, 3, 4],
+    )
+    with torch.no_grad():
+        # the released initialization zeroes the adaLN modulations, which would hide most of the blocks
+        for param in model.parameters():
+            param.normal_(0, 0.2)
+    return model.eval()
+
+
+def tiny_inputs(batch_size, height, width, seed=1, max_seq=64):
+    """Inputs of `tiny_model`; non-square latents are patchified and padded to `max_seq` like the pipeline does."""
+    generator = torch.Generator().manual_seed(seed)
+    hidden_states = torch.randn(batch_size, 4, height, width, generator=generator)
+    inputs = dict(
+        hidden_states = hidden_states,
+        timesteps = torch.full((batch_size,), 500.0),
+        encoder_hidden_states = [
+            torch.randn(batch_size, 6, 8, generator=generator), torch.randn(5, batch_size, 7, 12, generator=generator)
+        ],
+        pooled_embeds = torch.randn(batch_size, 10, generator=generator),
+        return_dict = False,
+    )
+    if height != width:
+        pH, pW = height // 2, width // 2
+        patches = hidden_states.reshape(batch_size, 4, pH, 2, pW, 2).permute(0, 1, 2, 4, 3, 5)
+        padded = torch.zeros(batch_size, 4, max_seq, 4)
+        padded[:, :, :pH * pW] = patches.reshape(batch_size, 4, pH * pW, 4)
+        inputs.update(hidden_states=padded, img_sizes=[(pH, pW)] * batch_size)
+    return inputs
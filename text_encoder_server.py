@@ -0,0 +1,39 @@
+# text_encoder_server.py
+import os, torch
+from transformers import LlamaForCausalLM, PreTrainedTokenizerFast
+
+from hi_diffusers import HiDreamImagePipeline
+from hi_diffusers.pipelines.hidream_image.text_encoder_service import TextEncoderServer
+from worker import MODEL_PREFIX, LLAMA_MODEL_NAME
+
+# the CLIP, T5 and Llama encoders are the same for all HiDream-I1 variants
+MODEL_PATH = f"{MODEL_PREFIX}/HiDream-I1-Full"
+
+def load_text_encoders():
+    tokenizer_4 = PreTrainedTokenizerFast.from_pretrained(LLAMA_MODEL_NAME, use_fast=False)
+    text_encoder_4 = LlamaForCausalLM.from_pretrained(
+        LLAMA_MODEL_NAME,
+        output_hidden_states=True,
+        torch_dtype=torch.bfloat16,
+    )
+    pipeline = HiDreamImagePipeline.from_pretrained(
+        MODEL_PATH,
+        vae=None,
+        tokenizer_4=tokenizer_4,
+        text_encoder_4=text_encoder_4,
+        torch_dtype=torch.bfloat16,
+    ).to("cuda", torch.bfloat16)
+    # the workers send the Llama layers their transformer reads with every request
+    pipeline.transformer = None
+    return pipeline
+
+
+# ==== Entrypoint ====
+if __name__ == "__main__":
+    torch.cuda.set_device(0)
+    socket_path = os.environ.get("TEXT_ENCODER_SOCKET", "/tmp/hidream_text_encoder.sock")
+
+    print("Loading text encoders...")
+    server = TextEncoderServer(load_text_encoders(), socket_path)
+    print(f"Text encoder service listening on {socket_path}")
+    server.serve_forever()
@@ -1,5 +1,6 @@
 # worker.py
 import os, torch
+from typing import Optional, Tuple
 from fastapi import FastAPI
 from pydantic import BaseModel
 from datetime import datetime
@@ -16,25 +17,58 @@ app = FastAPI()
 MODEL_PREFIX = "./"
 LLAMA_MODEL_NAME = "Meta-Llama-3.1-8B-Instruct"
 
+# options of the fast paths, the same for every model; None / False disables each
+FAST_PATH_DEFAULTS = {
+    # block residual cache, e.g. {"preset": ...} or {"threshold": ...}; None disables it
+    "block_cache": None,
+    # "int8" stores the transformer Linear weights as int8 with per-channel scales
+    "weight_quantization": None,
+    # keep only this many routed experts on the GPU and the rest in pinned host memory; None keeps all
+    "max_device_experts": None,
+    # stream the transformer blocks from pinned host memory through the GPU, overlapping copies with compute
+    "block_streaming": False,
+    # torch.compile kwargs of the per-resolution compiled transformer forward, e.g. {"mode": "max-autotune"}
+    "static_compile": None,
+    # bytes of feed-forward / MoE activations per token slice, e.g. 512 * 2**20; None runs the full sequence at once
+    "ffn_memory_budget": None,
+    # run the transformer blocks in place on reused workspace buffers
+    "block_workspace": False,
+    # prompt embedding cache kwargs, e.g. {"device_bytes": 2**30, "disk_dir": "prompt_cache"}; None disables it
+    "prompt_cache": None,
+    # pad prompts to the smallest of these token counts and mask the padding, e.g. [32, 64, 96, 128]; None pads to 128
+    "text_length_buckets": None,
+    # Unix socket of a text_encoder_server.py shared by the workers of the host (set by controller.py); None loads the text encoders here
+    "text_encoder_socket": os.environ.get("TEXT_ENCODER_SOCKET"),
+}
+
 MODEL_CONFIGS = {
     "dev": {
+        **FAST_PATH_DEFAULTS,
         "path": f"{MODEL_PREFIX}/HiDream-I1-Dev",
         "guidance_scale": 0.0,
         "num_inference_steps": 28,
+        # e.g. {"preset": "dev"}
+        "block_cache": None,
         "shift": 6.0,
         "scheduler": FlashFlowMatchEulerDiscreteScheduler
     },
     "full": {
+        **FAST_PATH_DEFAULTS,
         "path": f"{MODEL_PREFIX}/HiDream-I1-Full",
         "guidance_scale": 5.0,
         "num_inference_steps": 50,
+        # e.g. {"preset": "full"}
+        "block_cache": None,
         "shift": 3.0,
         "scheduler": FlowUniPCMultistepScheduler
     },
     "fast": {
+        **FAST_PATH_DEFAULTS,
         "path": f"{MODEL_PREFIX}/HiDream-I1-Fast",
         "guidance_scale": 0.0,
         "num_inference_steps": 16,
+        # e.g. {"preset": "fast"}
+        "block_cache": None,
         "shift": 3.0,
         "scheduler": FlashFlowMatchEulerDiscreteScheduler
     }
@@ -48,28 +82,59 @@ def load_models(model_type):
     config = MODEL_CONFIGS[model_type]
     scheduler = config["scheduler"](num_train_timesteps=1000, shift=config["shift"], use_dynamic_shifting=False)
 
-    tokenizer_4 = PreTrainedTokenizerFast.from_pretrained(LLAMA_MODEL_NAME, use_fast=False)
-    text_encoder_4 = LlamaForCausalLM.from_pretrained(
-        LLAMA_MODEL_NAME,
-        output_hidden_states=True,
-        output_attentions=True,
-        torch_dtype=torch.bfloat16,
-    ).to("cuda")
+    if config["text_encoder_socket"] is not None:
+        # the prompts are encoded by the shared service, so the worker loads none of the text encoders
+        text_encoders = {f"{name}{suffix}": None for name in ("tokenizer", "text_encoder") for suffix in ("", "_2", "_3", "_4")}
+    else:
+        text_encoders = {
+            "tokenizer_4": PreTrainedTokenizerFast.from_pretrained(LLAMA_MODEL_NAME, use_fast=False),
+            "text_encoder_4": LlamaForCausalLM.from_pretrained(
+                LLAMA_MODEL_NAME,
+                output_hidden_states=True,
+                torch_dtype=torch.bfloat16,
+            ).to("cuda"),
+        }
 
     transformer = HiDreamImageTransformer2DModel.from_pretrained(
         config["path"],
         subfolder="transformer",
         torch_dtype=torch.bfloat16
-    ).to("cuda")
+    )
+    if config["weight_quantization"] is not None and transformer.weight_quantization is None:
+        # quantized before moving to the device, so the full precision weights never occupy device memory
+        transformer.quantize_weights(config["weight_quantization"])
+    if config["max_device_experts"] is not None:
+        transformer.enable_expert_offload(config["max_device_experts"], device="cuda")
+    elif config["block_streaming"]:
+        transformer.enable_block_streaming(device="cuda")
+    transformer = transformer.to("cuda")
+    if config["ffn_memory_budget"] is not None:
+        transformer.set_ffn_memory_budget(config["ffn_memory_budget"])
+    if config["block_workspace"]:
+        transformer.enable_block_workspace()
+    if config["block_cache"] is not None:
+        transformer.enable_block_cache(**config["block_cache"])
 
     pipeline = HiDreamImagePipeline.from_pretrained(
         config["path"],
         scheduler=scheduler,
-        tokenizer_4=tokenizer_4,
-        text_encoder_4=text_encoder_4,
+        **text_encoders,
         torch_dtype=torch.bfloat16,
     ).to("cuda", torch.bfloat16)
     pipeline.transformer = transformer
+    if config["text_encoder_socket"] is not None:
+        pipeline.enable_remote_text_encoder(config["text_encoder_socket"])
+    if config["prompt_cache"] is not None:
+        pipeline.enable_prompt_cache(**config["prompt_cache"])
+    if config["text_length_buckets"] is not None:
+        pipeline.enable_text_length_buckets(config["text_length_buckets"])
+    if config["guidance_scale"] > 1.0:
+        # the empty negative prompt of every guided request is encoded once here and broadcast to the batch
+        pipeline.precompute_negative_prompt_embeds([""])
+    if config["static_compile"] is not None:
+        # the loop MoE syncs with the host to size its expert batches, which breaks the graph in every MoE layer
+        transformer.set_moe_impl("grouped")
+        pipeline.enable_static_compile(**config["static_compile"])
 
     return pipeline, config
 
@@ -83,12 +148,19 @@ class GenRequest(BaseModel):
     height: int = 1024
     seed: int = -1
     model: str = "full"  # optional override
+    # CFG only for sigmas inside (low, high); the conditional branch runs alone outside it
+    guidance_interval: Optional[Tuple[float, float]] = None
+    # recompute the unconditional prediction every k guided steps, "reuse" or "extrapolate" it in between
+    uncond_refresh_steps: int = 1
+    uncond_reuse: str = "reuse"
 
 
 import base64
 from io import BytesIO
 
-def generate_image(prompt, width, height, seed, model_type="full"):
+def generate_image(
+    prompt, width, height, seed, model_type="full", guidance_interval=None, uncond_refresh_steps=1, uncond_reuse="reuse"
+):
     global pipe, current_model
 
     if pipe is None or model_type != current_model:
@@ -103,7 +175,7 @@ def generate_image(prompt, width, height, seed, model_type="full"):
     config = MODEL_CONFIGS[model_type]
     generator = torch.Generator("cuda").manual_seed(seed)
 
-    images = pipe(
+    output = pipe(
         prompt,
         height=height,
         width=width,
@@ -111,21 +183,33 @@ def generate_image(prompt, width, height, seed, model_type="full"):
         num_inference_steps=config["num_inference_steps"],
         num_images_per_prompt=1,
         generator=generator,
-    ).images
+        guidance_interval=guidance_interval,
+        uncond_refresh_steps=uncond_refresh_steps,
+        uncond_reuse=uncond_reuse,
+    )
 
-    img = images[0]
+    img = output.images[0]
 
     # Convert PIL image to base64
     buffered = BytesIO()
     img.save(buffered, format="PNG")
     img_str = base64.b64encode(buffered.getvalue()).decode("utf-8")
 
-    return img_str
+    return img_str, output.skipped_steps
 
 @app.post("/generate")
 async def generate(req: GenRequest):
     actual_seed = req.seed if req.seed != -1 else int(torch.randint(0, 2**32 - 1, (1,)).item())
-    img_str = generate_image(req.prompt, req.width, req.height, actual_seed, model_type=req.model)
+    img_str, skipped_steps = generate_image(
+        req.prompt,
+        req.width,
+        req.height,
+        actual_seed,
+        model_type=req.model,
+        guidance_interval=req.guidance_interval,
+        uncond_refresh_steps=req.uncond_refresh_steps,
+        uncond_reuse=req.uncond_reuse,
+    )
 
     metadata = {
         "model": req.model,
@@ -133,6 +217,10 @@ async def generate(req: GenRequest):
         "width": req.width,
         "height": req.height,
         "seed": actual_seed,
+        "guidance_interval": req.guidance_interval,
+        "uncond_refresh_steps": req.uncond_refresh_steps,
+        "uncond_reuse": req.uncond_reuse,
+        "skipped_steps": skipped_steps,
         "device": torch.cuda.current_device(),
         "date": datetime.now().isoformat(),
     }